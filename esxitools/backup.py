@@ -1,17 +1,35 @@
 import os
+import errno
+import socket
 import datetime
 from glob import glob
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+import tarfile
+import shutil
+import subprocess
+import sys
 import re
 from tendo import singleton
 import paramiko
 from scp import SCPClient
 from ftplib import FTP
 from string import Template
-from tempfile import mkstemp
+from tempfile import mkstemp, TemporaryFile
+from distutils.spawn import find_executable
+from contextlib import contextmanager
 import logging
 import io
 
-import utils
+import integrity
+import profiles
+import history
+import watchdog
+import tiering
+import extents
+import notify
+import compression
+import compat
 
 log_stream = io.StringIO()
 logger = logging.getLogger(__name__)
@@ -44,10 +62,37 @@ def get_current_time():
 
 class BackupProfile(object):
     _no_such_file_or_dir_re = re.compile(u'No such file or directory')
+    # Disk files in a ghettovcb backup dir (descriptor and flat extent)
+    _disk_file_re = re.compile(u'(?P<disk>.+?)(\-flat)?\.vmdk$')
+    # `vim-cmd vmsvc/getallvms` line of a VM
+    _getallvms_re = re.compile(u'^(?P<vmid>\d+)\s+(?P<name>.+?)\s+'
+        u'\[(?P<datastore>[^\]]+)\]\s+(?P<vmx>.+?\.vmx)\s')
+    # Disk settings in a .vmx file
+    _vmx_disk_re = re.compile(u'^(?P<dev>(?:scsi|ide|sata|nvme)\d+\:\d+)'
+        u'\.fileName\s*\=\s*"(?P<file>[^"]+\.vmdk)"', re.M | re.I)
+    _vmx_mode_re = re.compile(u'^(?P<dev>(?:scsi|ide|sata|nvme)\d+\:\d+)'
+        u'\.mode\s*\=\s*"(?P<mode>[^"]+)"', re.M | re.I)
+    # Snapshot in `vim-cmd vmsvc/snapshot.get` output (nested snapshots
+    # get more leading dashes)
+    _snapshot_re = re.compile(u'^\-*Snapshot Name\s*\:\s*(?P<name>.*?)\s*\n'
+        u'\-*Snapshot Id\s*\:\s*(?P<id>\d+)', re.M)
+    # Flat extent in a VMDK descriptor
+    _descriptor_extent_re = re.compile(
+        u'^(?:RW|RDONLY)\s+\d+\s+(?:VMFS|FLAT)\s+"(?P<file>[^"]+)"', re.M)
+    # Backups with parallel disk streams are stored as one part archive
+    # per disk, all parts together making up the backup
     _backup_archive_re = re.compile(u'(?P<vmname>.+)\-'
-        '(?P<ts>\d{4}\-\d{2}\-\d{2}\_\d{2}\-\d{2}\-\d{2})\.tar\.gz')
+        '(?P<ts>\d{4}\-\d{2}\-\d{2}\_\d{2}\-\d{2}\-\d{2})'
+        '(?:\.part(?P<part>\d+)of(?P<parts>\d+))?'
+        '(?P<ext>\.tar\.(?:gz|xz|zst))$')
     _t = None
-    _chan = None
+    # Deadline of the currently running backup stage (see `_timed_stage`)
+    _deadline = None
+    # Seconds between deadline checks while waiting on remote commands
+    _poll_interval = 5
+    # Path of the local GNU tar, u'' if there is none, None if not looked
+    # up yet (see `_get_gnu_tar`)
+    _gnu_tar = None
     
     @classmethod
     def _get_current_time(cls):
@@ -72,8 +117,16 @@ class BackupProfile(object):
             f.write(out_string)
         return out_file_path
     
-    def __init__(self, profile_dict):
-        self.__dict__.update(profile_dict)
+    def __init__(self, profile):
+        """
+        `profile` is a compiled `profiles.Profile`, or a profile
+        dictionary that will be compiled (but not validated).
+        """
+        if not isinstance(profile, profiles.Profile):
+            profile = profiles.Profile(profile)
+        for key in profiles.Profile.__slots__:
+            if hasattr(profile, key):
+                setattr(self, key, getattr(profile, key))
     
     def __enter__(self):
         return self
@@ -84,62 +137,189 @@ class BackupProfile(object):
     def _get_ssh_transport(self):
         if self._t:
             return self._t
-        self._t = paramiko.Transport((self.host_ip, self.ssh_port))
+        sock = socket.create_connection((self.host_ip, self.ssh_port),
+                                        self.stall_timeout)
+        self._t = paramiko.Transport(sock)
         self._t.start_client()
         self._t.auth_password(self.ssh_user, self.ssh_password)
         return self._t
     
     def _close_ssh_transport(self):
-        self._close_ssh_session()
         if self._t:
             self._t.close()
             self._t = None
     
     def _get_ssh_session(self):
-        # if self._chan and not self._chan.closed:
-            # print 'pre', self._chan
-            # return self._chan
-        self._chan = self._get_ssh_transport().open_session()
-        self._chan.set_combine_stderr(True)
-        return self._chan
-    
-    def _close_ssh_session(self):
-        if self._chan:
-            self._chan.close()
-            self._chan = None
-    
-    def _run_ssh_command(self, cmd):
-        # Open an SSH session and execute the command
+        chan = self._get_ssh_transport().open_session()
+        chan.set_combine_stderr(True)
+        return chan
+    
+    def _exec_ssh(self, cmd):
+        "Executes `cmd` in a new SSH session, returning its combined output"
+        # Every command gets its own channel, so commands can run from
+        # parallel threads
         chan = self._get_ssh_session()
-        chan.exec_command('%s ; echo exit_code=$?' % (cmd))
-        stdout = ''
-        x = chan.recv(1024)
-        while x:
-            stdout += x
-            x = chan.recv(1024)
-        output = stdout.strip().split('\n')
-        exit_code = re.match('exit_code\=(\-?\d+)', output[-1]).group(1)
-        if not '0' == exit_code:
-            logger.debug(u'SSH command "%s" failed with output:\n%s' %
-                         (cmd, '\n'.join(output)))
-            raise RuntimeWarning(u'Remote command failed with code %s' %
-                                 (exit_code))
-        return '\n'.join(output[:-1])
+        try:
+            chan.settimeout(self._poll_interval)
+            chan.exec_command(cmd)
+            stdout = ''
+            while True:
+                try:
+                    x = chan.recv(1024)
+                except socket.timeout:
+                    self._check_deadline()
+                    continue
+                if not x:
+                    break
+                stdout += x
+                self._check_deadline()
+        finally:
+            chan.close()
+        return stdout
+    
+    @classmethod
+    def _build_batch_script(cls, cmds, marker, stop_on_error):
+        "Returns shell script running `cmds`, delimiting each with `marker`"
+        lines = list()
+        for i, cmd in enumerate(cmds):
+            lines.append(u'echo "%s-begin-%d"' % (marker, i))
+            lines.append(u'( %s ) 2>&1; rc=$?' % (cmd))
+            lines.append(u'echo "%s-end-%d exit_code=$rc"' % (marker, i))
+            if stop_on_error:
+                lines.append(u'[ $rc -eq 0 ] || exit 0')
+        return u'\n'.join(lines)
+    
+    @classmethod
+    def _parse_batch_output(cls, raw_output, marker, count):
+        """
+        Returns list of (exit code, output) per command of a batch script.
+        Commands that did not run get None exit code and output.
+        """
+        results = [(None, None)] * count
+        begin_re = re.compile(u'^%s\-begin\-(\d+)$' % (re.escape(marker)))
+        # Output that doesn't end with a newline precedes the end marker
+        end_re = re.compile(u'^(.*)%s\-end\-(\d+) exit_code\=(\-?\d+)$' %
+                            (re.escape(marker)))
+        current, output = None, list()
+        for line in raw_output.split(u'\n'):
+            line = line.rstrip(u'\r')
+            begin, end = begin_re.match(line), end_re.match(line)
+            if begin:
+                current, output = int(begin.group(1)), list()
+            elif end and current == int(end.group(2)):
+                if end.group(1):
+                    output.append(end.group(1))
+                results[current] = (int(end.group(3)), u'\n'.join(output))
+                current = None
+            elif current is not None:
+                output.append(line)
+        return results
+    
+    def _run_ssh_batch(self, cmds, stop_on_error=True):
+        """
+        Runs all `cmds` as one script in a single SSH session, returning
+        list of (exit code, output) per command.
+        If `stop_on_error`, commands after the first failure are skipped
+        (and get None exit code and output).
+        """
+        from uuid import uuid4
+        marker = u'esxitools-%s' % (uuid4().hex)
+        script = self._build_batch_script(cmds, marker, stop_on_error)
+        results = self._parse_batch_output(self._exec_ssh(script), marker,
+                                           len(cmds))
+        for cmd, (exit_code, output) in zip(cmds, results):
+            if exit_code:
+                logger.debug(u'SSH command "%s" failed with output:\n%s' %
+                             (cmd, output))
+        return results
+    
+    def _check_batch_results(self, results):
+        "Raises RuntimeWarning if any batch command failed or did not run"
+        for exit_code, _ in results:
+            if 0 != exit_code:
+                raise RuntimeWarning(u'Remote command failed with code %s' %
+                                     (exit_code))
+    
+    def _check_deadline(self):
+        if self._deadline:
+            self._deadline.check()
     
     def _get_vm_config(self, vmname, config):
-        vm_dict = self.backup_vms[vmname]
-        if config in vm_dict:
-            return vm_dict[config]
-        return self.default_vm_config[config]
+        return getattr(self.backup_vms[vmname], config)
     
-    def _list_backup_archives(self):
-        glob_str = os.path.join(self.backups_archive_dir, u'*.tar.gz')
-        return glob(glob_str)
+    def _get_corrupt_archives(self):
+        "Returns set of archive file names that failed verification"
+        manifest = integrity.load_manifest(self.backups_archive_dir)
+        return set(archive for archive, entry in manifest.iteritems()
+                   if entry[u'ok'] is False)
     
-    def _list_backup_archives_for_vm(self, vmname):
-        glob_str = os.path.join(self.backups_archive_dir,
-                                u'%s-*.tar.gz' % (vmname))
-        return glob(glob_str)
+    @classmethod
+    def _group_backups(cls, archive_paths):
+        """
+        Groups `archive_paths` by backup (see `_backup_archive_re`).
+        Returns list of (backup name, archive paths of the backup, True if
+        no part is missing), ordered by backup name (i.e. by timestamp).
+        """
+        groups = dict()
+        for archive_path in archive_paths:
+            _, archive = os.path.split(archive_path)
+            m = cls._backup_archive_re.match(archive)
+            if not m:
+                groups[archive] = ([archive_path], None, None)
+                continue
+            name = u'%s-%s' % (m.group(u'vmname'), m.group(u'ts'))
+            paths, parts, total = groups.setdefault(name,
+                                                    (list(), set(), None))
+            paths.append(archive_path)
+            if m.group(u'part') is not None:
+                parts.add(int(m.group(u'part')))
+                total = int(m.group(u'parts'))
+            groups[name] = (paths, parts, total)
+        return [(name, sorted(paths),
+                 total is None or parts == set(xrange(total)))
+                for name, (paths, parts, total) in sorted(groups.iteritems())]
+    
+    def _filter_archives(self, archive_paths, include_corrupt):
+        """
+        Returns `archive_paths` without the archives of backups with a
+        corrupt or missing part, unless `include_corrupt`
+        """
+        if include_corrupt:
+            return list(archive_paths)
+        corrupt = self._get_corrupt_archives()
+        valid = set()
+        for _, paths, complete in self._group_backups(archive_paths):
+            if complete and not any(os.path.split(path)[1] in corrupt
+                                    for path in paths):
+                valid.update(paths)
+        return [archive_path for archive_path in archive_paths
+                if archive_path in valid]
+    
+    def _list_cold_archives(self, pattern):
+        "Returns locations of offloaded archives with names like `pattern`"
+        if not self.cold_storage:
+            return list()
+        catalog = tiering.load_catalog(self.backups_archive_dir)
+        return [entry[u'location'] for archive, entry in catalog.iteritems()
+                if fnmatch(archive, pattern)]
+    
+    def _list_archives(self, pattern, include_corrupt, include_cold):
+        glob_str = os.path.join(self.backups_archive_dir, pattern)
+        # Skip partial (.part) archives
+        archive_paths = [archive_path for archive_path in glob(glob_str)
+                         if archive_path.endswith(
+                             compression.ARCHIVE_EXTENSIONS)]
+        if include_cold:
+            archive_paths.extend(self._list_cold_archives(pattern))
+        return self._filter_archives(archive_paths, include_corrupt)
+    
+    def _list_backup_archives(self, include_corrupt=False, include_cold=True):
+        return self._list_archives(u'*.tar.*', include_corrupt, include_cold)
+    
+    def _list_backup_archives_for_vm(self, vmname, include_corrupt=False,
+                                     include_cold=True):
+        return self._list_archives(u'%s-*.tar.*' % (vmname),
+                                   include_corrupt, include_cold)
     
     def get_latest_archives(self):
         """
@@ -150,9 +330,7 @@ class BackupProfile(object):
         res = dict()
         for archive_path in self._list_backup_archives():
             _, archive = os.path.split(archive_path)
-            m = re.match(u'(?P<vmname>.+)\-'
-                '(?P<ts>\d{4}\-\d{2}\-\d{2}\_\d{2}\-\d{2}\-\d{2})\.tar\.gz',
-                archive)
+            m = self._backup_archive_re.match(archive)
             if m:
                 vmname = m.groupdict()[u'vmname']
                 ts = datetime.datetime.strptime(m.groupdict()[u'ts'],
@@ -172,7 +350,6 @@ class BackupProfile(object):
                             (vmname))
             return False
         period = self._get_vm_config(vmname, u'period')
-        assert type(period) == datetime.timedelta
         return time_since_last_backup >= period
     
     def get_next_vm_to_backup(self):
@@ -203,11 +380,11 @@ class BackupProfile(object):
         scp = SCPClient(self._get_ssh_transport())
         scp.put(local_source, remote_destination)
     
-    def _set_remote_chmod(self, remote_file):
-        return self._run_ssh_command(u'chmod +x %s' % (remote_file))
-    
-    def _remove_remote_file(self, remote_file):
-        self._run_ssh_command('rm %s' % (remote_file))
+    def _remove_remote_files(self, remote_files):
+        "Removes all `remote_files` in one SSH session"
+        self._check_batch_results(self._run_ssh_batch(
+            [u'rm "%s"' % (remote_file) for remote_file in remote_files],
+            stop_on_error=False))
     
     def _remove_local_file(self, file):
         os.remove(file)
@@ -246,22 +423,29 @@ class BackupProfile(object):
     def _run_remote_backup(self, vmname):
         "Run ghettovcb script to backup the specified VM"
         # Generate ghettovcb script from template
+        vmdk_files = self._get_vm_config(vmname, u'vmdk_files')
+        if not isinstance(vmdk_files, basestring):
+            vmdk_files = u','.join(vmdk_files)
         local_script = self._apply_template(
             self.ghettovcb_script_template,
-            {u'RemoteBackupDir': self.remote_backup_dir}
+            {u'RemoteBackupDir': self.remote_backup_dir,
+             u'VmdkFilesToBackup': vmdk_files}
         )
-        # Upload ghettovcb script to host and make it executable
+        # Upload ghettovcb script to host
         remote_script = '/'.join((self.remote_workdir, 'ghettovcb.sh'))
         self._upload_file(local_script, remote_script)
-        self._set_remote_chmod(remote_script)
         # cleanup local temp
         self._remove_local_file(local_script)
-        # Run ghettovcb script for the requested vm-name
-        backup_cmd = '%s -m %s' % (remote_script, vmname)
-        cmd_result = self._run_ssh_command(backup_cmd)
-        self._remove_remote_file(remote_script)
+        # Make the script executable, run it for the requested vm-name and
+        # remove it, all in one SSH session (cleanup runs even on failure)
+        results = self._run_ssh_batch([
+            u'chmod +x %s' % (remote_script),
+            u'%s -m %s' % (remote_script, vmname),
+            u'rm %s' % (remote_script),
+        ], stop_on_error=False)
+        self._check_batch_results(results)
         # Parse the output and return the result
-        return self._parse_ghettovcb_output(cmd_result)
+        return self._parse_ghettovcb_output(results[1][1])
     
     def _archive_remote_backup(self, vmname, backup_dir):
         "Tar's and GZip's the backup dir, returning full path of the archive"
@@ -269,80 +453,1009 @@ class BackupProfile(object):
         remote_archive = u'%s.tar.gz' % (backup_dir)
         tar_cmd = u'cd "%s"; tar -cz -f "%s" "%s"' %    \
                     (remote_workdir, remote_archive, backup_dir)
-        tar_output = self._run_ssh_command(tar_cmd)
+        self._run_remote_tar(tar_cmd)
+        return '/'.join((remote_workdir, remote_archive))
+    
+    def _run_remote_tar(self, tar_cmd):
+        "Runs remote `tar_cmd`, raising RuntimeError if any file was missing"
+        results = self._run_ssh_batch([tar_cmd])
+        tar_output = results[0][1] or u''
         if self._no_such_file_or_dir_re.search(tar_output):
             raise RuntimeError(u'Tar command failed:\n%s' % (tar_output))
-        return '/'.join((remote_workdir, remote_archive))
+        self._check_batch_results(results)
+    
+    def _map_parallel(self, func, items, streams):
+        "Returns `func` applied to `items` by `streams` parallel threads"
+        pool = ThreadPool(streams)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+    
+    def _list_remote_backup_files(self, vmname, backup_dir):
+        "Returns list of (file name, size) in the remote `backup_dir`"
+        results = self._run_ssh_batch([u'ls -l "%s"' % (u'/'.join(
+            (self.remote_backup_dir, vmname, backup_dir)))])
+        self._check_batch_results(results)
+        files = list()
+        for line in results[0][1].split(u'\n'):
+            fields = line.split(None, 8)
+            if 9 == len(fields) and not fields[0].startswith(u'd'):
+                files.append((fields[8].strip(), int(fields[4])))
+        return files
+    
+    @classmethod
+    def _group_disk_files(cls, files):
+        """
+        Groups (file name, size) `files` into one list of file names per
+        disk, plus one for all other files, largest group first.
+        """
+        groups = dict()
+        for name, size in files:
+            m = cls._disk_file_re.match(name)
+            group = groups.setdefault(m.group(u'disk') if m else None,
+                                      [list(), 0])
+            group[0].append(name)
+            group[1] += size
+        return [sorted(names) for names, size in
+                sorted(groups.itervalues(), key=lambda g: g[1], reverse=True)]
+    
+    def _archive_remote_disks(self, vmname, backup_dir, streams):
+        """
+        Tar's and GZip's every disk of the backup dir into its own part
+        archive, `streams` disks at a time, returning full paths of the
+        part archives.
+        """
+        remote_workdir = u'/'.join((self.remote_backup_dir, vmname))
+        groups = self._group_disk_files(
+            self._list_remote_backup_files(vmname, backup_dir))
+        def archive_part(group):
+            i, names = group
+            if 1 == len(groups):
+                remote_part = u'%s.tar.gz' % (backup_dir)
+            else:
+                remote_part = u'%s.part%dof%d.tar.gz' % (backup_dir, i,
+                                                         len(groups))
+            tar_cmd = u'cd "%s"; tar -cz -f "%s" %s' % (
+                remote_workdir, remote_part,
+                u' '.join(u'"%s/%s"' % (backup_dir, name) for name in names))
+            self._run_remote_tar(tar_cmd)
+            return u'/'.join((remote_workdir, remote_part))
+        return self._map_parallel(archive_part, enumerate(groups), streams)
+    
+    def _get_staging_dir(self):
+        "Returns (creating if needed) local dir for partial downloads"
+        staging_dir = os.path.join(self.backups_archive_dir, u'.staging')
+        if not os.path.isdir(staging_dir):
+            os.mkdir(staging_dir)
+        return staging_dir
     
-    def _download_archive(self, remote_path):
+    def _download_disk_archives(self, remote_parts, streams):
         """
-        Downloads a remote file at `remote_path` via FTP to
-        `self.backups_archive_dir` using same file name,
+        Downloads part archives `remote_parts`, `streams` at a time, into
+        `self.backups_archive_dir`, returning the total time it took (in
+        seconds).
+        Parts are stored as they are (see `_backup_archive_re`), and only
+        moved into place once all of them are downloaded.
+        """
+        from time import time
+        ts = time()
+        staging_dir = self._get_staging_dir()
+        self._map_parallel(
+            lambda remote_part: self._download_archive(remote_part,
+                                                       staging_dir),
+            remote_parts, streams)
+        for remote_part in remote_parts:
+            _, part = os.path.split(remote_part)
+            os.rename(os.path.join(staging_dir, part),
+                      os.path.join(self.backups_archive_dir, part))
+        return time() - ts
+    
+    def _download_archive(self, remote_path, dest_dir=None):
+        """
+        Downloads a remote file at `remote_path` via FTP to `dest_dir`
+        (default `self.backups_archive_dir`) using same file name,
         returning the total time it took (in seconds).
         """
         from time import time
         ts  = time()
         _, remote_filename = os.path.split(remote_path)
-        dest_path = os.path.join(self.backups_archive_dir, remote_filename)
-        ftp = FTP(self.host_ip)
+        dest_path = os.path.join(dest_dir or self.backups_archive_dir,
+                                 remote_filename)
+        # Download under a temporary name, so partial archives are never
+        # listed (or verified) as backups
+        part_path = u'%s.part' % (dest_path)
+        ftp = FTP(self.host_ip, timeout=self.stall_timeout)
         ftp.login(self.ftp_user, self.ftp_password)
-        with open(dest_path, 'wb') as dest_file:
-            ftp.retrbinary(u'RETR %s' % (remote_path), dest_file.write)
+        monitor = watchdog.TransferMonitor(self._deadline, self.stall_timeout)
+        try:
+            with open(part_path, 'wb') as dest_file:
+                def write(data):
+                    dest_file.write(data)
+                    monitor.update(len(data))
+                try:
+                    ftp.retrbinary(u'RETR %s' % (remote_path), write)
+                except socket.timeout:
+                    monitor.stalled()
+        finally:
+            ftp.close()
+        os.rename(part_path, dest_path)
         return time() - ts
     
-    def backup_vm(self, vmname):
-        ghettovcb_output = self._run_remote_backup(vmname)
+    def _get_local_file_size(self, file):
+        return os.path.getsize(file)
+    
+    @contextmanager
+    def _timed_stage(self, run, stage, on_timeout=None):
+        """
+        Runs a backup `stage` under a watchdog deadline (from the `run`
+        timeouts, see `get_stage_timeouts`), recording its duration in the
+        `run` timings, even on error.
+        If the stage times out, `on_timeout` is called to clean up.
+        """
+        from time import time
+        timeout = run.get(u'timeouts', {}).get(stage, self.max_stage_timeout)
+        self._deadline = watchdog.Deadline(stage, timeout)
+        ts = time()
+        try:
+            yield
+        except watchdog.StageTimeout, ex:
+            logger.error(u'%s - cancelling' % (ex))
+            self._deadline = None
+            if on_timeout:
+                self._cancel_stage(on_timeout)
+            raise
+        finally:
+            self._deadline = None
+            run[u'timings'][stage] = time() - ts
+    
+    def _cancel_stage(self, cleanup):
+        """
+        Runs `cleanup` of a timed out (or failed) stage over a fresh SSH
+        connection, under a deadline, logging any error of the cleanup
+        """
+        self._close_ssh_transport()
+        self._deadline = watchdog.Deadline(u'cancel', self.stall_timeout)
+        try:
+            cleanup()
+        except Exception, ex:
+            logger.error(u'Cleanup of stage failed: %s' % (ex))
+        finally:
+            self._deadline = None
+    
+    def _cancel_remote_backup(self, vmname):
+        """
+        Kills a running ghettovcb backup of `vmname` (releasing its work
+        dir lock) and removes the backup snapshot of the VM, leaving any
+        other snapshot of the VM alone.
+        """
+        results = self._run_ssh_batch([
+            u'kill $(cat /tmp/ghettoVCB.work/pid)',
+            u'for pid in $(ps -c | grep vmkfstools | grep "/%s/" | '
+            u'grep -v grep | awk \'{print $1}\'); do kill $pid; done' %
+            (vmname),
+            u'rm -rf /tmp/ghettoVCB.work',
+            u'rm %s' % ('/'.join((self.remote_workdir, 'ghettovcb.sh'))),
+            u'vim-cmd vmsvc/getallvms',
+        ], stop_on_error=False)
+        self._check_batch_results(results[-1:])
+        vmid, _ = self._parse_remote_vm(results[-1][1], vmname)
+        self._remove_named_snapshots(vmid, u'ghettoVCB-snapshot-')
+        logger.info(u'Cancelled remote backup of VM "%s"' % (vmname))
+    
+    @classmethod
+    def _parse_snapshots(cls, raw_output):
+        "Returns list of (name, ID) of the snapshots in `snapshot.get` output"
+        return [(m.group(u'name'), m.group(u'id'))
+                for m in cls._snapshot_re.finditer(raw_output)]
+    
+    def _remove_named_snapshots(self, vmid, name_prefix, cmds=()):
+        """
+        Removes (consolidates) the snapshots of VM `vmid` whose names start
+        with `name_prefix`, returning list of the removed snapshot IDs.
+        Runs `cmds` in the same batch as the snapshot listing.
+        """
+        results = self._run_ssh_batch(
+            [u'vim-cmd vmsvc/snapshot.get %s' % (vmid)] + list(cmds),
+            stop_on_error=False)
+        self._check_batch_results(results)
+        snapshot_ids = [
+            snapshot_id for name, snapshot_id in
+            self._parse_snapshots(results[0][1])
+            if name.startswith(name_prefix)]
+        if snapshot_ids:
+            self._check_batch_results(self._run_ssh_batch(
+                [u'vim-cmd vmsvc/snapshot.remove %s %s' % (vmid, snapshot_id)
+                 for snapshot_id in snapshot_ids], stop_on_error=False))
+        return snapshot_ids
+    
+    def _cancel_remote_archive(self, vmname, backup_dir):
+        """
+        Kills running remote tar's of `backup_dir`, removing the archive
+        (or part archives)
+        """
+        remote_archives = u'/'.join((self.remote_backup_dir, vmname,
+                                     u'%s' % (backup_dir)))
+        self._run_ssh_batch([
+            u'for pid in $(ps -c | grep tar | grep "%s" | grep -v grep | '
+            u'awk \'{print $1}\'); do kill $pid; done' % (backup_dir),
+            u'rm -f "%s"*.tar.gz' % (remote_archives),
+        ], stop_on_error=False)
+        logger.info(u'Cancelled remote archiving of "%s"' % (backup_dir))
+    
+    def _cancel_download(self, remote_archives):
+        "Removes partial downloads and the remote archives"
+        staging_dir = os.path.join(self.backups_archive_dir, u'.staging')
+        for remote_archive in remote_archives:
+            _, archive = os.path.split(remote_archive)
+            for path in (
+                    os.path.join(self.backups_archive_dir,
+                                 u'%s.part' % (archive)),
+                    os.path.join(staging_dir, u'%s.part' % (archive)),
+                    os.path.join(staging_dir, archive)):
+                if os.path.isfile(path):
+                    self._remove_local_file(path)
+        self._run_ssh_batch([u'rm "%s"' % (remote_archive)
+                             for remote_archive in remote_archives],
+                            stop_on_error=False)
+        logger.info(u'Cancelled download of "%s"' % (
+            u'", "'.join(remote_archives)))
+    
+    def get_stage_timeouts(self, vmname):
+        "Returns {stage: timeout in seconds} derived from `vmname` history"
+        timeouts = dict()
+        with self.get_run_history() as run_history:
+            for stage in history.STAGES:
+                timeouts[stage] = watchdog.get_timeout(
+                    run_history.get_stage_percentile(vmname, stage, 95),
+                    self.stage_timeout_factor, self.min_stage_timeout,
+                    self.max_stage_timeout)
+        return timeouts
+    
+    def new_run(self, vmname):
+        "Returns a new run record for backing up `vmname`"
+        return {
+            u'profile': self.name,
+            u'vm': vmname,
+            u'host': self.host_ip,
+            u'started_at': self._get_current_time(),
+            u'outcome': u'error',
+            u'timings': dict(),
+            u'config': dict(),
+        }
+    
+    def backup_vm(self, vmname, run=None):
+        """
+        Backs up `vmname`, filling in the `run` record (see `new_run`)
+        with stage timings, ghettovcb output, archive size and outcome.
+        Returns the run record.
+        """
+        if run is None:
+            run = {u'timings': dict()}
+        if u'native' == self._get_vm_config(vmname, u'engine'):
+            return self._backup_vm_native(vmname, run)
+        with self._timed_stage(run, u'remote_backup',
+                lambda: self._cancel_remote_backup(vmname)):
+            ghettovcb_output = self._run_remote_backup(vmname)
+        run[u'config'] = ghettovcb_output
         logger.info(u'ghettovcb output:\n%s' % (
             u'\n'.join(
             [u'\t%s: %s' % (k,v)
              for k,v in ghettovcb_output.iteritems()])))
         if not ghettovcb_output[u'FINAL_STATUS']:
             # Something failed
-            return False
+            run[u'outcome'] = u'failed'
+            return run
         backup_name = ghettovcb_output[u'VM_BACKUP_DIR_NAMING_CONVENTION']
         backup_dir = u'%s-%s' % (vmname, backup_name)
-        remote_archive = self._archive_remote_backup(vmname, backup_dir)
-        download_time = self._download_archive(remote_archive)
+        archive = u'%s.tar.gz' % (backup_dir)
+        # Disks are archived and downloaded separately (in parallel)
+        # if there is more than one stream
+        streams = self._get_vm_config(vmname, u'parallel_disk_streams')
+        if self._get_vm_config(vmname, u'sparse_archive'):
+            return self._backup_sparse(vmname, backup_dir, archive, streams,
+                                       run)
+        with self._timed_stage(run, u'archive',
+                lambda: self._cancel_remote_archive(vmname, backup_dir)):
+            if 1 < streams:
+                remote_archives = self._archive_remote_disks(
+                    vmname, backup_dir, streams)
+            else:
+                remote_archives = [
+                    self._archive_remote_backup(vmname, backup_dir)]
+        with self._timed_stage(run, u'download',
+                lambda: self._cancel_download(remote_archives)):
+            if 1 < streams:
+                download_time = self._download_disk_archives(
+                    remote_archives, streams)
+            else:
+                download_time = self._download_archive(remote_archives[0])
+        archives = [os.path.split(remote_archive)[1]
+                    for remote_archive in remote_archives]
         logger.info(u'Backup archive "%s" downloaded to "%s" in %f seconds.' %
-                    (remote_archive, self.backups_archive_dir, download_time))
-        self._remove_remote_file(remote_archive)
+                    (u'", "'.join(archives), self.backups_archive_dir,
+                     download_time))
+        run[u'archive_bytes'] = sum(
+            self._get_local_file_size(os.path.join(self.backups_archive_dir,
+                                                   archive))
+            for archive in archives)
+        self._remove_remote_files(remote_archives)
         logger.info(u'Cleaned up archive from remote host')
+        run[u'outcome'] = u'ok'
+        return run
+    
+    def _download_sparse_backup(self, vmname, backup_dir, staging_dir,
+                                streams):
+        """
+        Streams the files of the remote `backup_dir` into `staging_dir`,
+        `streams` files at a time, skipping zero blocks (so thin disks are
+        written as sparse files).
+        Returns (total size, bytes transferred).
+        """
+        remote_dir = u'/'.join((self.remote_backup_dir, vmname, backup_dir))
+        files = sorted(self._list_remote_backup_files(vmname, backup_dir),
+                       key=lambda f: f[1], reverse=True)
+        self._upload_file(self.extent_stream_script,
+                          self._get_remote_extent_script())
+        try:
+            res = self._map_parallel(
+                lambda f: self._stream_remote_extents(
+                    u'/'.join((remote_dir, f[0])),
+                    os.path.join(staging_dir, f[0])),
+                files, streams)
+        finally:
+            self._remove_remote_files([self._get_remote_extent_script()])
+        return (sum(size for size, _ in res),
+                sum(transferred for _, transferred in res))
+    
+    def _backup_sparse(self, vmname, backup_dir, archive, streams, run):
+        """
+        Downloads the remote `backup_dir` as sparse files and archives it
+        locally as `archive`, instead of archiving it on the host (where
+        tar reads and compresses every zero of thin disks).
+        """
+        staging_dir = os.path.join(self._get_staging_dir(), backup_dir)
+        os.makedirs(staging_dir)
+        try:
+            with self._timed_stage(run, u'download',
+                    lambda: self._remove_remote_files(
+                        [self._get_remote_extent_script()])):
+                size, transferred = self._download_sparse_backup(
+                    vmname, backup_dir, staging_dir, streams)
+            logger.info(u'Backup dir "%s" streamed: %d of %d bytes non-zero' %
+                        (backup_dir, transferred, size))
+            with self._timed_stage(run, u'archive'):
+                self._archive_local_dir(
+                    staging_dir,
+                    os.path.join(self.backups_archive_dir, archive))
+        finally:
+            shutil.rmtree(staging_dir)
+        logger.info(u'Backup archive "%s" written to "%s"' %
+                    (archive, self.backups_archive_dir))
+        run[u'archive_bytes'] = self._get_local_file_size(
+            os.path.join(self.backups_archive_dir, archive))
+        run[u'outcome'] = u'ok'
+        return run
+    
+    def _get_remote_vm(self, vmname):
+        "Returns (VM ID, full path of the .vmx file) of `vmname` on host"
+        results = self._run_ssh_batch([u'vim-cmd vmsvc/getallvms'])
+        self._check_batch_results(results)
+        return self._parse_remote_vm(results[0][1], vmname)
+    
+    @classmethod
+    def _parse_remote_vm(cls, raw_output, vmname):
+        """
+        Returns (VM ID, full path of the .vmx file) of `vmname` in
+        `vim-cmd vmsvc/getallvms` output
+        """
+        for line in raw_output.split(u'\n'):
+            m = cls._getallvms_re.match(line)
+            if m and vmname == m.group(u'name'):
+                return m.group(u'vmid'), u'/vmfs/volumes/%s/%s' % (
+                    m.group(u'datastore'), m.group(u'vmx'))
+        raise RuntimeError(u'VM "%s" not found on host' % (vmname))
+    
+    @classmethod
+    def _parse_vmx_disks(cls, vmx):
+        """
+        Returns list of (device, VMDK descriptor file, mode) of the disks
+        in the `vmx` file contents.
+        """
+        modes = dict((m.group(u'dev').lower(), m.group(u'mode'))
+                     for m in cls._vmx_mode_re.finditer(vmx))
+        return [(m.group(u'dev'), m.group(u'file'),
+                 modes.get(m.group(u'dev').lower(), u'persistent'))
+                for m in cls._vmx_disk_re.finditer(vmx)]
+    
+    @classmethod
+    def _parse_descriptor_extents(cls, descriptor):
+        "Returns list of flat extent files in VMDK `descriptor` contents"
+        return [m.group(u'file')
+                for m in cls._descriptor_extent_re.finditer(descriptor)]
+    
+    def _get_remote_extent_script(self):
+        return u'/'.join((self.remote_workdir, u'extentstream.py'))
+    
+    def _stream_remote_extents(self, remote_path, local_path):
+        """
+        Streams the non-zero extents of `remote_path` into a sparse file
+        at `local_path`, returning (file size, bytes transferred).
+        """
+        chan = self._get_ssh_transport().open_session()
+        chan.settimeout(self._poll_interval)
+        chan.exec_command(u'python "%s" "%s"' %
+                          (self._get_remote_extent_script(), remote_path))
+        monitor = watchdog.TransferMonitor(self._deadline, self.stall_timeout)
+        def read(n):
+            data = list()
+            while n:
+                try:
+                    x = chan.recv(min(n, extents.WRITE_BUFFER_SIZE))
+                except socket.timeout:
+                    monitor.check()
+                    continue
+                if not x:
+                    raise extents.ExtentStreamError(
+                        u'Unexpected end of extent stream of "%s"' %
+                        (remote_path))
+                data.append(x)
+                n -= len(x)
+                monitor.update(len(x))
+            return b''.join(data)
+        try:
+            with open(local_path, 'wb') as local_file:
+                res = extents.read_extent_stream(read, local_file)
+            exit_code = chan.recv_exit_status()
+            if exit_code:
+                raise RuntimeError(u'Extent stream of "%s" failed (%d):\n%s' %
+                                   (remote_path, exit_code,
+                                    chan.recv_stderr(4096)))
+        finally:
+            chan.close()
+        return res
+    
+    @classmethod
+    def _get_gnu_tar(cls):
+        "Returns path of the local GNU tar (which keeps holes), or None"
+        if cls._gnu_tar is None:
+            cls._gnu_tar = u''
+            tar = find_executable(u'tar')
+            try:
+                if tar and u'GNU tar' in subprocess.check_output(
+                        [tar, u'--version']):
+                    cls._gnu_tar = tar
+            except (OSError, subprocess.CalledProcessError):
+                pass
+        return cls._gnu_tar or None
+    
+    def _run_local_tar(self, tar, src_dir, dest_path):
+        """
+        Archives `src_dir` into `dest_path` with GNU `tar`, compressing with
+        pigz (on every core) if installed, or gzip. Kills tar if the stage
+        deadline passes.
+        """
+        from time import sleep
+        parent_dir, name = os.path.split(src_dir)
+        pigz = find_executable(u'pigz')
+        args = [tar, u'--create', u'--sparse', u'--file', dest_path,
+                u'--use-compress-program=%s' % (pigz) if pigz else u'--gzip',
+                u'--directory', parent_dir, name]
+        with open(os.devnull, 'r+b') as devnull:
+            with TemporaryFile() as err_file:
+                proc = subprocess.Popen(args, stdin=devnull, stdout=devnull,
+                                        stderr=err_file,
+                                        close_fds=compat.CLOSE_FDS)
+                try:
+                    # Poll quickly at first, so small archives finish fast
+                    delay = 0.05
+                    while proc.poll() is None:
+                        self._check_deadline()
+                        sleep(delay)
+                        delay = min(delay * 2, self._poll_interval)
+                except:
+                    proc.kill()
+                    proc.wait()
+                    raise
+                if proc.returncode:
+                    err_file.seek(0)
+                    raise RuntimeError(u'Local tar of "%s" failed (%d):\n%s' %
+                                       (src_dir, proc.returncode,
+                                        err_file.read(4096)))
+    
+    def _archive_local_dir(self, src_dir, dest_path):
+        """
+        Tar's and GZip's `src_dir` (as its base name) into `dest_path`,
+        keeping the holes of sparse files with GNU tar. Without GNU tar,
+        falls back to tarfile, which stores holes as zeros.
+        """
+        tmp_path = u'%s.part' % (dest_path)
+        try:
+            tar = self._get_gnu_tar()
+            if tar:
+                self._run_local_tar(tar, src_dir, tmp_path)
+            else:
+                logger.warning(u'GNU tar not found - archiving "%s" without '
+                               u'sparse files' % (src_dir))
+                with open(tmp_path, 'wb') as tmp_file:
+                    tar = tarfile.open(
+                        mode='w:gz', compresslevel=6,
+                        fileobj=watchdog.DeadlineWriter(tmp_file,
+                                                        self._deadline))
+                    try:
+                        tar.add(src_dir,
+                                arcname=os.path.split(src_dir)[1])
+                    finally:
+                        tar.close()
+            os.rename(tmp_path, dest_path)
+        except:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def _remove_remote_snapshots(self, vmid):
+        """
+        Removes (consolidates) the backup snapshots of VM `vmid` and the
+        extent stream helper, leaving snapshots taken meanwhile alone.
+        """
+        snapshot_ids = self._remove_named_snapshots(
+            vmid, u'esxitools-',
+            [u'rm -f "%s"' % (self._get_remote_extent_script())])
+        if snapshot_ids:
+            logger.info(u'Removed backup snapshot of VM %s' % (vmid))
+    
+    def _prepare_native_backup(self, vmname, vmid, vmx_path, backup_name):
+        """
+        Snapshots `vmname` (VM `vmid`, with .vmx file `vmx_path`) for a
+        native backup, returning (.vmx contents, {descriptor path:
+        (contents, flat extent paths)}) of the disks to back up.
+        """
+        results = self._run_ssh_batch([
+            u'vim-cmd vmsvc/snapshot.get %s' % (vmid),
+            u'cat "%s"' % (vmx_path),
+        ])
+        self._check_batch_results(results)
+        if u'Snapshot Name' in results[0][1]:
+            raise RuntimeError(u'VM "%s" has snapshots - not backing up' %
+                               (vmname))
+        vmx = results[1][1]
+        vm_dir, _ = os.path.split(vmx_path)
+        vmdk_files = self._get_vm_config(vmname, u'vmdk_files')
+        descriptor_paths = list()
+        for dev, vmdk, mode in self._parse_vmx_disks(vmx):
+            if mode.startswith(u'independent'):
+                logger.warning(u'Skipping independent disk "%s" of VM "%s"' %
+                               (vmdk, vmname))
+                continue
+            if u'all' != vmdk_files and \
+                    not os.path.split(vmdk)[1] in vmdk_files:
+                continue
+            descriptor_paths.append(vmdk if vmdk.startswith(u'/') else
+                                    u'/'.join((vm_dir, vmdk)))
+        self._upload_file(self.extent_stream_script,
+                          self._get_remote_extent_script())
+        # The snapshot is created in the session reading the descriptors,
+        # freezing the disks they describe
+        results = self._run_ssh_batch(
+            [u'cat "%s"' % (path) for path in descriptor_paths] +
+            [u'vim-cmd vmsvc/snapshot.create %s "esxitools-%s" '
+             u'"esxitools backup snapshot" 0 0' % (vmid, backup_name)])
+        self._check_batch_results(results)
+        disks = dict()
+        for path, (_, descriptor) in zip(descriptor_paths, results):
+            disk_dir, _ = os.path.split(path)
+            flat_files = self._parse_descriptor_extents(descriptor)
+            if not flat_files:
+                raise RuntimeError(u'No flat extents in "%s"' % (path))
+            disks[path] = (descriptor, [u'/'.join((disk_dir, flat_file))
+                                        for flat_file in flat_files])
+        return vmx, disks
+    
+    def _backup_vm_native(self, vmname, run):
+        """
+        Backs up `vmname` by snapshotting it and streaming the (now
+        quiescent) base disks straight from the datastore, skipping zero
+        blocks, instead of cloning them with ghettovcb first.
+        Produces the same archive naming and layout as ghettovcb backups.
+        """
+        backup_name = self._get_current_time().strftime(u'%Y-%m-%d_%H-%M-%S')
+        backup_dir = u'%s-%s' % (vmname, backup_name)
+        archive = u'%s.tar.gz' % (backup_dir)
+        staging_dir = os.path.join(self._get_staging_dir(), backup_dir)
+        run[u'config'] = {u'ENGINE': u'native',
+                          u'VM_BACKUP_DIR_NAMING_CONVENTION': backup_name}
+        vmid = None
+        try:
+            # Timed out stages just drop the SSH connection, the snapshot
+            # is removed below either way - even if creating it failed or
+            # timed out, as it may have been created nevertheless
+            with self._timed_stage(run, u'remote_backup', lambda: None):
+                vmid, vmx_path = self._get_remote_vm(vmname)
+                vmx, disks = self._prepare_native_backup(
+                    vmname, vmid, vmx_path, backup_name)
+            os.makedirs(staging_dir)
+            with self._timed_stage(run, u'download', lambda: None):
+                with open(os.path.join(staging_dir,
+                        os.path.split(vmx_path)[1]), 'wb') as vmx_file:
+                    vmx_file.write(vmx.encode(u'utf-8'))
+                for descriptor_path, (descriptor, flat_paths) in \
+                        sorted(disks.iteritems()):
+                    with open(os.path.join(staging_dir,
+                            os.path.split(descriptor_path)[1]), 'wb') as f:
+                        f.write(descriptor.encode(u'utf-8'))
+                    for flat_path in flat_paths:
+                        size, transferred = self._stream_remote_extents(
+                            flat_path, os.path.join(
+                                staging_dir, os.path.split(flat_path)[1]))
+                        logger.info(u'Streamed "%s": %d of %d bytes '
+                                    u'non-zero' % (flat_path, transferred,
+                                                   size))
+                # Release the snapshot before the (local) archiving
+                self._remove_remote_snapshots(vmid)
+                vmid = None
+            with self._timed_stage(run, u'archive'):
+                self._archive_local_dir(
+                    staging_dir,
+                    os.path.join(self.backups_archive_dir, archive))
+        finally:
+            try:
+                # Never hangs on (or masks the error of) a wedged host
+                if vmid:
+                    self._cancel_stage(
+                        lambda: self._remove_remote_snapshots(vmid))
+            finally:
+                if os.path.isdir(staging_dir):
+                    shutil.rmtree(staging_dir)
+        run[u'config'][u'FINAL_STATUS'] = True
+        run[u'archive_bytes'] = self._get_local_file_size(
+            os.path.join(self.backups_archive_dir, archive))
+        logger.info(u'Backup archive "%s" written to "%s"' %
+                    (archive, self.backups_archive_dir))
+        run[u'outcome'] = u'ok'
+        return run
+    
+    def _get_cold_target(self):
+        return tiering.get_target(self.cold_storage, self.offload_streams)
+    
+    def _remove_archive(self, archive_path):
+        "Removes archive at `archive_path`, whether hot or offloaded"
+        _, archive = os.path.split(archive_path)
+        if not archive_path in self._list_cold_archives(archive):
+            # Offloading and recompressing move hot archives away under
+            # the catalog lock
+            with tiering.catalog_lock(self.backups_archive_dir):
+                try:
+                    self._remove_local_file(archive_path)
+                    return
+                except OSError, ex:
+                    if errno.ENOENT != ex.errno:
+                        raise
+            if not self._list_cold_archives(archive):
+                logger.warning(u'Archive "%s" was moved meanwhile - '
+                               u'not deleted' % (archive_path))
+                return
+            logger.info(u'Archive "%s" was offloaded meanwhile' %
+                        (archive_path))
+        tiering.remove_archive(self.backups_archive_dir,
+                               self._get_cold_target(), archive)
     
     def trim_backup_archives(self):
+        """
+        Deletes all but the newest `rotation_count` backups of every VM,
+        and all backups with an archive that failed verification or a
+        missing part (which do not count toward `rotation_count`) - except
+        the newest one of a VM without any other backup.
+        """
         for vmname in self.backup_vms.keys():
-            vm_archives = self._list_backup_archives_for_vm(vmname)
+            # Hot and cold archives live in different places, so backups
+            # are grouped and ordered by name (i.e. by timestamp)
+            backups = self._group_backups(
+                self._list_backup_archives_for_vm(vmname))
+            # By name, as archives may be offloaded between the listings
+            valid = set(name for name, _, _ in backups)
+            invalid = [(name, archive_paths) for name, archive_paths, _ in
+                       self._group_backups(self._list_backup_archives_for_vm(
+                           vmname, include_corrupt=True))
+                       if not name in valid]
+            if invalid and not backups:
+                name, _ = invalid.pop()
+                logger.warning(u'Keeping corrupt backup "%s" - the only '
+                               u'backup of VM "%s"' % (name, vmname))
+            for name, archive_paths in invalid:
+                for archive_to_delete in archive_paths:
+                    logger.info(u'Deleting corrupt archive "%s"' %
+                                (archive_to_delete))
+                    self._remove_archive(archive_to_delete)
             rot_count = self._get_vm_config(vmname, u'rotation_count')
-            for archive_to_delete in sorted(vm_archives)[:-rot_count]:
-                logger.info(u'Deleting archive "%s"' %
-                            (archive_to_delete))
-                self._remove_local_file(archive_to_delete)
+            for _, archive_paths, _ in backups[:-rot_count]:
+                for archive_to_delete in archive_paths:
+                    logger.info(u'Deleting archive "%s"' %
+                                (archive_to_delete))
+                    self._remove_archive(archive_to_delete)
+    
+    def offload_archives(self, processes=None):
+        """
+        Moves the archives of all but the newest `hot_archive_count`
+        backups of every VM to cold storage. Returns list of new archive
+        locations.
+        Offloaded archives are no longer verified, so archives are verified
+        first, and only those verified OK are offloaded.
+        """
+        if not self.cold_storage:
+            logger.info(u'No cold storage configured - Nothing to do.')
+            return list()
+        self.verify_archives(processes)
+        manifest = integrity.load_manifest(self.backups_archive_dir)
+        target = self._get_cold_target()
+        locations = list()
+        for vmname in self.backup_vms.keys():
+            hot_archives = set(self._list_backup_archives_for_vm(
+                vmname, include_corrupt=True, include_cold=False))
+            backups = self._group_backups(
+                self._list_backup_archives_for_vm(vmname))
+            archive_paths = [
+                archive_path
+                for _, paths, _ in backups[:-self.hot_archive_count]
+                for archive_path in paths if archive_path in hot_archives]
+            for archive_path in archive_paths:
+                _, archive = os.path.split(archive_path)
+                if not manifest.get(archive, {}).get(u'ok'):
+                    # Appeared (e.g. recompressed) since verified
+                    logger.info(u'Archive "%s" not verified yet - not '
+                                u'offloading' % (archive_path))
+                    continue
+                location = tiering.offload_archive(self.backups_archive_dir,
+                                                   target, archive_path)
+                if location:
+                    logger.info(u'Archive "%s" moved to "%s"' %
+                                (archive_path, location))
+                    locations.append(location)
+        return locations
+    
+    def verify_archives(self, processes=None):
+        """
+        Verifies new or changed archives in `backups_archive_dir`,
+        recording the results in the archive dir manifest.
+        Returns list of archive file names found corrupt.
+        """
+        verified = integrity.verify_archives(
+            self.backups_archive_dir,
+            self._list_backup_archives(include_corrupt=True,
+                                       include_cold=False),
+            processes)
+        corrupt = list()
+        for archive, entry in sorted(verified.iteritems()):
+            if entry[u'ok']:
+                logger.info(u'Archive "%s" verified OK (sha256 %s)' %
+                            (archive, entry[u'sha256']))
+            elif entry[u'ok'] is None:
+                logger.warning(u'Archive "%s" could not be read - verifying '
+                               u'it again next time: %s' %
+                               (archive, entry[u'error']))
+            else:
+                logger.error(u'Archive "%s" is corrupt: %s' %
+                             (archive, entry[u'error']))
+                corrupt.append(archive)
+        return corrupt
+    
+    def recompress_archives(self, processes=None):
+        """
+        Recompresses the downloaded (gzip) archives in `backups_archive_dir`
+        to `recompress_format`, one archive per process.
+        Returns list of the new archive paths.
+        """
+        if not self.recompress_format:
+            logger.info(u'No recompression format configured - '
+                        u'Nothing to do.')
+            return list()
+        archive_paths = [
+            archive_path
+            for archive_path in self._list_backup_archives(include_cold=False)
+            if u'gz' == compression.get_format(archive_path)]
+        new_paths = list()
+        for archive_path, res, error in sorted(compression.recompress_archives(
+                self.backups_archive_dir, archive_paths,
+                self.recompress_format, self.recompress_level,
+                processes or self.recompress_processes)):
+            if error:
+                logger.error(u'Recompressing "%s" failed: %s' %
+                             (archive_path, error))
+            elif res:
+                new_path, src_size, new_size = res
+                logger.info(u'Archive "%s" recompressed to "%s" '
+                            u'(%d -> %d bytes)' % (archive_path, new_path,
+                                                   src_size, new_size))
+                new_paths.append(new_path)
+        return new_paths
+    
+    def _get_notify_sinks(self):
+        "Returns {name: sink config} of the notification sinks"
+        if self.notify_sinks is not None:
+            return self.notify_sinks
+        if not self.email_report:
+            return dict()
+        return {
+            u'email': {
+                u'type': u'smtp', u'host': u'smtp.gmail.com', u'port': 587,
+                u'user': self.gmail_user, u'password': self.gmail_pwd,
+                u'from': self.from_field, u'recipients': self.recipients,
+            },
+        }
+    
+    def get_notifier(self):
+        "Returns a notifier spooling to the configured sinks"
+        spool_dir = self.notify_spool_dir or \
+                    os.path.join(self.backups_archive_dir, u'.notify-spool')
+        return notify.Notifier(spool_dir, dict(
+            (name, notify.get_sink(config))
+            for name, config in self._get_notify_sinks().iteritems()))
+    
+    def _log_notify_errors(self, errors):
+        for sink_name, error in sorted(errors.iteritems()):
+            if error:
+                logger.error(u'Notification sink "%s" failed (notifications '
+                             u'stay spooled): %s' % (sink_name, error))
+    
+    def flush_notifications(self):
+        "Delivers all spooled notifications"
+        self._log_notify_errors(self.get_notifier().flush())
+    
+    def _get_history_db_path(self):
+        if self.history_db:
+            return self.history_db
+        return os.path.join(self.backups_archive_dir,
+                            u'.esxitools-history.sqlite')
+    
+    def get_run_history(self):
+        return history.RunHistory(self._get_history_db_path())
+    
+    def record_run(self, run):
+        "Persists `run` to the history database, logging any failure"
+        run[u'total_time'] = (self._get_current_time() -
+                              run[u'started_at']).total_seconds()
+        try:
+            with self.get_run_history() as run_history:
+                run_history.record_run(run)
+        except Exception, ex:
+            logger.error(u'Failed recording run history: %s' % (ex))
 
-def backup(**kwargs):
-    # Avoid multiple instances of backup program
-    me = singleton.SingleInstance(flavor_id=u'esxi-backup')
-    # Obtain profile configuration
+def _get_profile(kwargs):
+    """
+    Returns (name, compiled profile) of the profile requested in `kwargs`,
+    loading profiles from the `config` file if specified, else settings.
+    """
     if not u'profile_name' in kwargs:
         raise RuntimeError(u'Missing profile_name argument')
     profile_name = kwargs[u'profile_name']
-    if not profile_name in settings.ESXI_BACKUP_PROFILES:
+    all_profiles = profiles.load_profiles(kwargs.get(u'config'))
+    if not profile_name in all_profiles:
         raise RuntimeError(u'No such profile "%s"' % profile_name)
-    profile = settings.ESXI_BACKUP_PROFILES[profile_name]
+    return profile_name, all_profiles[profile_name]
+
+def verify(**kwargs):
+    # Avoid multiple instances of verify program
+    me = singleton.SingleInstance(flavor_id=u'esxi-verify')
+    profile_name, profile = _get_profile(kwargs)
+    logger.info(u'Verifying archives of profile "%s"' % (profile_name))
+    with BackupProfile(profile) as bp:
+        with _notifications(bp, kwargs) as notifier:
+            corrupt = bp.verify_archives(kwargs.get(u'processes'))
+            if corrupt and notifier.sinks:
+                notifier.enqueue(
+                    u'CORRUPT ARCHIVES %s' % (u', '.join(corrupt)),
+                    log_stream.getvalue())
+    return True
+
+def offload(**kwargs):
+    # Avoid multiple instances of offload program
+    me = singleton.SingleInstance(flavor_id=u'esxi-offload')
+    profile_name, profile = _get_profile(kwargs)
+    logger.info(u'Offloading archives of profile "%s"' % (profile_name))
+    with BackupProfile(profile) as bp:
+        bp.offload_archives(kwargs.get(u'processes'))
+    return True
+
+def recompress(**kwargs):
+    # Avoid multiple instances of recompress program
+    me = singleton.SingleInstance(flavor_id=u'esxi-recompress')
+    profile_name, profile = _get_profile(kwargs)
+    logger.info(u'Recompressing archives of profile "%s"' % (profile_name))
+    with BackupProfile(profile) as bp:
+        bp.recompress_archives(kwargs.get(u'processes'))
+    return True
+
+def _start_detached(kwargs, command, log_dir):
+    """
+    Starts esxitools `command` of the profile in `kwargs` as a detached
+    process, so it never holds up backups. Its output is appended to
+    `.esxitools-<command>.log` in `log_dir`.
+    """
+    args = [sys.executable, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), u'esxitools.py')]
+    if kwargs.get(u'config'):
+        args.extend([u'-c', kwargs[u'config']])
+    args.extend([command, kwargs[u'profile_name']])
+    log_path = os.path.join(log_dir, u'.esxitools-%s.log' % (command))
+    with open(os.devnull, 'rb') as devnull, open(log_path, 'ab') as log_file:
+        log_file.write((u'=== %s %s %s ===\n' % (
+            datetime.datetime.now().strftime(u'%Y-%m-%d %H:%M:%S'), command,
+            kwargs[u'profile_name'])).encode(u'utf-8'))
+        log_file.flush()
+        subprocess.Popen(args, stdin=devnull, stdout=log_file,
+                         stderr=log_file, close_fds=compat.CLOSE_FDS)
+    logger.info(u'Started background "%s" (logging to "%s")' %
+                (command, log_path))
+
+@contextmanager
+def _notifications(bp, kwargs):
+    """
+    Yields the notifier of `bp`, starting a detached `notify` of the
+    profile in `kwargs` on exit if anything is spooled, so delivery never
+    holds up the command (or its single instance lock)
+    """
+    notifier = bp.get_notifier()
+    try:
+        yield notifier
+    finally:
+        if any(notifier.pending(sink_name) for sink_name in notifier.sinks):
+            _start_detached(kwargs, u'notify', notifier.spool_dir)
+
+def backup(**kwargs):
+    # Avoid multiple instances of backup program
+    me = singleton.SingleInstance(flavor_id=u'esxi-backup')
+    # Obtain profile configuration
+    profile_name, profile = _get_profile(kwargs)
     logger.info(u'Running backup profile "%s"' % (profile_name))
     # Check if profile is currently active
     t = get_current_time()
-    if not is_time_in_window(t, profile['backup_times']):
+    if not is_time_in_window(t, profile.backup_times):
         logger.debug(u'Out of time range. Skipping backup run for profile.')
         return True
-    with BackupProfile(profile) as bp:
+    with BackupProfile(profile) as bp, _notifications(bp, kwargs) as notifier:
         next_vm = bp.get_next_vm_to_backup()
         if next_vm:
             logger.info(u'Running backup for VM "%s"' % (next_vm))
-            bp.backup_vm(next_vm)
+            run = bp.new_run(next_vm)
+            run[u'timeouts'] = bp.get_stage_timeouts(next_vm)
+            logger.debug(u'Stage timeouts: %s' % (run[u'timeouts']))
+            try:
+                bp.backup_vm(next_vm, run)
+            except Exception, ex:
+                run[u'error'] = u'%s' % (ex)
+                logger.error(u'Backup of VM "%s" failed: %s' % (next_vm, ex))
+                if notifier.sinks:
+                    notifier.enqueue(u'BACKUP FAILED %s' % (next_vm),
+                                     log_stream.getvalue())
+                raise
+            finally:
+                bp.record_run(run)
             bp.trim_backup_archives()
-            if bp.email_report:
-                utils.send_email(
-                    bp.gmail_user, bp.gmail_pwd, bp.from_field, bp.recipients,
-                    u'BACKUP OK %s' % (next_vm), log_stream.getvalue())
+            if bp.recompress_format and u'ok' == run[u'outcome']:
+                _start_detached(kwargs, u'recompress',
+                                bp.backups_archive_dir)
+            if notifier.sinks:
+                notifier.enqueue(
+                    u'BACKUP %s %s' % (
+                        u'OK' if u'ok' == run[u'outcome'] else u'FAILED',
+                        next_vm),
+                    log_stream.getvalue())
         else:
             logger.info(u'No next VM to backup - Nothing to do.')
     return True
+
+def flush_notifications(**kwargs):
+    profile_name, profile = _get_profile(kwargs)
+    logger.info(u'Delivering notifications of profile "%s"' % (profile_name))
+    with BackupProfile(profile) as bp:
+        bp.flush_notifications()
+    return True
+
+def report(**kwargs):
+    profile_name, profile = _get_profile(kwargs)
+    days = kwargs.get(u'days') or 90
+    with BackupProfile(profile) as bp:
+        since = bp._get_current_time() - datetime.timedelta(days)
+        with bp.get_run_history() as run_history:
+            print history.format_report(run_history, since)
+    return True
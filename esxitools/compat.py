@@ -0,0 +1,48 @@
+"""
+Differences between POSIX and Windows platforms.
+"""
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Python 2 on Windows cannot close inherited handles while redirecting
+# the standard streams of a child process
+CLOSE_FDS = os.name != 'nt'
+
+def _lock(lock_file):
+    if fcntl:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+    # Byte-range lock of the first byte - LK_LOCK gives up after 10 tries
+    lock_file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except IOError:
+            pass
+
+def _unlock(lock_file):
+    if fcntl:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+    lock_file.seek(0)
+    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on the lock file at `path` (created if
+    missing), serializing updates between processes
+    """
+    with open(path, 'a') as lock_file:
+        _lock(lock_file)
+        try:
+            yield
+        finally:
+            _unlock(lock_file)
@@ -0,0 +1,213 @@
+"""
+Archive formats and local recompression.
+
+The host can only produce (single-threaded) gzip archives, so downloaded
+`.tar.gz` archives can be recompressed locally into a denser format -
+xz (needs backports.lzma on Python 2) or zstd (needs zstandard) - sharing
+the CPU cores between parallel archives and the threads of the codec.
+"""
+import os
+import gzip
+import subprocess
+from multiprocessing import Pool, cpu_count
+from distutils.spawn import find_executable
+
+import tiering
+import compat
+
+# Backup archive extension by format
+EXTENSIONS = {
+    u'gz':          u'.tar.gz',
+    u'xz':          u'.tar.xz',
+    u'zst':         u'.tar.zst',
+}
+ARCHIVE_EXTENSIONS = tuple(sorted(EXTENSIONS.itervalues()))
+# Default compression level by format
+DEFAULT_LEVELS = {
+    u'xz':          6,
+    u'zst':         12,
+}
+CHUNK_SIZE = 1024 * 1024
+# Long zstd window (128MB, the largest any zstd decoder accepts by default)
+ZSTD_WINDOW_LOG = 27
+
+def get_format(archive_path):
+    "Returns the format of `archive_path` by extension, or None"
+    for fmt, ext in EXTENSIONS.iteritems():
+        if archive_path.endswith(ext):
+            return fmt
+    return None
+
+def _import_lzma():
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise RuntimeError(u'xz archives require backports.lzma')
+    return lzma
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(u'zstd archives require zstandard')
+    return zstandard
+
+def open_reader(fmt, raw_file):
+    """
+    Returns a file-like object reading the decompressed tar stream of
+    `raw_file` in (non-gzip) format `fmt`, validating its checksums.
+    """
+    if u'xz' == fmt:
+        return _import_lzma().LZMAFile(raw_file)
+    if u'zst' == fmt:
+        return _import_zstandard().ZstdDecompressor().stream_reader(raw_file)
+    raise ValueError(u'No reader for format "%s"' % (fmt))
+
+def _check_format(fmt):
+    "Raises RuntimeError if archives in `fmt` cannot be written and read"
+    if u'xz' == fmt:
+        _import_lzma()
+    elif u'zst' == fmt:
+        _import_zstandard()
+    else:
+        raise ValueError(u'Cannot recompress to format "%s"' % (fmt))
+
+class _XzProcess(object):
+    """
+    Compressor (see `_get_compressor`) piping into the xz tool, which
+    (unlike the lzma module) compresses with multiple threads, writing
+    straight to `dest_file`
+    """
+    def __init__(self, xz, level, threads, dest_file):
+        self._proc = subprocess.Popen(
+            [xz, u'-%d' % (level), u'--threads=%d' % (threads or 0),
+             u'--check=crc64', u'--stdout'],
+            stdin=subprocess.PIPE, stdout=dest_file,
+            close_fds=compat.CLOSE_FDS)
+
+    def compress(self, data):
+        self._proc.stdin.write(data)
+        return b''
+
+    def flush(self):
+        self._proc.stdin.close()
+        if self._proc.wait():
+            raise RuntimeError(u'xz failed with code %d' %
+                               (self._proc.returncode))
+        return b''
+
+    def abort(self):
+        if self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+
+def _get_compressor(fmt, level, threads, dest_file):
+    """
+    Returns a compressor object (with compress and flush) for `fmt` that
+    uses `threads` threads (all CPUs if None), and may write compressed
+    data to `dest_file` itself.
+    Without the xz tool, xz archives are compressed in a single thread.
+    """
+    if u'xz' == fmt:
+        xz = find_executable(u'xz')
+        if xz:
+            return _XzProcess(xz, level, threads, dest_file)
+        lzma = _import_lzma()
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ,
+                                   check=lzma.CHECK_CRC64, preset=level)
+    if u'zst' == fmt:
+        zstandard = _import_zstandard()
+        params = zstandard.ZstdCompressionParameters.from_level(
+            level, window_log=ZSTD_WINDOW_LOG, enable_ldm=1,
+            write_checksum=1, threads=threads or -1)
+        return zstandard.ZstdCompressor(
+            compression_params=params).compressobj()
+    raise ValueError(u'Cannot recompress to format "%s"' % (fmt))
+
+def recompress_archive(archive_dir, archive_path, fmt, level=None,
+                       threads=None):
+    """
+    Recompresses `.tar.gz` archive `archive_path` to format `fmt` with
+    `threads` codec threads (all CPUs if None), streaming into a temporary
+    file that atomically replaces the original.
+    Returns (new archive path, original size, new size), or None if the
+    original was removed (e.g. trimmed or offloaded) meanwhile.
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[fmt]
+    dest_path = u'%s%s' % (archive_path[:-len(EXTENSIONS[u'gz'])],
+                           EXTENSIONS[fmt])
+    part_path = u'%s.part' % (dest_path)
+    try:
+        # GzipFile validates the CRC of the original on the last read
+        src_file = gzip.GzipFile(archive_path, 'rb')
+        try:
+            with open(part_path, 'wb') as dest_file:
+                compressor = _get_compressor(fmt, level, threads, dest_file)
+                try:
+                    while True:
+                        data = src_file.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        dest_file.write(compressor.compress(data))
+                    dest_file.write(compressor.flush())
+                except:
+                    if hasattr(compressor, u'abort'):
+                        compressor.abort()
+                    raise
+                dest_file.flush()
+                os.fsync(dest_file.fileno())
+        finally:
+            src_file.close()
+        # Swap under the catalog lock, so offloading never copies an
+        # archive that no longer exists (see `tiering.offload_archive`)
+        with tiering.catalog_lock(archive_dir):
+            if not os.path.isfile(archive_path):
+                os.remove(part_path)
+                return None
+            src_size = os.path.getsize(archive_path)
+            os.rename(part_path, dest_path)
+            os.remove(archive_path)
+    except:
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+        raise
+    return dest_path, src_size, os.path.getsize(dest_path)
+
+def _recompress_archive_job(args):
+    archive_dir, archive_path, fmt, level, threads = args
+    try:
+        return archive_path, recompress_archive(archive_dir, archive_path,
+                                                fmt, level, threads), None
+    except Exception, ex:
+        return archive_path, None, u'%s' % (ex)
+
+def recompress_archives(archive_dir, archive_paths, fmt, level=None,
+                        processes=None):
+    """
+    Recompresses `.tar.gz` archives in `archive_paths` to format `fmt`
+    using a pool of up to `processes` worker processes (defaults to the
+    number of CPUs), each compressing with its share of the CPUs as codec
+    threads - so a single archive still uses every CPU.
+    Returns list of (archive path, `recompress_archive` result or None,
+    error message or None).
+    """
+    # Fail early on a missing compression module
+    _check_format(fmt)
+    archive_paths = [archive_path for archive_path in archive_paths
+                     if u'gz' == get_format(archive_path)]
+    if not archive_paths:
+        return list()
+    processes = min(processes or cpu_count(), len(archive_paths))
+    threads = max(cpu_count() // processes, 1)
+    jobs = [(archive_dir, archive_path, fmt, level, threads)
+            for archive_path in archive_paths]
+    pool = Pool(processes)
+    try:
+        return list(pool.imap_unordered(_recompress_archive_job, jobs))
+    finally:
+        pool.close()
+        pool.join()
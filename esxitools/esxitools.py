@@ -1,13 +1,66 @@
-from backup import backup
+from backup import backup, verify, report, offload, flush_notifications, \
+    recompress
+from simulate import simulate
 
 if '__main__' == __name__:
     import argparse
     parser = argparse.ArgumentParser(description='ESXi Remote Backup Tool')
+    parser.add_argument('-c', '--config', default=None,
+                        help='JSON/YAML profiles file (default: settings.py)')
     subparsers = parser.add_subparsers()
     backup_parser = subparsers.add_parser('backup',
                                           help='Run a backup profile')
     backup_parser.add_argument('profile_name', help='Profile name to run')
     backup_parser.set_defaults(func=backup)
+    verify_parser = subparsers.add_parser('verify',
+                                          help='Verify archives of a profile')
+    verify_parser.add_argument('profile_name', help='Profile name to verify')
+    verify_parser.add_argument('-j', '--processes', type=int, default=None,
+                               help='Number of verification processes')
+    verify_parser.set_defaults(func=verify)
+    report_parser = subparsers.add_parser('report',
+                                          help='Report backup run history')
+    report_parser.add_argument('profile_name', help='Profile name to report')
+    report_parser.add_argument('-d', '--days', type=int, default=90,
+                               help='Report on the last DAYS days')
+    report_parser.set_defaults(func=report)
+    offload_parser = subparsers.add_parser(
+        'offload', help='Move older archives of a profile to cold storage')
+    offload_parser.add_argument('profile_name', help='Profile name to offload')
+    offload_parser.add_argument('-j', '--processes', type=int, default=None,
+                                help='Number of verification processes')
+    offload_parser.set_defaults(func=offload)
+    notify_parser = subparsers.add_parser(
+        'notify', help='Deliver spooled notifications of a profile')
+    notify_parser.add_argument('profile_name', help='Profile name to notify')
+    notify_parser.set_defaults(func=flush_notifications)
+    recompress_parser = subparsers.add_parser(
+        'recompress', help='Recompress downloaded archives of a profile')
+    recompress_parser.add_argument('profile_name',
+                                   help='Profile name to recompress')
+    recompress_parser.add_argument('-j', '--processes', type=int,
+                                   default=None,
+                                   help='Number of recompression processes')
+    recompress_parser.set_defaults(func=recompress)
+    simulate_parser = subparsers.add_parser(
+        'simulate', help='Simulate backup scheduling of a profile')
+    simulate_parser.add_argument('profile_name',
+                                 help='Profile name to simulate')
+    simulate_parser.add_argument('-d', '--days', type=int, default=28,
+                                 help='Simulate DAYS days ahead')
+    simulate_parser.add_argument('-t', '--tick', type=int, default=15,
+                                 help='Minutes between backup runs (cron)')
+    simulate_parser.add_argument('--history-days', type=int, default=90,
+                                 help='Use run durations of the last '
+                                      'HISTORY_DAYS days')
+    simulate_parser.add_argument('--default-duration', type=int, default=60,
+                                 help='Minutes per run of VMs with no history')
+    simulate_parser.add_argument('--duration-factor', type=float,
+                                 default=1.0,
+                                 help='Scale all run durations by a factor')
+    simulate_parser.add_argument('--empty', action='store_true',
+                                 help='Start with no archives')
+    simulate_parser.set_defaults(func=simulate)
     args = parser.parse_args()
     try:
         args.func(**vars(args))
@@ -0,0 +1,38 @@
+"""
+Local side of the extent streams produced by vmware/extentstream.py,
+which skip the all-zero blocks of (thin provisioned) disk files.
+"""
+import struct
+
+MAGIC = b'ESXTENT1'
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+class ExtentStreamError(RuntimeError):
+    pass
+
+def read_extent_stream(read, dest_file):
+    """
+    Reads an extent stream with `read(n)` (returning exactly `n` bytes)
+    and writes it to `dest_file` as a sparse file, leaving holes where
+    the source had zeros.
+    Returns (file size, number of data bytes received).
+    """
+    header = read(len(MAGIC) + 8)
+    if not header.startswith(MAGIC):
+        raise ExtentStreamError(u'Bad extent stream header')
+    size, = struct.unpack('>Q', header[len(MAGIC):])
+    dest_file.truncate(size)
+    received = 0
+    while True:
+        offset, length = struct.unpack('>QQ', read(16))
+        if not length:
+            break
+        if offset + length > size:
+            raise ExtentStreamError(u'Extent beyond end of file')
+        dest_file.seek(offset)
+        while length:
+            data = read(min(length, WRITE_BUFFER_SIZE))
+            dest_file.write(data)
+            length -= len(data)
+            received += len(data)
+    return size, received
@@ -0,0 +1,198 @@
+"""
+Historical record of backup runs, kept in a local SQLite database.
+"""
+import json
+import math
+import sqlite3
+import datetime
+
+STAGES = (u'remote_backup', u'archive', u'download')
+
+_schema = u"""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    profile TEXT,
+    vm TEXT NOT NULL,
+    host TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    remote_backup_time REAL,
+    archive_time REAL,
+    download_time REAL,
+    total_time REAL,
+    archive_bytes INTEGER,
+    warnings TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_vm_outcome_total
+    ON runs (vm, outcome, total_time);
+CREATE INDEX IF NOT EXISTS runs_started_at ON runs (started_at);
+CREATE TABLE IF NOT EXISTS run_config (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (run_id, key)
+);
+"""
+
+def _format_ts(ts):
+    return ts.strftime('%Y-%m-%d %H:%M:%S')
+
+class RunHistory(object):
+    def __init__(self, db_path):
+        self._db = sqlite3.connect(db_path)
+        self._db.executescript(_schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def record_run(self, run):
+        """
+        Persists a `run` dictionary, as filled by `BackupProfile.backup_vm`,
+        returning the new run ID.
+        """
+        timings = run.get(u'timings', {})
+        config = dict(run.get(u'config', {}))
+        warnings = config.pop(u'WARNINGS', [])
+        with self._db:
+            cur = self._db.execute(
+                u'INSERT INTO runs (profile, vm, host, started_at, outcome, '
+                u'remote_backup_time, archive_time, download_time, '
+                u'total_time, archive_bytes, warnings, error) '
+                u'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run.get(u'profile'), run[u'vm'], run[u'host'],
+                 _format_ts(run[u'started_at']), run[u'outcome'],
+                 timings.get(u'remote_backup'), timings.get(u'archive'),
+                 timings.get(u'download'), run.get(u'total_time'),
+                 run.get(u'archive_bytes'), json.dumps(warnings),
+                 run.get(u'error')))
+            run_id = cur.lastrowid
+            self._db.executemany(
+                u'INSERT INTO run_config (run_id, key, value) '
+                u'VALUES (?, ?, ?)',
+                [(run_id, key, u'%s' % (value))
+                 for key, value in config.iteritems()])
+        return run_id
+
+    def get_duration_percentiles(self, since, percentiles=(50, 90, 95)):
+        """
+        Returns dictionary of {VM: {percentile: total duration}} over
+        successful runs started after `since` (nearest-rank percentiles).
+        """
+        since = _format_ts(since)
+        counts = self._db.execute(
+            u'SELECT vm, COUNT(*) FROM runs '
+            u'WHERE outcome = ? AND started_at >= ? '
+            u'AND total_time IS NOT NULL GROUP BY vm', (u'ok', since))
+        res = dict()
+        for vm, count in counts.fetchall():
+            res[vm] = dict()
+            for p in percentiles:
+                offset = max(int(math.ceil(p / 100.0 * count)) - 1, 0)
+                row = self._db.execute(
+                    u'SELECT total_time FROM runs '
+                    u'WHERE vm = ? AND outcome = ? AND started_at >= ? '
+                    u'AND total_time IS NOT NULL '
+                    u'ORDER BY total_time LIMIT 1 OFFSET ?',
+                    (vm, u'ok', since, offset)).fetchone()
+                res[vm][p] = row[0]
+        return res
+
+    def get_stage_percentile(self, vm, stage, percentile):
+        """
+        Returns the `percentile` duration of `stage` (one of STAGES) over
+        successful runs of `vm`, or None if there are no such runs.
+        """
+        if not stage in STAGES:
+            raise ValueError(u'No such stage "%s"' % (stage))
+        column = u'%s_time' % (stage)
+        count = self._db.execute(
+            u'SELECT COUNT(*) FROM runs WHERE vm = ? AND outcome = ? '
+            u'AND %s IS NOT NULL' % (column), (vm, u'ok')).fetchone()[0]
+        if not count:
+            return None
+        offset = max(int(math.ceil(percentile / 100.0 * count)) - 1, 0)
+        return self._db.execute(
+            u'SELECT %s FROM runs WHERE vm = ? AND outcome = ? '
+            u'AND %s IS NOT NULL ORDER BY %s LIMIT 1 OFFSET ?' %
+            (column, column, column), (vm, u'ok', offset)).fetchone()[0]
+
+    def get_monthly_trends(self, since):
+        """
+        Returns list of (VM, month, runs, average duration, total bytes)
+        tuples for successful runs started after `since`,
+        ordered by VM and month.
+        """
+        return self._db.execute(
+            u"SELECT vm, strftime('%Y-%m', started_at) AS month, COUNT(*), "
+            u'AVG(total_time), SUM(archive_bytes) FROM runs '
+            u'WHERE outcome = ? AND started_at >= ? '
+            u'GROUP BY vm, month ORDER BY vm, month',
+            (u'ok', _format_ts(since))).fetchall()
+
+    def get_host_throughput(self, since):
+        """
+        Returns dictionary of {host: download throughput in bytes/second}
+        over successful runs started after `since`.
+        """
+        rows = self._db.execute(
+            u'SELECT host, SUM(archive_bytes), SUM(download_time) FROM runs '
+            u'WHERE outcome = ? AND started_at >= ? '
+            u'AND archive_bytes IS NOT NULL AND download_time > 0 '
+            u'GROUP BY host', (u'ok', _format_ts(since)))
+        return dict((host, total_bytes / total_time)
+                    for host, total_bytes, total_time in rows.fetchall())
+
+    def get_average_archive_bytes(self, since):
+        "Returns dictionary of {VM: average archive size} after `since`"
+        return dict(self._db.execute(
+            u'SELECT vm, AVG(archive_bytes) FROM runs '
+            u'WHERE outcome = ? AND started_at >= ? '
+            u'AND archive_bytes IS NOT NULL GROUP BY vm',
+            (u'ok', _format_ts(since))).fetchall())
+
+    def get_outcome_counts(self, since):
+        "Returns dictionary of {VM: {outcome: count}} for runs after `since`"
+        res = dict()
+        for vm, outcome, count in self._db.execute(
+                u'SELECT vm, outcome, COUNT(*) FROM runs '
+                u'WHERE started_at >= ? GROUP BY vm, outcome',
+                (_format_ts(since),)).fetchall():
+            res.setdefault(vm, dict())[outcome] = count
+        return res
+
+def format_report(run_history, since, slowdown_ratio=1.5):
+    "Returns a plain text performance report for runs after `since`"
+    lines = [u'Backup report since %s' % (_format_ts(since)), u'']
+    lines.append(u'Duration percentiles (seconds):')
+    outcomes = run_history.get_outcome_counts(since)
+    for vm, pcts in sorted(run_history.get_duration_percentiles(
+            since).iteritems()):
+        lines.append(u'\t%s: %s (failed runs: %d)' % (
+            vm, u', '.join(u'p%d=%.0f' % (p, pcts[p]) for p in sorted(pcts)),
+            sum(count for outcome, count in outcomes[vm].iteritems()
+                if u'ok' != outcome)))
+    lines.append(u'')
+    lines.append(u'Monthly trends:')
+    prev = dict()
+    for vm, month, runs, avg_time, total_bytes in \
+            run_history.get_monthly_trends(since):
+        note = u''
+        if vm in prev and prev[vm] and \
+                avg_time >= prev[vm] * slowdown_ratio:
+            note = u'\t<-- %.1fx slower' % (avg_time / prev[vm])
+        lines.append(u'\t%s %s: %d runs, avg %.0f seconds, %d bytes%s' % (
+            vm, month, runs, avg_time, total_bytes or 0, note))
+        prev[vm] = avg_time
+    lines.append(u'')
+    lines.append(u'Download throughput:')
+    for host, throughput in sorted(run_history.get_host_throughput(
+            since).iteritems()):
+        lines.append(u'\t%s: %.2f MB/s' % (host, throughput / 2**20))
+    return u'\n'.join(lines)
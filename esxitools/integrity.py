@@ -0,0 +1,260 @@
+"""
+Integrity checking of downloaded backup archives.
+
+Archives are streamed through decompression (gzip, or xz/zstd after
+recompression) and tar validation while being hashed,
+and the results are recorded in a sidecar manifest that lives next to the
+archives, so only new or changed archives need to be checked again.
+Manifest entries are "ok" (True), corrupt (False), or unverified (None,
+when the archive could not be read) - unverified archives are checked
+again on the next run.
+"""
+import os
+import errno
+import json
+import hashlib
+import struct
+import tarfile
+import zlib
+from multiprocessing import Pool
+
+import compression
+import compat
+
+MANIFEST_NAME = u'.verify-manifest.json'
+CHUNK_SIZE = 1024 * 1024
+
+class ArchiveCorruptError(RuntimeError):
+    pass
+
+class _GzipStreamReader(object):
+    """
+    Read-only file-like object that hashes the raw bytes of a gzip stream
+    and yields the decompressed bytes, validating the gzip trailer
+    (CRC32 and size) once the stream is exhausted.
+    """
+    def __init__(self, raw_file):
+        self._raw_file = raw_file
+        self._hash = hashlib.sha256()
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buf = b''
+        self._pos = 0
+        self._tail = b''
+        self._crc = 0
+        self._size = 0
+        self._eof = False
+
+    def _fill(self):
+        # Decompress in bounded steps so zero-filled disks don't blow up
+        raw = self._decompressor.unconsumed_tail
+        if not raw:
+            raw = self._raw_file.read(CHUNK_SIZE)
+            if raw:
+                self._hash.update(raw)
+                self._tail = (self._tail + raw)[-8:]
+        if raw:
+            data = self._decompressor.decompress(raw, CHUNK_SIZE)
+        else:
+            data = self._decompressor.flush()
+            self._eof = True
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+
+    def read(self, size=-1):
+        while not self._eof and \
+                (size < 0 or len(self._buf) - self._pos < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buf) - self._pos
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def drain(self):
+        "Reads (and discards) the rest of the stream, checking the trailer"
+        while not self._eof:
+            self._pos = len(self._buf)
+            self._fill()
+        if len(self._tail) < 8:
+            raise ArchiveCorruptError(u'Truncated gzip stream')
+        crc, size = struct.unpack('<II', self._tail)
+        if crc != self._crc & 0xffffffff or size != self._size & 0xffffffff:
+            raise ArchiveCorruptError(u'Gzip trailer mismatch')
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+class _HashingReader(object):
+    "Read-only file-like object hashing the bytes read from `raw_file`"
+    def __init__(self, raw_file):
+        self._raw_file = raw_file
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._raw_file.read(size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+class _StreamReader(object):
+    """
+    Read-only file-like object yielding the decompressed bytes of
+    `raw_file` in (non-gzip) format `fmt`, hashing the raw bytes.
+    """
+    def __init__(self, raw_file, fmt):
+        self._raw_reader = _HashingReader(raw_file)
+        self._reader = compression.open_reader(fmt, self._raw_reader)
+
+    def read(self, size=-1):
+        try:
+            return self._reader.read(size)
+        except (IOError, EOFError):
+            raise
+        except Exception, ex:
+            # Decompression errors of lzma and zstandard
+            raise ArchiveCorruptError(u'%s' % (ex))
+
+    def drain(self):
+        "Reads (and discards) the rest of the stream, checking its checksum"
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self._raw_reader.hexdigest()
+
+def _stat_archive(archive_path):
+    """
+    Returns the stat of `archive_path`, or None if it was removed (e.g.
+    trimmed, offloaded or recompressed) since it was listed
+    """
+    try:
+        return os.stat(archive_path)
+    except OSError, ex:
+        if errno.ENOENT == ex.errno:
+            return None
+        raise
+
+def check_archive(archive_path):
+    """
+    Streams `archive_path` through decompression+tar validation and
+    hashing, returning a manifest entry dictionary for it, or None if the
+    archive no longer exists.
+    Only format errors mark the archive corrupt - I/O errors reading it
+    (e.g. permissions, EIO or stale NFS handles) leave it unverified.
+    """
+    st = _stat_archive(archive_path)
+    if st is None:
+        return None
+    entry = {u'size': st.st_size, u'mtime': st.st_mtime}
+    fmt = compression.get_format(archive_path)
+    try:
+        with open(archive_path, 'rb') as raw_file:
+            if u'gz' == fmt or fmt is None:
+                reader = _GzipStreamReader(raw_file)
+            else:
+                reader = _StreamReader(raw_file, fmt)
+            tar = tarfile.open(fileobj=reader, mode='r|')
+            # Iterating a stream-mode tar reads through all member data
+            for _ in tar:
+                pass
+            tar.close()
+            reader.drain()
+    except EnvironmentError, ex:
+        if errno.ENOENT == ex.errno:
+            return None
+        entry[u'ok'] = None
+        entry[u'error'] = u'%s' % (ex)
+    except (EOFError, tarfile.TarError, zlib.error,
+            ArchiveCorruptError), ex:
+        entry[u'ok'] = False
+        entry[u'error'] = u'%s' % (ex)
+    else:
+        entry[u'ok'] = True
+        entry[u'sha256'] = reader.hexdigest()
+    return entry
+
+def _check_archive_job(archive_path):
+    _, archive = os.path.split(archive_path)
+    return archive, check_archive(archive_path)
+
+def get_manifest_path(archive_dir):
+    return os.path.join(archive_dir, MANIFEST_NAME)
+
+def load_manifest(archive_dir):
+    """
+    Returns the verification manifest of `archive_dir` as a dictionary,
+    with archive file names as keys and manifest entries as values.
+    """
+    manifest_path = get_manifest_path(archive_dir)
+    if not os.path.isfile(manifest_path):
+        return dict()
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def manifest_lock(archive_dir):
+    "Serializes manifest updates between verify and offload processes"
+    return compat.file_lock(u'%s.lock' % (get_manifest_path(archive_dir)))
+
+def save_manifest(archive_dir, manifest):
+    "Atomically replaces the verification manifest of `archive_dir`"
+    manifest_path = get_manifest_path(archive_dir)
+    tmp_path = u'%s.tmp' % (manifest_path)
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.rename(tmp_path, manifest_path)
+
+def is_entry_stale(entry, archive_path):
+    """
+    Returns True if `archive_path` changed (or was removed) since `entry`
+    was recorded
+    """
+    st = _stat_archive(archive_path)
+    if st is None:
+        return True
+    return entry[u'size'] != st.st_size or entry[u'mtime'] != st.st_mtime
+
+def verify_archives(archive_dir, archive_paths, processes=None):
+    """
+    Verifies archives in `archive_paths` that are new or changed since the
+    last run, using a pool of `processes` worker processes (defaults to
+    the number of CPUs), and updates the manifest of `archive_dir`.
+    Returns a dictionary of the newly verified entries.
+    """
+    manifest = load_manifest(archive_dir)
+    to_verify = list()
+    present = set()
+    for archive_path in archive_paths:
+        _, archive = os.path.split(archive_path)
+        present.add(archive)
+        if archive not in manifest or manifest[archive][u'ok'] is None or \
+                is_entry_stale(manifest[archive], archive_path):
+            to_verify.append(archive_path)
+    # Forget archives that no longer exist
+    removed = set(manifest) - present
+    verified = dict()
+    if to_verify:
+        pool = Pool(processes)
+        try:
+            for archive, entry in pool.imap_unordered(_check_archive_job,
+                                                      to_verify):
+                if entry is None:
+                    # Removed since listed - forget it
+                    removed.add(archive)
+                else:
+                    verified[archive] = entry
+        finally:
+            pool.close()
+            pool.join()
+    # Merge into the current manifest, as another verification may have
+    # updated it meanwhile
+    with manifest_lock(archive_dir):
+        manifest = load_manifest(archive_dir)
+        for archive in removed:
+            manifest.pop(archive, None)
+        manifest.update(verified)
+        save_manifest(archive_dir, manifest)
+    return verified
@@ -0,0 +1,208 @@
+"""
+Batched, asynchronous notification delivery.
+
+Notifications are queued to a durable spool directory (one JSON file per
+message and sink), and delivered as digests by `Notifier.flush` - from the
+`notify` command, which backups start detached after queueing, so a slow
+or unreachable sink never holds up a backup run. Anything left behind
+(e.g. while the SMTP server was down) is delivered by the next flush.
+"""
+import os
+import json
+import time
+import uuid
+
+import compat
+
+class SmtpSink(object):
+    "Sends digests by email, reusing one SMTP connection per flush"
+    def __init__(self, config):
+        self.host = config[u'host']
+        self.port = config.get(u'port', 587)
+        self.timeout = config.get(u'timeout', 60)
+        self.starttls = config.get(u'starttls', True)
+        self.user = config.get(u'user')
+        self.password = config.get(u'password')
+        self.from_field = config[u'from']
+        recipients = config[u'recipients']
+        self.recipients = list(recipients) if isinstance(recipients, list) \
+                          else [recipients]
+        self._server = None
+
+    def _connect(self):
+        import smtplib
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.user:
+            server.login(self.user, self.password)
+        return server
+
+    def send(self, subject, body):
+        if not self._server:
+            self._server = self._connect()
+        message = u'From: %s\r\nTo: %s\r\nSubject: %s\r\n\r\n%s\r\n' % (
+            self.from_field, u', '.join(self.recipients), subject, body)
+        try:
+            self._server.sendmail(self.from_field, self.recipients,
+                                  message.encode(u'utf-8'))
+        except:
+            # Reconnect on the next attempt
+            self.close()
+            raise
+
+    def close(self):
+        if self._server:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+class WebhookSink(object):
+    "Posts digests as JSON ({subject, body}) to a URL"
+    def __init__(self, config):
+        self.url = config[u'url']
+        self.timeout = config.get(u'timeout', 30)
+
+    def send(self, subject, body):
+        import urllib2
+        request = urllib2.Request(
+            self.url, json.dumps({u'subject': subject, u'body': body}),
+            {'Content-Type': 'application/json'})
+        urllib2.urlopen(request, timeout=self.timeout).close()
+
+    def close(self):
+        pass
+
+class FileSink(object):
+    "Appends digests to a local file"
+    def __init__(self, config):
+        self.path = config[u'path']
+
+    def send(self, subject, body):
+        with open(self.path, 'ab') as out_file:
+            out_file.write((u'Subject: %s\n\n%s\n\n' %
+                            (subject, body)).encode(u'utf-8'))
+
+    def close(self):
+        pass
+
+_sinks = {
+    u'smtp':        SmtpSink,
+    u'webhook':     WebhookSink,
+    u'file':        FileSink,
+}
+
+def get_sink(config):
+    "Returns notification sink for `config` (see `notify_sinks` setting)"
+    return _sinks[config[u'type']](config)
+
+def format_digest(messages):
+    "Returns (subject, body) of a digest of spooled `messages`"
+    if 1 == len(messages):
+        return messages[0][u'subject'], messages[0][u'body']
+    subject = u'%d notifications: %s' % (
+        len(messages), u'; '.join(msg[u'subject'] for msg in messages))
+    body = u'\n\n'.join(u'=== %s (%s) ===\n%s' % (
+        msg[u'subject'], msg[u'created_at'], msg[u'body'])
+        for msg in messages)
+    return subject, body
+
+class Notifier(object):
+    """
+    Spools notifications for every sink in `sinks` ({name: sink}) under
+    `spool_dir`, and delivers them in digests of up to `max_batch`
+    messages, retrying failed deliveries `retries` times.
+    """
+    _sleep = staticmethod(time.sleep)
+    _clock = staticmethod(time.time)
+
+    def __init__(self, spool_dir, sinks, max_batch=50, retries=3,
+                 retry_delay=5):
+        self.spool_dir = spool_dir
+        self.sinks = sinks
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def _get_sink_dir(self, name):
+        sink_dir = os.path.join(self.spool_dir, name)
+        if not os.path.isdir(sink_dir):
+            os.makedirs(sink_dir)
+        return sink_dir
+
+    def _sink_lock(self, name):
+        "Serializes flushes of sink `name` between processes"
+        return compat.file_lock(os.path.join(self._get_sink_dir(name),
+                                             u'.lock'))
+
+    def enqueue(self, subject, body):
+        "Spools a notification for every sink"
+        message = {
+            u'subject': subject,
+            u'body': body,
+            u'created_at': time.strftime(u'%Y-%m-%d %H:%M:%S',
+                                         time.localtime(self._clock())),
+        }
+        # Names sort in queueing order
+        name = u'%017.6f-%s.json' % (self._clock(), uuid.uuid4().hex)
+        for sink_name in self.sinks:
+            path = os.path.join(self._get_sink_dir(sink_name), name)
+            with open(u'%s.tmp' % (path), 'w') as msg_file:
+                json.dump(message, msg_file)
+            os.rename(u'%s.tmp' % (path), path)
+
+    def pending(self, sink_name):
+        "Returns sorted paths of the spooled messages of sink `sink_name`"
+        sink_dir = self._get_sink_dir(sink_name)
+        return [os.path.join(sink_dir, name)
+                for name in sorted(os.listdir(sink_dir))
+                if name.endswith(u'.json')]
+
+    def _deliver(self, sink, subject, body):
+        "Sends a digest with `sink`, retrying with exponential backoff"
+        for attempt in xrange(self.retries + 1):
+            try:
+                return sink.send(subject, body)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                self._sleep(self.retry_delay * 2 ** attempt)
+
+    def _flush_sink(self, sink_name):
+        sink = self.sinks[sink_name]
+        sent = 0
+        with self._sink_lock(sink_name):
+            try:
+                paths = self.pending(sink_name)
+                for i in xrange(0, len(paths), self.max_batch):
+                    batch = paths[i:i + self.max_batch]
+                    messages = list()
+                    for path in batch:
+                        with open(path, 'r') as msg_file:
+                            messages.append(json.load(msg_file))
+                    self._deliver(sink, *format_digest(messages))
+                    for path in batch:
+                        os.remove(path)
+                    sent += len(batch)
+            finally:
+                sink.close()
+        return sent
+
+    def flush(self):
+        """
+        Delivers all spooled notifications, returning {sink name: error
+        message, or None if all its messages were delivered}.
+        Messages of sinks that keep failing stay spooled for the next flush.
+        """
+        res = dict()
+        for sink_name in sorted(self.sinks):
+            try:
+                self._flush_sink(sink_name)
+                res[sink_name] = None
+            except Exception, ex:
+                res[sink_name] = u'%s' % (ex)
+        return res
@@ -0,0 +1,397 @@
+"""
+Backup profile configuration model.
+
+Profiles are loaded from `settings.ESXI_BACKUP_PROFILES` (or from a JSON or
+YAML file with the same structure), compiled into `Profile` objects with
+per-VM settings resolved against `default_vm_config`, and validated once.
+Compiled profiles are cached per source file and modification time.
+"""
+import os
+import re
+import json
+import datetime
+
+class ProfileError(RuntimeError):
+    pass
+
+def _string(value):
+    if not isinstance(value, basestring):
+        raise ValueError(u'expected a string')
+    return value
+
+def _strings(value):
+    if isinstance(value, basestring):
+        return value
+    if not isinstance(value, (list, tuple)) or \
+            not all(isinstance(v, basestring) for v in value):
+        raise ValueError(u'expected a string or a list of strings')
+    return list(value)
+
+def _bool(value):
+    if not isinstance(value, bool):
+        raise ValueError(u'expected True or False')
+    return value
+
+def _port(value):
+    if not isinstance(value, (int, long)) or not 0 < value < 65536:
+        raise ValueError(u'expected a TCP port number')
+    return value
+
+def _positive_int(value):
+    if not isinstance(value, (int, long)) or isinstance(value, bool) or \
+            value < 1:
+        raise ValueError(u'expected a positive integer')
+    return value
+
+def _positive_number(value):
+    if not isinstance(value, (int, long, float)) or \
+            isinstance(value, bool) or value <= 0:
+        raise ValueError(u'expected a positive number')
+    return value
+
+def _cold_storage(value):
+    if not isinstance(value, dict):
+        raise ValueError(u'expected a dictionary')
+    required = {
+        u'directory':   (u'path',),
+        u's3':          (u'bucket',),
+    }
+    if not value.get(u'type') in required:
+        raise ValueError(u'expected type "directory" or "s3"')
+    for key in required[value[u'type']]:
+        if not isinstance(value.get(key), basestring):
+            raise ValueError(u'missing "%s"' % (key))
+    return value
+
+def _notify_sinks(value):
+    if not isinstance(value, dict):
+        raise ValueError(u'expected a dictionary of sinks')
+    required = {
+        u'smtp':        (u'host', u'from'),
+        u'webhook':     (u'url',),
+        u'file':        (u'path',),
+    }
+    for name, sink in sorted(value.iteritems()):
+        if not isinstance(sink, dict) or not sink.get(u'type') in required:
+            raise ValueError(u'sink "%s": expected type "smtp", "webhook" '
+                             u'or "file"' % (name))
+        for key in required[sink[u'type']]:
+            if not isinstance(sink.get(key), basestring):
+                raise ValueError(u'sink "%s": missing "%s"' % (name, key))
+        if u'smtp' == sink[u'type']:
+            try:
+                _strings(sink.get(u'recipients'))
+            except ValueError, ex:
+                raise ValueError(u'sink "%s": "recipients" %s' % (name, ex))
+    return value
+
+def _vmdk_files(value):
+    "Accepts 'all' or a list of VMDK file names"
+    if u'all' == value:
+        return value
+    if not isinstance(value, (list, tuple)) or not value or \
+            not all(isinstance(v, basestring) and v.endswith(u'.vmdk')
+                    and not u',' in v for v in value):
+        raise ValueError(u'expected "all" or a list of VMDK file names')
+    return list(value)
+
+def _engine(value):
+    if not value in (u'ghettovcb', u'native'):
+        raise ValueError(u'expected "ghettovcb" or "native"')
+    return value
+
+def _recompress_format(value):
+    if not value in (u'xz', u'zst'):
+        raise ValueError(u'expected "xz" or "zst"')
+    return value
+
+def _period(value):
+    "Accepts a timedelta, or a number of days (for JSON/YAML profiles)"
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        value = datetime.timedelta(value)
+    if not isinstance(value, datetime.timedelta):
+        raise ValueError(u'expected a timedelta or a number of days')
+    if value <= datetime.timedelta(0):
+        raise ValueError(u'expected a positive period')
+    return value
+
+_time_re = re.compile(u'^(\d{1,2})\:(\d{2})(?:\:(\d{2}))?$')
+
+def _time(value):
+    "Accepts a time, or a HH:MM[:SS] string (for JSON/YAML profiles)"
+    if isinstance(value, datetime.time):
+        return value
+    if isinstance(value, basestring):
+        if value in (u'max', u'24:00'):
+            return datetime.time.max
+        m = _time_re.match(value)
+        if m:
+            return datetime.time(*[int(g) for g in m.groups() if g])
+    raise ValueError(u'expected a time or a HH:MM[:SS] string')
+
+def _time_ranges(value):
+    if not isinstance(value, (list, tuple)):
+        raise ValueError(u'expected a sequence of (start, end) pairs')
+    ranges = list()
+    for time_range in value:
+        if not isinstance(time_range, (list, tuple)) or 2 != len(time_range):
+            raise ValueError(u'expected a sequence of (start, end) pairs')
+        ts, te = _time(time_range[0]), _time(time_range[1])
+        if ts > te:
+            raise ValueError(u'range starts after it ends')
+        ranges.append((ts, te))
+    return tuple(ranges)
+
+_default_extent_stream_script = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, u'vmware',
+    u'extentstream.py'))
+
+class VmConfig(object):
+    "Resolved backup configuration of a single VM"
+    __slots__ = (
+        'period',
+        'rotation_count',
+        'vmdk_files',
+        'parallel_disk_streams',
+        'engine',
+        'sparse_archive',
+    )
+    # Setting name -> value validator
+    _validators = {
+        u'period':          _period,
+        u'rotation_count':  _positive_int,
+    }
+    # Optional settings: setting name -> (value validator, default value)
+    _optional_settings = {
+        # VMDK files to back up (names as in the VM directory)
+        u'vmdk_files':      (_vmdk_files, u'all'),
+        # Disks archived and downloaded in parallel, as one part archive
+        # per disk (1 = single archive)
+        u'parallel_disk_streams': (_positive_int, 1),
+        # "ghettovcb" clones disks on the host and archives the clones,
+        # "native" snapshots the VM and streams the base disks directly
+        u'engine':          (_engine, u'ghettovcb'),
+        # Stream ghettovcb backups skipping zero blocks, archiving locally
+        u'sparse_archive':  (_bool, False),
+    }
+
+    def __init__(self, *config_dicts):
+        """
+        Applies `config_dicts` in order, so later dictionaries override
+        settings of earlier ones.
+        """
+        for key, (_, default) in self._optional_settings.iteritems():
+            setattr(self, key, default)
+        for config_dict in config_dicts:
+            for key, value in config_dict.iteritems():
+                if not key in self._validators and \
+                        not key in self._optional_settings:
+                    raise ProfileError(u'Unknown VM setting "%s"' % (key))
+                setattr(self, key, value)
+
+    def validate(self, vmname):
+        validators = dict(self._validators)
+        validators.update(
+            (key, validator)
+            for key, (validator, _) in self._optional_settings.iteritems())
+        for key, validator in sorted(validators.iteritems()):
+            if not hasattr(self, key):
+                raise ProfileError(u'VM "%s": missing setting "%s"' %
+                                   (vmname, key))
+            try:
+                setattr(self, key, validator(getattr(self, key)))
+            except ValueError, ex:
+                raise ProfileError(u'VM "%s": bad setting "%s" (%s)' %
+                                   (vmname, key, ex))
+
+class Profile(object):
+    "Compiled backup profile"
+    __slots__ = (
+        'name',
+        'host_ip',
+        'ssh_port',
+        'ssh_user',
+        'ssh_password',
+        'ftp_user',
+        'ftp_password',
+        'backup_times',
+        'ghettovcb_script_template',
+        'remote_workdir',
+        'remote_backup_dir',
+        'backups_archive_dir',
+        'email_report',
+        'gmail_user',
+        'gmail_pwd',
+        'from_field',
+        'recipients',
+        'backup_vms',
+        'history_db',
+        'stage_timeout_factor',
+        'min_stage_timeout',
+        'max_stage_timeout',
+        'stall_timeout',
+        'cold_storage',
+        'hot_archive_count',
+        'offload_streams',
+        'extent_stream_script',
+        'notify_sinks',
+        'notify_spool_dir',
+        'recompress_format',
+        'recompress_level',
+        'recompress_processes',
+    )
+    # Setting name -> value validator
+    _validators = {
+        u'host_ip':         _string,
+        u'ssh_port':        _port,
+        u'ssh_user':        _string,
+        u'ssh_password':    _string,
+        u'ftp_user':        _string,
+        u'ftp_password':    _string,
+        u'backup_times':    _time_ranges,
+        u'ghettovcb_script_template': _string,
+        u'remote_workdir':  _string,
+        u'remote_backup_dir': _string,
+        u'backups_archive_dir': _string,
+        u'email_report':    _bool,
+    }
+    # Settings only required when email reports are enabled
+    _email_validators = {
+        u'gmail_user':      _string,
+        u'gmail_pwd':       _string,
+        u'from_field':      _string,
+        u'recipients':      _strings,
+    }
+
+    # Optional settings: setting name -> (value validator, default value)
+    # Validation is skipped for settings left as None
+    _optional_settings = {
+        u'history_db':      (_string, None),
+        # Stage timeouts are the historical (95th percentile) stage duration
+        # times the factor, bounded by min/max (seconds)
+        u'stage_timeout_factor': (_positive_number, 3),
+        u'min_stage_timeout': (_positive_number, 10 * 60),
+        u'max_stage_timeout': (_positive_number, 12 * 60 * 60),
+        # Seconds without progress before a transfer is considered stalled
+        u'stall_timeout':   (_positive_number, 5 * 60),
+        # Secondary target for older archives (no tiering if None)
+        u'cold_storage':    (_cold_storage, None),
+        # Number of newest archives per VM kept in backups_archive_dir
+        u'hot_archive_count': (_positive_int, 1),
+        # Parallel streams per archive copied to cold storage
+        u'offload_streams': (_positive_int, 4),
+        # Host-side helper of the native engine
+        u'extent_stream_script': (_string, _default_extent_stream_script),
+        # Notification sinks: name -> sink config (if None, an email sink
+        # from the gmail settings when email_report is enabled)
+        u'notify_sinks':    (_notify_sinks, None),
+        # Spool of undelivered notifications (default in backups_archive_dir)
+        u'notify_spool_dir': (_string, None),
+        # Denser format downloaded archives are recompressed to in the
+        # background (no recompression if None)
+        u'recompress_format': (_recompress_format, None),
+        # Format-specific compression level (default per format)
+        u'recompress_level': (_positive_int, None),
+        # Parallel recompression processes (default is the number of CPUs)
+        u'recompress_processes': (_positive_int, None),
+    }
+
+    def __init__(self, profile_dict, name=None):
+        """
+        Compiles `profile_dict`, resolving the configuration of every VM
+        in `backup_vms` against `default_vm_config`.
+        Settings are not validated - see `validate`.
+        """
+        self.name = name
+        for key, (_, default) in self._optional_settings.iteritems():
+            setattr(self, key, default)
+        default_vm_config = profile_dict.get(u'default_vm_config', {})
+        for key, value in profile_dict.iteritems():
+            if u'default_vm_config' == key:
+                continue
+            if u'backup_vms' == key:
+                value = dict(
+                    (vmname, VmConfig(default_vm_config, vm_dict))
+                    for vmname, vm_dict in value.iteritems())
+            elif not key in self._validators and \
+                    not key in self._email_validators and \
+                    not key in self._optional_settings:
+                raise ProfileError(u'Unknown profile setting "%s"' % (key))
+            setattr(self, key, value)
+
+    def _validate_settings(self, validators):
+        for key, validator in sorted(validators.iteritems()):
+            if not hasattr(self, key):
+                raise ProfileError(u'Profile "%s": missing setting "%s"' %
+                                   (self.name, key))
+            try:
+                setattr(self, key, validator(getattr(self, key)))
+            except ValueError, ex:
+                raise ProfileError(u'Profile "%s": bad setting "%s" (%s)' %
+                                   (self.name, key, ex))
+
+    def validate(self):
+        "Validates (and normalizes) all settings, raising ProfileError"
+        self._validate_settings(self._validators)
+        if self.email_report:
+            self._validate_settings(self._email_validators)
+        self._validate_settings(dict(
+            (key, validator)
+            for key, (validator, _) in self._optional_settings.iteritems()
+            if getattr(self, key) is not None))
+        if not getattr(self, u'backup_vms', None):
+            raise ProfileError(u'Profile "%s": no VMs in "backup_vms"' %
+                               (self.name))
+        for vmname, vm_config in self.backup_vms.iteritems():
+            try:
+                vm_config.validate(vmname)
+            except ProfileError, ex:
+                raise ProfileError(u'Profile "%s": %s' % (self.name, ex))
+        return self
+
+def compile_profiles(profile_dicts):
+    "Returns dictionary of validated Profile objects by profile name"
+    return dict((name, Profile(profile_dict, name).validate())
+                for name, profile_dict in profile_dicts.iteritems())
+
+def _read_profiles_file(path):
+    with open(path, 'r') as profiles_file:
+        if path.endswith((u'.yaml', u'.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ProfileError(u'YAML profiles require PyYAML')
+            return yaml.safe_load(profiles_file)
+        return json.load(profiles_file)
+
+def _get_settings_path(settings_module):
+    path = settings_module.__file__
+    if path.endswith((u'.pyc', u'.pyo')):
+        path = path[:-1]
+    return path
+
+# Source file path -> (modification time, compiled profiles)
+_cache = dict()
+
+def load_profiles(path=None):
+    """
+    Returns dictionary of compiled profiles by profile name.
+    If `path` is specified, profiles are read from that JSON/YAML file,
+    otherwise from `settings.ESXI_BACKUP_PROFILES`.
+    Compiled profiles are reused until the source file is modified.
+    """
+    import settings
+    source = path or _get_settings_path(settings)
+    mtime = os.path.getmtime(source)
+    if source in _cache and _cache[source][0] == mtime:
+        return _cache[source][1]
+    if path:
+        profile_dicts = _read_profiles_file(path)
+    else:
+        if source in _cache:
+            # Settings changed since they were compiled
+            reload(settings)
+        profile_dicts = settings.ESXI_BACKUP_PROFILES
+    profiles = compile_profiles(profile_dicts)
+    _cache[source] = (mtime, profiles)
+    return profiles
@@ -0,0 +1,241 @@
+"""
+Dry-run scheduling simulator.
+
+Replays the real scheduling (`get_next_vm_to_backup`) and trimming
+(`trim_backup_archives`) logic of a profile over weeks of simulated time,
+against an in-memory archive index and historical run durations, to see
+the effect of `period`, `rotation_count` and `backup_times` changes
+without running any backups.
+"""
+import os
+import re
+import datetime
+from fnmatch import translate
+
+import backup
+from backup import BackupProfile, is_time_in_window, logger
+
+class SimulatedBackupProfile(BackupProfile):
+    """
+    BackupProfile with a simulated clock (`now`) and an in-memory archive
+    index (`archives`, {archive file name: size in bytes}).
+    """
+    def __init__(self, profile, archives, now):
+        super(SimulatedBackupProfile, self).__init__(profile)
+        self.now = now
+        self.archives = dict()
+        # The scheduler lists the archives of every VM on every decision,
+        # so listings (by pattern) and timestamps (by VM) are indexed.
+        # Listings are (compiled pattern, set of archive file names).
+        self._listings = dict()
+        self._timestamps = dict()
+        for archive, size in archives.iteritems():
+            self.add_archive(archive, size)
+
+    def _get_current_time(self):
+        return self.now
+
+    def _list_archives(self, pattern, include_corrupt, include_cold):
+        if not pattern in self._listings:
+            pattern_re = re.compile(translate(pattern))
+            self._listings[pattern] = (pattern_re, set(
+                archive for archive in self.archives
+                if pattern_re.match(archive)))
+        return [os.path.join(self.backups_archive_dir, archive)
+                for archive in sorted(self._listings[pattern][1])]
+
+    def get_latest_archives(self):
+        return dict((vmname, max(timestamps))
+                    for vmname, timestamps in self._timestamps.iteritems()
+                    if timestamps)
+
+    def _parse_archive(self, archive):
+        m = self._backup_archive_re.match(archive)
+        if m:
+            return m.group(u'vmname'), datetime.datetime.strptime(
+                m.group(u'ts'), u'%Y-%m-%d_%H-%M-%S')
+        return None, None
+
+    def add_archive(self, archive, size):
+        self.archives[archive] = size
+        for pattern_re, listing in self._listings.itervalues():
+            if pattern_re.match(archive):
+                listing.add(archive)
+        vmname, ts = self._parse_archive(archive)
+        if vmname:
+            self._timestamps.setdefault(vmname, set()).add(ts)
+
+    def _remove_archive(self, archive_path):
+        _, archive = os.path.split(archive_path)
+        del self.archives[archive]
+        for _, listing in self._listings.itervalues():
+            listing.discard(archive)
+        vmname, ts = self._parse_archive(archive)
+        if vmname:
+            self._timestamps[vmname].discard(ts)
+
+    def get_storage_bytes(self):
+        return sum(self.archives.itervalues())
+
+def _window_seconds(backup_times, start, end,
+                    step=datetime.timedelta(minutes=1)):
+    "Returns seconds of backup windows between `start` and `end`"
+    seconds, t = 0, start
+    while t < end:
+        # Windows include their end time - sample the middle of every step
+        if is_time_in_window((t + step // 2).time(), backup_times):
+            seconds += (min(t + step, end) - t).total_seconds()
+        t += step
+    return seconds
+
+def _get_overdue_stats(backups, period, end):
+    """
+    Returns (total overdue seconds, max overdue seconds, overdue at `end`)
+    for a VM backed up at the sorted `backups` times.
+    """
+    total = worst = 0
+    for prev_ts, next_ts in zip(backups, backups[1:] + [end]):
+        late = (next_ts - prev_ts - period).total_seconds()
+        if late > 0:
+            total += late
+            worst = max(worst, late)
+    overdue_at_end = not backups or end - backups[-1] >= period
+    return total, worst, overdue_at_end
+
+def simulate_schedule(bp, durations, sizes, days, tick=datetime.timedelta(
+                      minutes=15), default_duration=3600, default_size=0):
+    """
+    Simulates `days` days of backup runs of SimulatedBackupProfile `bp`,
+    starting at `bp.now`, with a backup run starting (if none is running)
+    every `tick`, like a cron job.
+    `durations` and `sizes` are {VM: run seconds} and {VM: archive bytes},
+    with `default_duration` and `default_size` for VMs missing there.
+    Returns dictionary of simulation results (see `format_simulation`).
+    """
+    start = bp.now
+    end = start + datetime.timedelta(days)
+    res = {
+        u'start': start,
+        u'end': end,
+        u'runs': list(),
+        u'busy_seconds': 0,
+        u'overrun_seconds': 0,
+        u'storage_peak': (bp.get_storage_bytes(), start),
+    }
+    backups = dict((vmname, list()) for vmname in bp.backup_vms)
+    for vmname, ts in bp.get_latest_archives().iteritems():
+        if vmname in backups:
+            backups[vmname].append(ts)
+    # The real scheduler logs every decision - keep it quiet
+    logger.disabled = True
+    try:
+        while bp.now < end:
+            if not is_time_in_window(bp.now.time(), bp.backup_times):
+                bp.now += tick
+                continue
+            vmname = bp.get_next_vm_to_backup()
+            if not vmname:
+                bp.now += tick
+                continue
+            run_start = bp.now
+            duration = datetime.timedelta(
+                seconds=durations.get(vmname, default_duration))
+            run_end = run_start + duration
+            # The archive is named by the start of the backup, and lands
+            # in the archive dir at the end of the run
+            bp.now = run_end
+            bp.add_archive(u'%s-%s.tar.gz' % (
+                vmname, run_start.strftime(u'%Y-%m-%d_%H-%M-%S')),
+                sizes.get(vmname, default_size))
+            storage = bp.get_storage_bytes()
+            if storage > res[u'storage_peak'][0]:
+                res[u'storage_peak'] = (storage, run_end)
+            bp.trim_backup_archives()
+            backups[vmname].append(run_start)
+            res[u'runs'].append((vmname, run_start, duration))
+            res[u'busy_seconds'] += duration.total_seconds()
+            res[u'overrun_seconds'] += max(duration.total_seconds() -
+                _window_seconds(bp.backup_times, run_start, run_end), 0)
+            # The next cron tick after the run ends
+            ticks = -(-(run_end - start).total_seconds() //
+                      tick.total_seconds())
+            bp.now = start + datetime.timedelta(
+                seconds=ticks * tick.total_seconds())
+    finally:
+        logger.disabled = False
+    res[u'window_seconds'] = _window_seconds(bp.backup_times, start, end)
+    res[u'overdue'] = dict(
+        (vmname, _get_overdue_stats(sorted(ts_list),
+                                    bp._get_vm_config(vmname, u'period'),
+                                    end))
+        for vmname, ts_list in backups.iteritems())
+    res[u'final_storage'] = bp.get_storage_bytes()
+    return res
+
+def format_simulation(res):
+    "Returns a plain text report of `simulate_schedule` results"
+    lines = [u'Simulated %s to %s: %d backup runs' % (
+        res[u'start'].strftime(u'%Y-%m-%d %H:%M'),
+        res[u'end'].strftime(u'%Y-%m-%d %H:%M'), len(res[u'runs'])), u'']
+    in_window = res[u'busy_seconds'] - res[u'overrun_seconds']
+    lines.append(u'Window utilization: %.1f%% of %.1f window hours' % (
+        100.0 * in_window / res[u'window_seconds']
+        if res[u'window_seconds'] else 0, res[u'window_seconds'] / 3600))
+    lines.append(u'Runs past window end: %.1f hours' % (
+        res[u'overrun_seconds'] / 3600))
+    lines.append(u'')
+    lines.append(u'Overdue VMs:')
+    for vmname, (total, worst, at_end) in sorted(res[u'overdue'].iteritems()):
+        if total or at_end:
+            lines.append(u'\t%s: overdue %.1f hours in total, worst %.1f '
+                         u'hours%s' % (vmname, total / 3600, worst / 3600,
+                                       u' (still overdue at end)'
+                                       if at_end else u''))
+    lines.append(u'')
+    peak, peak_ts = res[u'storage_peak']
+    lines.append(u'Storage peak: %.2f GB at %s (at end: %.2f GB)' % (
+        peak / 2.0**30, peak_ts.strftime(u'%Y-%m-%d %H:%M'),
+        res[u'final_storage'] / 2.0**30))
+    return u'\n'.join(lines)
+
+def _get_archive_index(bp, sizes):
+    """
+    Returns {archive file name: size} of the real archives of `bp`, as the
+    scheduler sees them (without corrupt or incomplete backups)
+    """
+    index = dict()
+    for archive_path in bp._list_backup_archives():
+        _, archive = os.path.split(archive_path)
+        m = bp._backup_archive_re.match(archive)
+        if not m:
+            continue
+        if os.path.isfile(archive_path):
+            index[archive] = os.path.getsize(archive_path)
+        else:
+            index[archive] = sizes.get(m.group(u'vmname'), 0)
+    return index
+
+def simulate(**kwargs):
+    profile_name, profile = backup._get_profile(kwargs)
+    days = kwargs.get(u'days') or 28
+    tick = datetime.timedelta(minutes=kwargs.get(u'tick') or 15)
+    duration_factor = kwargs.get(u'duration_factor') or 1.0
+    with BackupProfile(profile) as real_bp:
+        now = real_bp._get_current_time()
+        with real_bp.get_run_history() as run_history:
+            since = now - datetime.timedelta(kwargs.get(u'history_days')
+                                             or 90)
+            durations = dict(
+                (vmname, pcts[50] * duration_factor) for vmname, pcts in
+                run_history.get_duration_percentiles(since, (50,)).iteritems())
+            sizes = run_history.get_average_archive_bytes(since)
+        archives = dict() if kwargs.get(u'empty') else \
+                   _get_archive_index(real_bp, sizes)
+    bp = SimulatedBackupProfile(profile, archives,
+                                now.replace(second=0, microsecond=0))
+    print format_simulation(simulate_schedule(
+        bp, durations, sizes, days, tick,
+        default_duration=(kwargs.get(u'default_duration') or 60) * 60 *
+        duration_factor,
+        default_size=sum(sizes.itervalues()) / len(sizes) if sizes else 0))
+    return True
@@ -1,11 +1,20 @@
 import unittest
 from mock import Mock, call, patch, MagicMock
 from contextlib import nested
+from glob import glob
 from datetime import timedelta
 import os
 
 # Module under test
 import backup
+import integrity
+import profiles
+import history
+import watchdog
+import tiering
+import notify
+import simulate
+import compression
 
 def test_time_ranges():
     from datetime import time
@@ -50,6 +59,31 @@ class BackupTests(unittest.TestCase):
 
     def test_time_out_of_range(self):
         pass
+    
+    def test_failed_backup_notifies(self):
+        "Check that backups failing with an exception are notified"
+        from datetime import time
+        profile = Mock(backup_times=((time.min, time.max),))
+        with nested(patch(__name__ + '.backup.singleton'),
+                    patch(__name__ + '.backup._get_profile',
+                          return_value=(u'Dummy', profile)),
+                    patch(__name__ + '.backup.BackupProfile'),
+                    patch(__name__ + '.backup._start_detached')) as \
+                (_, _, bp_class, start_detached):
+            bp = bp_class.return_value.__enter__.return_value
+            bp.get_next_vm_to_backup.return_value = u'DummyVM-1'
+            bp.backup_vm.side_effect = watchdog.StageTimeout(
+                u'Stage "download" timed out')
+            notifier = bp.get_notifier.return_value
+            notifier.sinks = {u'log': Mock()}
+            notifier.pending.return_value = [u'/spool/log/1.json']
+            with self.assertRaises(watchdog.StageTimeout):
+                backup.backup(profile_name=u'Dummy')
+            self.assertEqual(notifier.enqueue.call_args[0][0],
+                             u'BACKUP FAILED DummyVM-1')
+            self.assertTrue(bp.record_run.called)
+            start_detached.assert_called_once_with(
+                {u'profile_name': u'Dummy'}, u'notify', notifier.spool_dir)
 
 ghettovcb_output_no_vm = """
 Logging output to "/tmp/ghettoVCB-2013-12-03_16-30-19-1752530.log" ...
@@ -346,50 +380,197 @@ class BackupProfileTests(unittest.TestCase):
                 },
             },
         }
-        with backup.BackupProfile(dummy_profile) as bp:
-            bp._list_backup_archives_for_vm = Mock(return_value=[
-                u'C:\\Backups\\DummyVM-1-2013-12-01_01-23-45.tar.gz',
-                u'C:\\Backups\\DummyVM-1-2013-10-01_01-23-45.tar.gz',
-                u'C:\\Backups\\DummyVM-1-2013-11-01_01-23-45.tar.gz',
-            ])
-            bp._remove_local_file = Mock()
-            bp.trim_backup_archives()
-            self.assertFalse(bp._remove_local_file.called)
+        with patch(__name__ + '.backup.tiering.catalog_lock'):
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._list_backup_archives_for_vm = Mock(return_value=[
+                    u'C:\\Backups\\DummyVM-1-2013-12-01_01-23-45.tar.gz',
+                    u'C:\\Backups\\DummyVM-1-2013-10-01_01-23-45.tar.gz',
+                    u'C:\\Backups\\DummyVM-1-2013-11-01_01-23-45.tar.gz',
+                ])
+                bp._remove_local_file = Mock()
+                bp.trim_backup_archives()
+                self.assertFalse(bp._remove_local_file.called)
     
     def test_trim_archives_one_deletion(self):
         "Check that archive trimming works as expected with one archive to delete"
         dummy_profile = {
+            u'backups_archive_dir': u'C:\\Backups',
             u'backup_vms':  {
                 u'DummyVM-1': {
                     u'rotation_count': 2,
                 },
             },
         }
+        with patch(__name__ + '.backup.tiering.catalog_lock'):
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._list_backup_archives_for_vm = Mock(return_value=[
+                    u'C:\\Backups\\DummyVM-1-2013-12-01_01-23-45.tar.gz',
+                    u'C:\\Backups\\DummyVM-1-2013-10-01_01-23-45.tar.gz',
+                    u'C:\\Backups\\DummyVM-1-2013-11-01_01-23-45.tar.gz',
+                ])
+                bp._remove_local_file = Mock()
+                bp.trim_backup_archives()
+                bp._remove_local_file.assert_called_once_with(
+                    u'C:\\Backups\\DummyVM-1-2013-10-01_01-23-45.tar.gz')
+    
+    def test_trim_archives_deletes_corrupt(self):
+        "Check that corrupt archives are trimmed without counting as backups"
+        dummy_profile = {
+            u'backups_archive_dir': u'/mnt/backups',
+            u'backup_vms':  {
+                u'DummyVM-1': {
+                    u'rotation_count': 1,
+                },
+            },
+        }
+        archives = [
+            u'/mnt/backups/DummyVM-1-2013-10-01_01-23-45.tar.gz',
+            u'/mnt/backups/DummyVM-1-2013-11-01_01-23-45.tar.gz',
+            u'/mnt/backups/DummyVM-1-2013-12-01_01-23-45.tar.gz',
+        ]
+        with patch(__name__ + '.backup.tiering.catalog_lock'):
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._list_backup_archives_for_vm = Mock(
+                    side_effect=lambda vmname, include_corrupt=False:
+                        list(archives) if include_corrupt else archives[:2])
+                bp._remove_local_file = Mock()
+                bp.trim_backup_archives()
+                self.assertItemsEqual(bp._remove_local_file.call_args_list, [
+                    call(u'/mnt/backups/DummyVM-1-2013-12-01_01-23-45.tar.gz'),
+                    call(u'/mnt/backups/DummyVM-1-2013-10-01_01-23-45.tar.gz')])
+    
+    def test_trim_archives_keeps_only_backup(self):
+        "Check that the newest backup is kept if no backup is valid"
+        dummy_profile = {
+            u'backups_archive_dir': u'/mnt/backups',
+            u'backup_vms':  {
+                u'DummyVM-1': {
+                    u'rotation_count': 1,
+                },
+            },
+        }
+        archives = [
+            u'/mnt/backups/DummyVM-1-2013-11-01_01-23-45.tar.gz',
+            u'/mnt/backups/DummyVM-1-2013-12-01_01-23-45.tar.gz',
+        ]
+        with patch(__name__ + '.backup.tiering.catalog_lock'):
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._list_backup_archives_for_vm = Mock(
+                    side_effect=lambda vmname, include_corrupt=False:
+                        list(archives) if include_corrupt else [])
+                bp._remove_local_file = Mock()
+                bp.trim_backup_archives()
+                bp._remove_local_file.assert_called_once_with(
+                    u'/mnt/backups/DummyVM-1-2013-11-01_01-23-45.tar.gz')
+    
+    def test_run_ssh_batch(self):
+        "Check that a batch runs as one script with per-command results"
+        dummy_profile = {}
         with backup.BackupProfile(dummy_profile) as bp:
-            bp._list_backup_archives_for_vm = Mock(return_value=[
-                u'C:\\Backups\\DummyVM-1-2013-12-01_01-23-45.tar.gz',
-                u'C:\\Backups\\DummyVM-1-2013-10-01_01-23-45.tar.gz',
-                u'C:\\Backups\\DummyVM-1-2013-11-01_01-23-45.tar.gz',
-            ])
-            bp._remove_local_file = Mock()
-            bp.trim_backup_archives()
-            bp._remove_local_file.assert_called_once_with(
-                u'C:\\Backups\\DummyVM-1-2013-10-01_01-23-45.tar.gz')
+            def fake_exec(script):
+                marker = script.split(u'"')[1][:-len(u'-begin-0')]
+                return (u'%(m)s-begin-0\nfoo\nbar\n%(m)s-end-0 exit_code=0\n'
+                        u'%(m)s-begin-1\nno newline%(m)s-end-1 exit_code=0\n'
+                        u'%(m)s-begin-2\n%(m)s-end-2 exit_code=1\n' %
+                        {u'm': marker})
+            bp._exec_ssh = Mock(side_effect=fake_exec)
+            self.assertListEqual(
+                bp._run_ssh_batch([u'echo foo; echo bar',
+                                   u'printf "no newline"', u'false',
+                                   u'echo never']),
+                [(0, u'foo\nbar'), (0, u'no newline'), (1, u''),
+                 (None, None)])
+            self.assertEqual(bp._exec_ssh.call_count, 1)
+            script = bp._exec_ssh.call_args[0][0]
+            self.assertIn(u'( echo foo; echo bar ) 2>&1; rc=$?', script)
+            self.assertIn(u'[ $rc -eq 0 ] || exit 0', script)
+            with self.assertRaises(RuntimeWarning):
+                bp._check_batch_results([(0, u''), (1, u'')])
+            with self.assertRaises(RuntimeWarning):
+                bp._check_batch_results([(0, u''), (None, None)])
     
-    def test_set_remote_chmod(self):
+    def test_exec_ssh_deadline(self):
+        "Check that a silent remote command is abandoned at its deadline"
+        import socket
         dummy_profile = {}
         with backup.BackupProfile(dummy_profile) as bp:
-            bp._run_ssh_command = Mock()
-            bp._set_remote_chmod(u'script.sh')
-            bp._run_ssh_command.assert_called_once_with(u'chmod +x script.sh')
+            chan = Mock()
+            chan.recv = Mock(side_effect=[u'Clone: 9% done.', socket.timeout,
+                                          socket.timeout, socket.timeout])
+            bp._get_ssh_session = Mock(return_value=chan)
+            bp._deadline = Mock()
+            bp._deadline.check = Mock(side_effect=[None, None,
+                watchdog.StageTimeout(u'Stage "remote_backup" timed out')])
+            with self.assertRaises(watchdog.StageTimeout):
+                bp._exec_ssh(u'/tmp/ghettovcb.sh -m DummyVM-1')
+            chan.settimeout.assert_called_once_with(bp._poll_interval)
+            self.assertEqual(chan.recv.call_count, 3)
+            chan.close.assert_called_once_with()
     
-    def test_remove_remote_file(self):
+    def test_timed_stage_timeout_cancels(self):
+        "Check that a timed out stage is cleaned up and re-raised"
         dummy_profile = {}
         with backup.BackupProfile(dummy_profile) as bp:
-            bp._run_ssh_command = Mock()
-            bp._remove_remote_file(u'/file/to/remove/me.tar.gz')
-            bp._run_ssh_command.assert_called_once_with(
-                u'rm /file/to/remove/me.tar.gz')
+            bp._close_ssh_transport = Mock()
+            cleanup = Mock()
+            run = {u'timings': dict(), u'timeouts': {u'archive': 60}}
+            with self.assertRaises(watchdog.StageTimeout):
+                with bp._timed_stage(run, u'archive', cleanup):
+                    self.assertEqual(bp._deadline.timeout, 60)
+                    raise watchdog.StageTimeout(u'Stage "archive" timed out')
+            cleanup.assert_called_once_with()
+            bp._close_ssh_transport.assert_called_once_with()
+            self.assertIsNone(bp._deadline)
+            self.assertIn(u'archive', run[u'timings'])
+            # Other errors don't trigger cleanup
+            with self.assertRaises(RuntimeError):
+                with bp._timed_stage(run, u'download', cleanup):
+                    self.assertEqual(bp._deadline.timeout, 12 * 60 * 60)
+                    raise RuntimeError(u'Tar command failed')
+            cleanup.assert_called_once_with()
+    
+    def test_cancel_remote_backup_keeps_other_snapshots(self):
+        "Check that a cancelled backup removes only the ghettovcb snapshot"
+        dummy_profile = {
+            u'remote_workdir':  u'/tmp',
+        }
+        with backup.BackupProfile(dummy_profile) as bp:
+            bp._run_ssh_batch = Mock(side_effect=[
+                [(0, u'')] * 4 + [(0,
+                    u'Vmid     Name          File                      '
+                    u'Guest OS       Version   Annotation\n'
+                    u'12     Dummy VM   [datastore1] Dummy VM/Dummy VM.vmx  '
+                    u'ubuntu64Guest   vmx-08\n')],
+                [(0,
+                  u'Get Snapshot:\n'
+                  u'|-ROOT\n'
+                  u'--Snapshot Name        : before upgrade\n'
+                  u'--Snapshot Id        : 3\n'
+                  u'--Snapshot Desciption  : \n'
+                  u'--|-CHILD\n'
+                  u'----Snapshot Name        : ghettoVCB-snapshot-2013-12-04\n'
+                  u'----Snapshot Id        : 4\n'
+                  u'----Snapshot Desciption  : ghettoVCB-snapshot-2013-12-04\n'
+                  )],
+                [(0, u'')]])
+            bp._cancel_remote_backup(u'Dummy VM')
+            self.assertEqual(bp._run_ssh_batch.call_count, 3)
+            self.assertEqual(bp._run_ssh_batch.call_args_list[0][0][0][-1],
+                             u'vim-cmd vmsvc/getallvms')
+            self.assertListEqual(bp._run_ssh_batch.call_args_list[1:], [
+                call([u'vim-cmd vmsvc/snapshot.get 12'], stop_on_error=False),
+                call([u'vim-cmd vmsvc/snapshot.remove 12 4'],
+                     stop_on_error=False)])
+    
+    def test_remove_remote_files(self):
+        dummy_profile = {}
+        with backup.BackupProfile(dummy_profile) as bp:
+            bp._run_ssh_batch = Mock(return_value=[(0, u''), (0, u'')])
+            bp._remove_remote_files([u'/file/to/remove/me.tar.gz',
+                                     u'/file/to/remove/me too.tar.gz'])
+            bp._run_ssh_batch.assert_called_once_with([
+                u'rm "/file/to/remove/me.tar.gz"',
+                u'rm "/file/to/remove/me too.tar.gz"'], stop_on_error=False)
     
     def test_parse_ghettovcb_output_no_vm(self):
         dummy_profile = {}
@@ -454,23 +635,24 @@ class BackupProfileTests(unittest.TestCase):
         with backup.BackupProfile(dummy_profile) as bp:
             bp._apply_template = Mock(return_value=u'/local/tmp/rndBla')
             bp._upload_file = Mock()
-            bp._set_remote_chmod = Mock()
             bp._remove_local_file = Mock()
-            bp._run_ssh_command = Mock(return_value=u'ghettovcb')
-            bp._remove_remote_file = Mock()
+            bp._run_ssh_batch = Mock(return_value=[
+                (0, u''), (0, u'ghettovcb'), (0, u'')])
             bp._parse_ghettovcb_output = Mock(return_value={u'OK': u'OK'})
             self.assertDictEqual({u'OK': u'OK'},
                                  bp._run_remote_backup(u'DummyVM-1'))
             bp._apply_template.assert_called_once_with(
                 u'/local/vmware/ghettovcb.sh.tmpl',
-                {u'RemoteBackupDir': u'/vmfs/volumes/Backup-LUN/BackupsDir'}
+                {u'RemoteBackupDir': u'/vmfs/volumes/Backup-LUN/BackupsDir',
+                 u'VmdkFilesToBackup': u'all'}
             )
             bp._upload_file.assert_called_once_with(u'/local/tmp/rndBla',
                                                     u'/tmp/ghettovcb.sh')
-            bp._set_remote_chmod.assert_called_once_with(u'/tmp/ghettovcb.sh')
             bp._remove_local_file.assert_called_once_with(u'/local/tmp/rndBla')
-            bp._run_ssh_command.assert_called_once_with(
-                u'/tmp/ghettovcb.sh -m DummyVM-1')
+            bp._run_ssh_batch.assert_called_once_with([
+                u'chmod +x /tmp/ghettovcb.sh',
+                u'/tmp/ghettovcb.sh -m DummyVM-1',
+                u'rm /tmp/ghettovcb.sh'], stop_on_error=False)
             bp._parse_ghettovcb_output.assert_called_once_with(u'ghettovcb')
     
     def test_backup_vm(self):
@@ -491,15 +673,181 @@ class BackupProfileTests(unittest.TestCase):
             bp._archive_remote_backup = Mock(return_value=
                 u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz')
             bp._download_archive = Mock(return_value=1.0)
-            bp._remove_remote_file = Mock()
-            bp.backup_vm(u'DummyVM-1')
+            bp._get_local_file_size = Mock(return_value=1024)
+            bp._remove_remote_files = Mock()
+            run = bp.backup_vm(u'DummyVM-1')
+            self.assertEqual(run[u'outcome'], u'ok')
+            self.assertEqual(run[u'archive_bytes'], 1024)
+            self.assertItemsEqual(run[u'timings'].keys(),
+                                  [u'remote_backup', u'archive', u'download'])
+            bp._get_local_file_size.assert_called_once_with(os.path.join(
+                u'/mnt/backups/ESXi-archives',
+                u'DummyVM-1-2013-12-04_08-03-34.tar.gz'))
             bp._run_remote_backup.assert_called_once_with(u'DummyVM-1')
             bp._archive_remote_backup.assert_called_once_with(u'DummyVM-1',
                 u'DummyVM-1-2013-12-04_08-03-34')
             bp._download_archive.assert_called_once_with(
                 u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz')
-            bp._remove_remote_file.assert_called_once_with(
-                u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz')
+            bp._remove_remote_files.assert_called_once_with([
+                u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz'])
+    
+    def test_run_remote_backup_selected_vmdks(self):
+        dummy_profile = {
+            u'ghettovcb_script_template': u'/local/vmware/ghettovcb.sh.tmpl',
+            u'remote_workdir':  u'/tmp',
+            u'remote_backup_dir': u'/vmfs/volumes/Backup-LUN/BackupsDir',
+            u'backup_vms':  {
+                u'DummyVM-1': {
+                    u'vmdk_files': [u'DummyVM-1.vmdk', u'DummyVM-1_1.vmdk'],
+                },
+            },
+        }
+        with backup.BackupProfile(dummy_profile) as bp:
+            bp._apply_template = Mock(return_value=u'/local/tmp/rndBla')
+            bp._upload_file = Mock()
+            bp._remove_local_file = Mock()
+            bp._run_ssh_batch = Mock(return_value=[
+                (0, u''), (0, u'ghettovcb'), (0, u'')])
+            bp._parse_ghettovcb_output = Mock(return_value={u'OK': u'OK'})
+            bp._run_remote_backup(u'DummyVM-1')
+            bp._apply_template.assert_called_once_with(
+                u'/local/vmware/ghettovcb.sh.tmpl',
+                {u'RemoteBackupDir': u'/vmfs/volumes/Backup-LUN/BackupsDir',
+                 u'VmdkFilesToBackup': u'DummyVM-1.vmdk,DummyVM-1_1.vmdk'}
+            )
+    
+    def test_group_disk_files(self):
+        "Check that backup dir files are grouped per disk, largest first"
+        dummy_profile = {
+            u'remote_backup_dir': u'/vmfs/volumes/Backup-LUN/BackupsDir',
+        }
+        with backup.BackupProfile(dummy_profile) as bp:
+            bp._run_ssh_batch = Mock(return_value=[(0,
+                u'total 1024\n'
+                u'-rw-------    1 root     root          3284 Dec  4 08:03 DummyVM-1.vmx\n'
+                u'-rw-------    1 root     root          512 Dec  4 08:03 DummyVM-1.vmdk\n'
+                u'-rw-------    1 root     root    8589934592 Dec  4 08:03 DummyVM-1-flat.vmdk\n'
+                u'-rw-------    1 root     root          512 Dec  4 08:03 DummyVM-1_1.vmdk\n'
+                u'-rw-------    1 root     root    10737418240 Dec  4 08:03 DummyVM-1_1-flat.vmdk')])
+            files = bp._list_remote_backup_files(u'DummyVM-1',
+                                                 u'DummyVM-1-2013-12-04_08-03-34')
+            bp._run_ssh_batch.assert_called_once_with([
+                u'ls -l "/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/'
+                u'DummyVM-1-2013-12-04_08-03-34"'])
+            self.assertEqual(len(files), 5)
+            self.assertListEqual(bp._group_disk_files(files), [
+                [u'DummyVM-1_1-flat.vmdk', u'DummyVM-1_1.vmdk'],
+                [u'DummyVM-1-flat.vmdk', u'DummyVM-1.vmdk'],
+                [u'DummyVM-1.vmx'],
+            ])
+    
+    def test_backup_vm_parallel_disks(self):
+        dummy_profile = {
+            u'backups_archive_dir': u'/mnt/backups/ESXi-archives',
+            u'backup_vms':  {
+                u'DummyVM-1': {
+                    u'parallel_disk_streams': 2,
+                },
+            },
+        }
+        remote_parts = [
+            u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.part0of2.tar.gz',
+            u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.part1of2.tar.gz',
+        ]
+        with backup.BackupProfile(dummy_profile) as bp:
+            bp._run_remote_backup = Mock(return_value={
+                u'FINAL_STATUS': True,
+                u'VM_BACKUP_DIR_NAMING_CONVENTION': u'2013-12-04_08-03-34',
+            })
+            bp._archive_remote_disks = Mock(return_value=remote_parts)
+            bp._download_disk_archives = Mock(return_value=1.0)
+            bp._get_local_file_size = Mock(return_value=1024)
+            bp._run_ssh_batch = Mock(return_value=[(0, u''), (0, u'')])
+            run = bp.backup_vm(u'DummyVM-1')
+            self.assertEqual(run[u'outcome'], u'ok')
+            self.assertEqual(run[u'archive_bytes'], 2048)
+            bp._archive_remote_disks.assert_called_once_with(u'DummyVM-1',
+                u'DummyVM-1-2013-12-04_08-03-34', 2)
+            bp._download_disk_archives.assert_called_once_with(remote_parts,
+                                                               2)
+            bp._run_ssh_batch.assert_called_once_with(
+                [u'rm "%s"' % (p) for p in remote_parts], stop_on_error=False)
+    
+    def test_download_disk_archives(self):
+        "Check that part archives are stored as they are, once all arrived"
+        import shutil
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        remote_parts = [
+            u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.part0of2.tar.gz',
+            u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.part1of2.tar.gz',
+        ]
+        try:
+            with backup.BackupProfile({u'backups_archive_dir': tmp_dir}) as bp:
+                def download(remote_path, dest_dir):
+                    self.assertListEqual(glob(os.path.join(tmp_dir, u'*')),
+                                         [])
+                    with open(os.path.join(dest_dir, os.path.split(
+                            remote_path)[1]), 'wb') as part_file:
+                        part_file.write(b'part')
+                bp._download_archive = Mock(side_effect=download)
+                bp._download_disk_archives(remote_parts, 2)
+                self.assertItemsEqual(os.listdir(tmp_dir), [
+                    u'.staging',
+                    u'DummyVM-1-2013-12-04_08-03-34.part0of2.tar.gz',
+                    u'DummyVM-1-2013-12-04_08-03-34.part1of2.tar.gz'])
+                self.assertListEqual(os.listdir(bp._get_staging_dir()), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_group_backups(self):
+        "Check that part archives are grouped into (complete) backups"
+        self.assertListEqual(backup.BackupProfile._group_backups([
+            u'/b/DummyVM-1-2013-12-08_01-23-45.part1of2.tar.gz',
+            u'/b/DummyVM-1-2013-12-01_01-23-45.tar.gz',
+            u'/b/DummyVM-1-2013-12-08_01-23-45.part0of2.tar.xz',
+            u'/b/DummyVM-1-2013-12-15_01-23-45.part0of2.tar.gz',
+        ]), [
+            (u'DummyVM-1-2013-12-01_01-23-45',
+             [u'/b/DummyVM-1-2013-12-01_01-23-45.tar.gz'], True),
+            (u'DummyVM-1-2013-12-08_01-23-45',
+             [u'/b/DummyVM-1-2013-12-08_01-23-45.part0of2.tar.xz',
+              u'/b/DummyVM-1-2013-12-08_01-23-45.part1of2.tar.gz'], True),
+            (u'DummyVM-1-2013-12-15_01-23-45',
+             [u'/b/DummyVM-1-2013-12-15_01-23-45.part0of2.tar.gz'], False),
+        ])
+    
+    def test_trim_part_archives(self):
+        "Check that backups made of part archives are trimmed as a whole"
+        archives = [
+            u'/mnt/backups/DummyVM-1-2013-11-01_01-23-45.part0of2.tar.gz',
+            u'/mnt/backups/DummyVM-1-2013-11-01_01-23-45.part1of2.tar.gz',
+            u'/mnt/backups/DummyVM-1-2013-12-01_01-23-45.part0of2.tar.gz',
+            u'/mnt/backups/DummyVM-1-2013-12-01_01-23-45.part1of2.tar.gz',
+            u'/mnt/backups/DummyVM-1-2013-12-08_01-23-45.part0of2.tar.gz',
+        ]
+        dummy_profile = {
+            u'backups_archive_dir': u'/mnt/backups',
+            u'backup_vms':  {
+                u'DummyVM-1': {
+                    u'rotation_count': 1,
+                },
+            },
+        }
+        with nested(
+                patch(__name__ + '.backup.glob', return_value=archives),
+                patch(__name__ + '.backup.tiering.catalog_lock'),
+            ):
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._get_corrupt_archives = Mock(return_value=set())
+                from datetime import datetime
+                self.assertDictEqual(bp.get_latest_archives(), {
+                    u'DummyVM-1': datetime(2013,12,1,1,23,45)})
+                bp._remove_local_file = Mock()
+                bp.trim_backup_archives()
+                self.assertItemsEqual(bp._remove_local_file.call_args_list,
+                                      [call(path) for path in
+                                       archives[:2] + archives[4:]])
     
     def test_archive_remote_backup(self):
         dummy_profile = {
@@ -509,14 +857,14 @@ class BackupProfileTests(unittest.TestCase):
             },
         }
         with backup.BackupProfile(dummy_profile) as bp:
-            bp._run_ssh_command = Mock(return_value=u'')
+            bp._run_ssh_batch = Mock(return_value=[(0, u'')])
             self.assertEqual(u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz',
                 bp._archive_remote_backup(u'DummyVM-1',
                 u'DummyVM-1-2013-12-04_08-03-34'))
-            bp._run_ssh_command.assert_called_once_with(
+            bp._run_ssh_batch.assert_called_once_with([
                 u'cd "/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1"; '
                 u'tar -cz -f "DummyVM-1-2013-12-04_08-03-34.tar.gz" '
-                u'"DummyVM-1-2013-12-04_08-03-34"')
+                u'"DummyVM-1-2013-12-04_08-03-34"'])
     
     def test_archive_remote_backup_error(self):
         dummy_profile = {
@@ -526,17 +874,18 @@ class BackupProfileTests(unittest.TestCase):
             },
         }
         with backup.BackupProfile(dummy_profile) as bp:
-            bp._run_ssh_command = Mock(return_value=u'No such file or directory')
+            bp._run_ssh_batch = Mock(return_value=[
+                (1, u'No such file or directory')])
             with self.assertRaises(RuntimeError) as cm:
                 self.assertEqual(u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz',
                     bp._archive_remote_backup(u'DummyVM-1',
                     u'DummyVM-1-2013-12-04_08-03-34'))
                 self.assertEqual(cm.exception.message,
                     u'Tar command failed:\nNo such file or directory')
-            bp._run_ssh_command.assert_called_once_with(
+            bp._run_ssh_batch.assert_called_once_with([
                 u'cd "/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1"; '
                 u'tar -cz -f "DummyVM-1-2013-12-04_08-03-34.tar.gz" '
-                u'"DummyVM-1-2013-12-04_08-03-34"')
+                u'"DummyVM-1-2013-12-04_08-03-34"'])
     
     def test_download_archive(self):
         dummy_profile = {
@@ -551,19 +900,1301 @@ class BackupProfileTests(unittest.TestCase):
         with nested(
                 patch('__builtin__.open', create=True),
                 patch(__name__ + '.backup.FTP', return_value=Mock()),
-            ) as (mock_open, mock_ftp):
+                patch(__name__ + '.backup.os.rename'),
+            ) as (mock_open, mock_ftp, mock_rename):
             mock_open.return_value = MagicMock(spec=file)
             with backup.BackupProfile(dummy_profile) as bp:
                 self.assertIsInstance(
                     bp._download_archive(u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz'),
                     float)
             mock_open.assert_called_once_with(
-                os.path.join(u'/mnt/backups/ESXi-archives', u'DummyVM-1-2013-12-04_08-03-34.tar.gz'),
+                os.path.join(u'/mnt/backups/ESXi-archives', u'DummyVM-1-2013-12-04_08-03-34.tar.gz.part'),
                 'wb')
+            mock_rename.assert_called_once_with(
+                os.path.join(u'/mnt/backups/ESXi-archives', u'DummyVM-1-2013-12-04_08-03-34.tar.gz.part'),
+                os.path.join(u'/mnt/backups/ESXi-archives', u'DummyVM-1-2013-12-04_08-03-34.tar.gz'))
             mock_file = mock_open.return_value.__enter__.return_value
-            mock_ftp.assert_called_once_with(u'10.0.0.20')
+            mock_ftp.assert_called_once_with(u'10.0.0.20', timeout=300)
             mock_ftp.return_value.login.assert_called_once_with(
                 u'dummy', u'dummypass')
-            mock_ftp.return_value.retrbinary.assert_called_once_with(
-                u'RETR /vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz',
-                mock_file.write)
+            self.assertEqual(mock_ftp.return_value.retrbinary.call_count, 1)
+            cmd, callback = mock_ftp.return_value.retrbinary.call_args[0]
+            self.assertEqual(cmd,
+                u'RETR /vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/DummyVM-1-2013-12-04_08-03-34.tar.gz')
+            callback(b'data')
+            mock_file.write.assert_called_once_with(b'data')
+            mock_ftp.return_value.close.assert_called_once_with()
+    
+    def test_list_backup_archives_skips_corrupt(self):
+        "Check that archives that failed verification are not listed"
+        dummy_profile = {
+            u'backups_archive_dir': u'/mnt/backups/ESXi-archives',
+        }
+        with patch(__name__ + '.backup.glob', return_value=[
+                u'/mnt/backups/ESXi-archives/DummyVM-1-2013-12-01_01-23-45.tar.gz',
+                u'/mnt/backups/ESXi-archives/DummyVM-1-2013-12-08_01-23-45.tar.gz',
+            ]):
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._get_corrupt_archives = Mock(return_value=set([
+                    u'DummyVM-1-2013-12-08_01-23-45.tar.gz']))
+                self.assertListEqual(
+                    bp._list_backup_archives_for_vm(u'DummyVM-1'),
+                    [u'/mnt/backups/ESXi-archives/DummyVM-1-2013-12-01_01-23-45.tar.gz'])
+                self.assertEqual(len(bp._list_backup_archives(
+                    include_corrupt=True)), 2)
+
+class IntegrityTests(unittest.TestCase):
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.archive_dir = mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.archive_dir)
+    
+    def _make_archive(self, name, payload):
+        import tarfile
+        src_path = os.path.join(self.archive_dir, u'disk-flat.vmdk')
+        with open(src_path, 'wb') as src_file:
+            src_file.write(payload)
+        archive_path = os.path.join(self.archive_dir, name)
+        tar = tarfile.open(archive_path, 'w:gz')
+        tar.add(src_path, arcname=u'DummyVM-1/disk-flat.vmdk')
+        tar.close()
+        os.remove(src_path)
+        return archive_path
+    
+    def test_check_archive_ok(self):
+        import hashlib
+        archive_path = self._make_archive(
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz',
+            os.urandom(1024 * 100) + b'\0' * (1024 * 1024 * 3))
+        entry = integrity.check_archive(archive_path)
+        self.assertTrue(entry[u'ok'])
+        with open(archive_path, 'rb') as archive_file:
+            self.assertEqual(entry[u'sha256'],
+                             hashlib.sha256(archive_file.read()).hexdigest())
+    
+    def test_check_archive_truncated(self):
+        archive_path = self._make_archive(
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz', os.urandom(1024 * 100))
+        with open(archive_path, 'r+b') as archive_file:
+            archive_file.truncate(os.path.getsize(archive_path) - 4)
+        entry = integrity.check_archive(archive_path)
+        self.assertFalse(entry[u'ok'])
+    
+    def test_check_archive_corrupt_data(self):
+        archive_path = self._make_archive(
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz', b'A' * (1024 * 100))
+        size = os.path.getsize(archive_path)
+        with open(archive_path, 'r+b') as archive_file:
+            archive_file.seek(size // 2)
+            archive_file.write(b'\xff\xff\xff\xff')
+        entry = integrity.check_archive(archive_path)
+        self.assertFalse(entry[u'ok'])
+    
+    def test_verify_archives_only_new_or_changed(self):
+        archive_1 = self._make_archive(
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz', os.urandom(1024))
+        archive_2 = self._make_archive(
+            u'DummyVM-1-2013-12-08_01-23-45.tar.gz', os.urandom(1024))
+        verified = integrity.verify_archives(self.archive_dir,
+                                             [archive_1, archive_2], 2)
+        self.assertItemsEqual(verified.keys(), [
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz',
+            u'DummyVM-1-2013-12-08_01-23-45.tar.gz'])
+        # Nothing changed - nothing to verify
+        self.assertDictEqual(integrity.verify_archives(
+            self.archive_dir, [archive_1, archive_2], 2), {})
+        # Corrupt one of the archives
+        with open(archive_2, 'r+b') as archive_file:
+            archive_file.truncate(100)
+        verified = integrity.verify_archives(self.archive_dir,
+                                             [archive_1, archive_2], 2)
+        self.assertItemsEqual(verified.keys(), [
+            u'DummyVM-1-2013-12-08_01-23-45.tar.gz'])
+        self.assertFalse(integrity.load_manifest(self.archive_dir)[
+            u'DummyVM-1-2013-12-08_01-23-45.tar.gz'][u'ok'])
+    
+    def test_check_archive_read_error(self):
+        "Check that I/O errors leave archives unverified, not corrupt"
+        import errno
+        archive_path = self._make_archive(
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz', os.urandom(1024))
+        with patch(__name__ + '.integrity.open', create=True,
+                   side_effect=IOError(errno.EIO, u'Input/output error')):
+            entry = integrity.check_archive(archive_path)
+        self.assertIsNone(entry[u'ok'])
+        integrity.save_manifest(self.archive_dir, {
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz': entry})
+        # Unverified archives are checked again
+        verified = integrity.verify_archives(self.archive_dir,
+                                             [archive_path], 1)
+        self.assertTrue(verified[u'DummyVM-1-2013-12-01_01-23-45.tar.gz'][
+            u'ok'])
+    
+    def test_verify_archives_merges_concurrent_results(self):
+        "Check that results saved by a concurrent verification are kept"
+        archive_path = self._make_archive(
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz', os.urandom(1024))
+        def imap_unordered(job, archive_paths):
+            integrity.save_manifest(self.archive_dir, {
+                u'DummyVM-2-2013-12-01_01-23-45.tar.gz': {u'ok': False}})
+            return map(job, archive_paths)
+        with patch(__name__ + '.integrity.Pool') as pool:
+            pool.return_value.imap_unordered.side_effect = imap_unordered
+            integrity.verify_archives(self.archive_dir, [archive_path], 1)
+        manifest = integrity.load_manifest(self.archive_dir)
+        self.assertFalse(
+            manifest[u'DummyVM-2-2013-12-01_01-23-45.tar.gz'][u'ok'])
+        self.assertTrue(
+            manifest[u'DummyVM-1-2013-12-01_01-23-45.tar.gz'][u'ok'])
+    
+    def test_verify_archives_skips_removed(self):
+        "Check that archives removed since listed are skipped, not fatal"
+        archive_1 = self._make_archive(
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz', os.urandom(1024))
+        archive_2 = self._make_archive(
+            u'DummyVM-1-2013-12-08_01-23-45.tar.gz', os.urandom(1024))
+        archive_3 = os.path.join(self.archive_dir,
+                                 u'DummyVM-1-2013-12-15_01-23-45.tar.gz')
+        integrity.verify_archives(self.archive_dir, [archive_1, archive_2], 1)
+        os.remove(archive_2)
+        self.assertIsNone(integrity.check_archive(archive_2))
+        verified = integrity.verify_archives(
+            self.archive_dir, [archive_1, archive_2, archive_3], 1)
+        self.assertDictEqual(verified, {})
+        self.assertItemsEqual(integrity.load_manifest(self.archive_dir).keys(),
+                              [u'DummyVM-1-2013-12-01_01-23-45.tar.gz'])
+
+class ProfilesTests(unittest.TestCase):
+    def _profile_dict(self, **overrides):
+        from datetime import time
+        profile_dict = {
+            u'host_ip':         u'10.0.0.20',
+            u'ssh_port':        22,
+            u'ssh_user':        u'root',
+            u'ssh_password':    u'password',
+            u'ftp_user':        u'root',
+            u'ftp_password':    u'password',
+            u'backup_times':    ( (time(23,00,00), time.max), ),
+            u'ghettovcb_script_template': u'/local/vmware/ghettovcb.sh.tmpl',
+            u'remote_workdir':  u'/tmp',
+            u'remote_backup_dir': u'/vmfs/volumes/Backup-LUN/BackupsDir',
+            u'backups_archive_dir': u'/mnt/backups/ESXi-archives',
+            u'email_report':    False,
+            u'backup_vms':  {
+                u'DummyVM-1': {},
+                u'DummyVM-2': {
+                    u'period': timedelta(1),
+                },
+            },
+            u'default_vm_config': {
+                u'period': timedelta(7),
+                u'rotation_count': 3,
+            },
+        }
+        profile_dict.update(overrides)
+        return profile_dict
+    
+    def test_vm_config_resolution(self):
+        "Check that per-VM settings are resolved against the defaults"
+        profile = profiles.Profile(self._profile_dict(), u'Dummy').validate()
+        self.assertEqual(profile.backup_vms[u'DummyVM-1'].period,
+                         timedelta(7))
+        self.assertEqual(profile.backup_vms[u'DummyVM-2'].period,
+                         timedelta(1))
+        self.assertEqual(profile.backup_vms[u'DummyVM-2'].rotation_count, 3)
+        with backup.BackupProfile(profile) as bp:
+            self.assertEqual(bp._get_vm_config(u'DummyVM-2', u'period'),
+                             timedelta(1))
+    
+    def test_validation_errors(self):
+        "Check that bad settings are reported when the profile is loaded"
+        bad_profiles = [
+            (self._profile_dict(ssh_port=u'22'),
+             u'Profile "Dummy": bad setting "ssh_port" '
+             u'(expected a TCP port number)'),
+            (self._profile_dict(backup_vms={u'DummyVM-1': {u'period': 7j}}),
+             u'Profile "Dummy": VM "DummyVM-1": bad setting "period" '
+             u'(expected a timedelta or a number of days)'),
+            (self._profile_dict(default_vm_config={u'period': timedelta(7)}),
+             u'Profile "Dummy": VM "DummyVM-1": missing setting '
+             u'"rotation_count"'),
+            (self._profile_dict(email_report=True),
+             u'Profile "Dummy": missing setting "from_field"'),
+            (self._profile_dict(notify_sinks={
+                u'hook': {u'type': u'webhook'}}),
+             u'Profile "Dummy": bad setting "notify_sinks" '
+             u'(sink "hook": missing "url")'),
+        ]
+        for profile_dict, message in bad_profiles:
+            with self.assertRaises(profiles.ProfileError) as cm:
+                profiles.Profile(profile_dict, u'Dummy').validate()
+            self.assertEqual(cm.exception.message, message)
+        with self.assertRaises(profiles.ProfileError) as cm:
+            profiles.Profile(self._profile_dict(no_such_setting=1))
+        self.assertEqual(cm.exception.message,
+                         u'Unknown profile setting "no_such_setting"')
+    
+    def test_load_json_profiles_cached(self):
+        "Check JSON profile coercion and caching by file modification time"
+        import json
+        from tempfile import mkstemp
+        from datetime import time
+        profile_dict = self._profile_dict(
+            backup_times=[[u'23:00', u'max'], [u'00:00', u'04:00:00']],
+            backup_vms={u'DummyVM-1': {u'period': 1}},
+            default_vm_config={u'rotation_count': 2})
+        f, path = mkstemp(suffix=u'.json')
+        os.close(f)
+        try:
+            with open(path, 'w') as profiles_file:
+                json.dump({u'Dummy': profile_dict}, profiles_file)
+            loaded = profiles.load_profiles(path)
+            profile = loaded[u'Dummy']
+            self.assertEqual(profile.backup_times, (
+                (time(23,0,0), time.max), (time(0,0,0), time(4,0,0))))
+            self.assertEqual(profile.backup_vms[u'DummyVM-1'].period,
+                             timedelta(1))
+            self.assertIs(profiles.load_profiles(path), loaded)
+            os.utime(path, (0, 0))
+            self.assertIsNot(profiles.load_profiles(path), loaded)
+        finally:
+            os.remove(path)
+
+class HistoryTests(unittest.TestCase):
+    def setUp(self):
+        from datetime import datetime
+        self.run_history = history.RunHistory(u':memory:')
+        for day, vm, total_time, outcome in [
+                (1, u'DummyVM-1', 100.0, u'ok'),
+                (2, u'DummyVM-1', 200.0, u'ok'),
+                (3, u'DummyVM-1', 300.0, u'ok'),
+                (4, u'DummyVM-1', 400.0, u'failed'),
+                (35, u'DummyVM-1', 900.0, u'ok'),
+                (1, u'DummyVM-2', 50.0, u'ok'),
+            ]:
+            self.run_history.record_run({
+                u'profile': u'Dummy',
+                u'vm': vm,
+                u'host': u'10.0.0.20',
+                u'started_at': datetime(2013,11,1) + timedelta(day),
+                u'outcome': outcome,
+                u'timings': {u'download': total_time / 2},
+                u'total_time': total_time,
+                u'archive_bytes': 1024 * 1024 * total_time,
+                u'config': {
+                    u'VERSION': u'2013_01_11_0',
+                    u'WARNINGS': [u'Independent VMDK'],
+                },
+            })
+    
+    def tearDown(self):
+        self.run_history.close()
+    
+    def test_duration_percentiles(self):
+        from datetime import datetime
+        self.assertDictEqual(
+            self.run_history.get_duration_percentiles(datetime(2013,11,1)),
+            {u'DummyVM-1': {50: 200.0, 90: 900.0, 95: 900.0},
+             u'DummyVM-2': {50: 50.0, 90: 50.0, 95: 50.0}})
+        self.assertDictEqual(
+            self.run_history.get_duration_percentiles(datetime(2013,12,1),
+                                                      (50,)),
+            {u'DummyVM-1': {50: 900.0}})
+    
+    def test_monthly_trends(self):
+        from datetime import datetime
+        self.assertListEqual(
+            self.run_history.get_monthly_trends(datetime(2013,11,1)),
+            [(u'DummyVM-1', u'2013-11', 3, 200.0, 1024 * 1024 * 600),
+             (u'DummyVM-1', u'2013-12', 1, 900.0, 1024 * 1024 * 900),
+             (u'DummyVM-2', u'2013-11', 1, 50.0, 1024 * 1024 * 50)])
+        report = history.format_report(self.run_history, datetime(2013,11,1))
+        self.assertIn(u'DummyVM-1 2013-12: 1 runs, avg 900 seconds', report)
+        self.assertIn(u'4.5x slower', report)
+        self.assertIn(u'10.0.0.20: 2.00 MB/s', report)
+    
+    def test_stage_percentile(self):
+        self.assertEqual(self.run_history.get_stage_percentile(
+            u'DummyVM-1', u'download', 95), 450.0)
+        self.assertIsNone(self.run_history.get_stage_percentile(
+            u'NoSuchVM', u'download', 95))
+        with self.assertRaises(ValueError):
+            self.run_history.get_stage_percentile(u'DummyVM-1', u'bla', 95)
+    
+    def test_host_throughput(self):
+        from datetime import datetime
+        self.assertDictEqual(
+            self.run_history.get_host_throughput(datetime(2013,11,1)),
+            {u'10.0.0.20': 2.0 * 1024 * 1024})
+
+class WatchdogTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        watchdog.Deadline._clock = staticmethod(lambda: self.now)
+        watchdog.TransferMonitor._clock = staticmethod(lambda: self.now)
+    
+    def tearDown(self):
+        import time
+        watchdog.Deadline._clock = staticmethod(time.time)
+        watchdog.TransferMonitor._clock = staticmethod(time.time)
+    
+    def test_get_timeout(self):
+        self.assertEqual(watchdog.get_timeout(None, 3, 600, 3600), 3600)
+        self.assertEqual(watchdog.get_timeout(100, 3, 600, 3600), 600)
+        self.assertEqual(watchdog.get_timeout(1000, 3, 600, 3600), 3000)
+        self.assertEqual(watchdog.get_timeout(5000, 3, 600, 3600), 3600)
+    
+    def test_deadline(self):
+        deadline = watchdog.Deadline(u'download', 60)
+        self.now += 59
+        deadline.check()
+        self.assertEqual(deadline.remaining(), 1)
+        self.now += 1
+        with self.assertRaises(watchdog.StageTimeout) as cm:
+            deadline.check()
+        self.assertEqual(cm.exception.message,
+                         u'Stage "download" timed out after 60 seconds')
+    
+    def test_transfer_monitor_stall(self):
+        monitor = watchdog.TransferMonitor(
+            watchdog.Deadline(u'download', 3600), 300)
+        for _ in range(10):
+            self.now += 299
+            monitor.update(1024)
+        self.now += 299
+        monitor.update(0)
+        self.now += 1
+        with self.assertRaises(watchdog.StageTimeout) as cm:
+            monitor.update(0)
+        self.assertEqual(cm.exception.message,
+                         u'Transfer stalled after 10240 bytes')
+
+class TieringTests(unittest.TestCase):
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.hot_dir = mkdtemp()
+        self.cold_dir = mkdtemp()
+        self.dummy_profile = {
+            u'backups_archive_dir': self.hot_dir,
+            u'cold_storage': {u'type': u'directory', u'path': self.cold_dir},
+            u'hot_archive_count': 1,
+            u'backup_vms':  {
+                u'DummyVM-1': {
+                    u'rotation_count': 2,
+                },
+            },
+        }
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.hot_dir)
+        shutil.rmtree(self.cold_dir)
+    
+    def _make_archive(self, name, size=1024, corrupt=False):
+        import tarfile
+        from io import BytesIO
+        archive_path = os.path.join(self.hot_dir, name)
+        if corrupt:
+            with open(archive_path, 'wb') as archive_file:
+                archive_file.write(os.urandom(size))
+            return archive_path
+        data = os.urandom(size)
+        info = tarfile.TarInfo(u'DummyVM-1/disk-flat.vmdk')
+        info.size = len(data)
+        tar = tarfile.open(archive_path, 'w:gz')
+        tar.addfile(info, BytesIO(data))
+        tar.close()
+        return archive_path
+    
+    def test_directory_target_parallel_copy(self):
+        archive_path = self._make_archive(u'DummyVM-1-2013-12-01_01-23-45.tar.gz',
+                                          1024 * 10 + 7)
+        target = tiering.DirectoryTarget({u'path': self.cold_dir}, 3)
+        with patch(__name__ + '.tiering.PART_SIZE', 1024):
+            location = target.upload(archive_path,
+                                     u'DummyVM-1-2013-12-01_01-23-45.tar.gz')
+        self.assertEqual(location, os.path.join(
+            self.cold_dir, u'DummyVM-1-2013-12-01_01-23-45.tar.gz'))
+        with open(archive_path, 'rb') as src, open(location, 'rb') as dst:
+            self.assertEqual(src.read(), dst.read())
+        self.assertListEqual(os.listdir(self.cold_dir),
+                             [u'DummyVM-1-2013-12-01_01-23-45.tar.gz'])
+    
+    def test_offload_list_and_trim(self):
+        "Check offloaded archives are cataloged, listed and trimmed"
+        for ts in (u'2013-11-01_01-23-45', u'2013-12-01_01-23-45',
+                   u'2013-12-08_01-23-45'):
+            self._make_archive(u'DummyVM-1-%s.tar.gz' % (ts))
+        with backup.BackupProfile(self.dummy_profile) as bp:
+            self.assertEqual(len(bp.offload_archives()), 2)
+            self.assertItemsEqual(
+                [name for name in os.listdir(self.hot_dir)
+                 if name.endswith(u'.tar.gz')],
+                [u'DummyVM-1-2013-12-08_01-23-45.tar.gz'])
+            self.assertItemsEqual(tiering.load_catalog(self.hot_dir).keys(), [
+                u'DummyVM-1-2013-11-01_01-23-45.tar.gz',
+                u'DummyVM-1-2013-12-01_01-23-45.tar.gz'])
+            self.assertEqual(len(bp._list_backup_archives_for_vm(
+                u'DummyVM-1')), 3)
+            from datetime import datetime
+            self.assertDictEqual(bp.get_latest_archives(), {
+                u'DummyVM-1': datetime(2013,12,8,1,23,45)})
+            bp.trim_backup_archives()
+            self.assertListEqual(os.listdir(self.cold_dir),
+                                 [u'DummyVM-1-2013-12-01_01-23-45.tar.gz'])
+            self.assertItemsEqual(tiering.load_catalog(self.hot_dir).keys(), [
+                u'DummyVM-1-2013-12-01_01-23-45.tar.gz'])
+    
+    def test_offload_archive_trimmed_meanwhile(self):
+        "Check that an archive deleted while being copied is not cataloged"
+        archive_path = self._make_archive(
+            u'DummyVM-1-2013-11-01_01-23-45.tar.gz')
+        target = tiering.DirectoryTarget({u'path': self.cold_dir}, 1)
+        upload = target.upload
+        def upload_and_trim(local_path, name):
+            location = upload(local_path, name)
+            os.remove(local_path)
+            return location
+        target.upload = upload_and_trim
+        self.assertIsNone(tiering.offload_archive(self.hot_dir, target,
+                                                  archive_path))
+        self.assertListEqual(os.listdir(self.cold_dir), [])
+        self.assertDictEqual(tiering.load_catalog(self.hot_dir), {})
+    
+    def test_verify_skips_offloaded(self):
+        "Check that offloaded archives are not verified in place"
+        for ts in (u'2013-12-01_01-23-45', u'2013-12-08_01-23-45'):
+            self._make_archive(u'DummyVM-1-%s.tar.gz' % (ts))
+        with backup.BackupProfile(self.dummy_profile) as bp:
+            location, = bp.offload_archives(processes=1)
+            with open(location, 'wb') as cold_file:
+                cold_file.write(b'not verified')
+            self.assertListEqual(bp.verify_archives(processes=1), [])
+    
+    def test_offload_skips_corrupt(self):
+        "Check that corrupt archives stay hot (and get trimmed)"
+        self._make_archive(u'DummyVM-1-2013-11-01_01-23-45.tar.gz',
+                           corrupt=True)
+        for ts in (u'2013-12-01_01-23-45', u'2013-12-08_01-23-45'):
+            self._make_archive(u'DummyVM-1-%s.tar.gz' % (ts))
+        with backup.BackupProfile(self.dummy_profile) as bp:
+            self.assertListEqual(bp.offload_archives(processes=1), [
+                os.path.join(self.cold_dir,
+                             u'DummyVM-1-2013-12-01_01-23-45.tar.gz')])
+            self.assertEqual(len(bp._list_backup_archives_for_vm(
+                u'DummyVM-1')), 2)
+            bp.trim_backup_archives()
+            self.assertItemsEqual(
+                [name for name in os.listdir(self.hot_dir)
+                 if name.endswith(u'.tar.gz')],
+                [u'DummyVM-1-2013-12-08_01-23-45.tar.gz'])
+            self.assertListEqual(os.listdir(self.cold_dir),
+                                 [u'DummyVM-1-2013-12-01_01-23-45.tar.gz'])
+    
+    def test_trim_archive_offloaded_meanwhile(self):
+        "Check that trimming follows an archive offloaded since listed"
+        archive_path = self._make_archive(
+            u'DummyVM-1-2013-11-01_01-23-45.tar.gz')
+        for ts in (u'2013-12-01_01-23-45', u'2013-12-08_01-23-45'):
+            self._make_archive(u'DummyVM-1-%s.tar.gz' % (ts))
+        with backup.BackupProfile(self.dummy_profile) as bp:
+            list_archives = bp._list_backup_archives_for_vm
+            def list_and_offload(*args, **kwargs):
+                archive_paths = list_archives(*args, **kwargs)
+                if os.path.isfile(archive_path):
+                    tiering.offload_archive(
+                        self.hot_dir, bp._get_cold_target(), archive_path)
+                return archive_paths
+            bp._list_backup_archives_for_vm = list_and_offload
+            bp.trim_backup_archives()
+            self.assertListEqual(os.listdir(self.cold_dir), [])
+            self.assertDictEqual(tiering.load_catalog(self.hot_dir), {})
+            self.assertEqual(len(bp._list_backup_archives_for_vm(
+                u'DummyVM-1')), 2)
+
+class NativeEngineTests(unittest.TestCase):
+    dummy_profile = {
+        u'remote_workdir':  u'/tmp',
+        u'backups_archive_dir': u'/mnt/backups/ESXi-archives',
+        u'extent_stream_script': u'/local/vmware/extentstream.py',
+        u'backup_vms':  {
+            u'DummyVM-1': {
+                u'engine': u'native',
+                u'vmdk_files': [u'DummyVM-1.vmdk'],
+            },
+        },
+    }
+    
+    def test_extent_stream_round_trip(self):
+        "Check that extent streams skip zero blocks and restore sparse files"
+        import imp
+        import shutil
+        from io import BytesIO
+        from tempfile import mkdtemp
+        import extents
+        extentstream = imp.load_source('extentstream', os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), os.pardir,
+            u'vmware', u'extentstream.py'))
+        block = extentstream.BLOCK_SIZE
+        data = (b'\0' * block * 3 + os.urandom(block * 20) + b'\0' * block +
+                b'tail' + b'\0' * 100)
+        tmp_dir = mkdtemp()
+        try:
+            src_path = os.path.join(tmp_dir, u'DummyVM-1-flat.vmdk')
+            with open(src_path, 'wb') as src_file:
+                src_file.write(data)
+            stream = BytesIO()
+            extentstream.write_extents(src_path, stream)
+            stream.seek(0)
+            dest_path = os.path.join(tmp_dir, u'restored.vmdk')
+            with open(dest_path, 'wb') as dest_file:
+                size, received = extents.read_extent_stream(stream.read,
+                                                            dest_file)
+            self.assertEqual(size, len(data))
+            self.assertEqual(received, block * 20 + 104)
+            with open(dest_path, 'rb') as dest_file:
+                self.assertEqual(dest_file.read(), data)
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_bad_extent_stream(self):
+        import extents
+        from io import BytesIO
+        with self.assertRaises(extents.ExtentStreamError):
+            extents.read_extent_stream(BytesIO(b'\0' * 16).read, BytesIO())
+    
+    def test_parse_remote_vm(self):
+        with backup.BackupProfile(self.dummy_profile) as bp:
+            bp._run_ssh_batch = Mock(return_value=[(0,
+                u'Vmid     Name          File                                '
+                u'Guest OS       Version   Annotation\n'
+                u'1      DummyVM-1    [datastore1] DummyVM-1/DummyVM-1.vmx   '
+                u'ubuntu64Guest   vmx-08\n'
+                u'12     Dummy VM 2   [datastore 2] Dummy VM 2/Dummy VM 2.vmx  '
+                u'winNetStandardGuest   vmx-08\n')])
+            self.assertTupleEqual(bp._get_remote_vm(u'Dummy VM 2'), (
+                u'12', u'/vmfs/volumes/datastore 2/Dummy VM 2/Dummy VM 2.vmx'))
+            with self.assertRaises(RuntimeError):
+                bp._get_remote_vm(u'DummyVM-3')
+    
+    def test_parse_vmx_and_descriptor(self):
+        self.assertListEqual(backup.BackupProfile._parse_vmx_disks(
+            u'displayName = "DummyVM-1"\n'
+            u'scsi0:0.present = "TRUE"\n'
+            u'scsi0:0.fileName = "DummyVM-1.vmdk"\n'
+            u'scsi0:1.fileName = "/vmfs/volumes/datastore2/DummyVM-1_1.vmdk"\n'
+            u'scsi0:1.mode = "independent-persistent"\n'
+            u'ide1:0.fileName = "/vmimages/tools-isoimages/linux.iso"\n'), [
+            (u'scsi0:0', u'DummyVM-1.vmdk', u'persistent'),
+            (u'scsi0:1', u'/vmfs/volumes/datastore2/DummyVM-1_1.vmdk',
+             u'independent-persistent'),
+        ])
+        self.assertListEqual(backup.BackupProfile._parse_descriptor_extents(
+            u'# Disk DescriptorFile\n'
+            u'createType="vmfs"\n'
+            u'# Extent description\n'
+            u'RW 16777216 VMFS "DummyVM-1-flat.vmdk"\n'),
+            [u'DummyVM-1-flat.vmdk'])
+    
+    def test_prepare_native_backup_refuses_snapshots(self):
+        with backup.BackupProfile(self.dummy_profile) as bp:
+            bp._run_ssh_batch = Mock(return_value=[
+                (0, u'Get Snapshot:\n|-ROOT\n--Snapshot Name        : pre'),
+                (0, u'')])
+            bp._upload_file = Mock()
+            with self.assertRaises(RuntimeError):
+                bp._prepare_native_backup(
+                    u'DummyVM-1', u'1',
+                    u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmx',
+                    u'2013-12-04_08-03-34')
+            self.assertFalse(bp._upload_file.called)
+    
+    def test_prepare_native_backup(self):
+        with backup.BackupProfile(self.dummy_profile) as bp:
+            vmx = (u'scsi0:0.fileName = "DummyVM-1.vmdk"\n'
+                   u'scsi0:1.fileName = "DummyVM-1_1.vmdk"\n')
+            descriptor = u'RW 16777216 VMFS "DummyVM-1-flat.vmdk"\n'
+            bp._run_ssh_batch = Mock(side_effect=[
+                [(0, u'Get Snapshot:\n|-ROOT'), (0, vmx)],
+                [(0, descriptor), (0, u'')]])
+            bp._upload_file = Mock()
+            self.assertTupleEqual(
+                bp._prepare_native_backup(
+                    u'DummyVM-1', u'1',
+                    u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmx',
+                    u'2013-12-04_08-03-34'),
+                (vmx, {u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmdk': (
+                    descriptor,
+                    [u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1-flat.vmdk'
+                     ])}))
+            bp._run_ssh_batch.assert_called_with([
+                u'cat "/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmdk"',
+                u'vim-cmd vmsvc/snapshot.create 1 '
+                u'"esxitools-2013-12-04_08-03-34" '
+                u'"esxitools backup snapshot" 0 0'])
+            bp._upload_file.assert_called_once_with(
+                u'/local/vmware/extentstream.py', u'/tmp/extentstream.py')
+    
+    def test_native_backup_removes_snapshot_on_failure(self):
+        import shutil
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        dummy_profile = dict(self.dummy_profile)
+        dummy_profile[u'backups_archive_dir'] = tmp_dir
+        try:
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._get_remote_vm = Mock(return_value=(
+                    u'1', u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmx'))
+                bp._prepare_native_backup = Mock(return_value=(
+                    u'', {u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmdk':
+                          (u'', [u'/vmfs/volumes/datastore1/DummyVM-1/'
+                                 u'DummyVM-1-flat.vmdk'])}))
+                bp._stream_remote_extents = Mock(
+                    side_effect=RuntimeError(u'Broken pipe'))
+                bp._remove_remote_snapshots = Mock()
+                run = {u'timings': dict()}
+                with self.assertRaises(RuntimeError):
+                    bp.backup_vm(u'DummyVM-1', run)
+                bp._remove_remote_snapshots.assert_called_once_with(u'1')
+                self.assertItemsEqual(run[u'timings'].keys(),
+                                      [u'remote_backup', u'download'])
+                self.assertListEqual(os.listdir(bp._get_staging_dir()), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_native_backup_cleanup_failure(self):
+        "Check that a failing snapshot cleanup is bounded and not masking"
+        import shutil
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        dummy_profile = dict(self.dummy_profile)
+        dummy_profile[u'backups_archive_dir'] = tmp_dir
+        deadlines = list()
+        def remove_snapshots(vmid):
+            deadlines.append(bp._deadline)
+            raise watchdog.StageTimeout(u'Stage "cancel" timed out')
+        try:
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._get_remote_vm = Mock(return_value=(
+                    u'1', u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmx'))
+                bp._prepare_native_backup = Mock(return_value=(
+                    u'', {u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmdk':
+                          (u'', [u'/vmfs/volumes/datastore1/DummyVM-1/'
+                                 u'DummyVM-1-flat.vmdk'])}))
+                bp._stream_remote_extents = Mock(
+                    side_effect=RuntimeError(u'Broken pipe'))
+                bp._remove_remote_snapshots = Mock(
+                    side_effect=remove_snapshots)
+                with self.assertRaises(RuntimeError) as cm:
+                    bp.backup_vm(u'DummyVM-1', {u'timings': dict()})
+                self.assertEqual(cm.exception.message, u'Broken pipe')
+                self.assertEqual(deadlines[0].stage, u'cancel')
+                self.assertIsNone(bp._deadline)
+                self.assertListEqual(os.listdir(bp._get_staging_dir()), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_native_backup_removes_snapshot_on_create_failure(self):
+        "Check that a failed snapshot.create is still cleaned up"
+        import shutil
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        dummy_profile = dict(self.dummy_profile)
+        dummy_profile[u'backups_archive_dir'] = tmp_dir
+        try:
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._get_remote_vm = Mock(return_value=(
+                    u'1', u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmx'))
+                bp._run_ssh_batch = Mock(side_effect=[
+                    [(0, u'Get Snapshot:\n|-ROOT'),
+                     (0, u'scsi0:0.fileName = "DummyVM-1.vmdk"\n')],
+                    RuntimeError(u'Connection reset')])
+                bp._upload_file = Mock()
+                bp._remove_remote_snapshots = Mock()
+                run = {u'timings': dict()}
+                with self.assertRaises(RuntimeError):
+                    bp.backup_vm(u'DummyVM-1', run)
+                bp._remove_remote_snapshots.assert_called_once_with(u'1')
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_remove_remote_snapshots_keeps_other_snapshots(self):
+        with backup.BackupProfile(self.dummy_profile) as bp:
+            bp._run_ssh_batch = Mock(side_effect=[
+                [(0,
+                  u'Get Snapshot:\n'
+                  u'|-ROOT\n'
+                  u'--Snapshot Name        : esxitools-2013-12-04_08-03-34\n'
+                  u'--Snapshot Id        : 2\n'
+                  u'--Snapshot Desciption  : esxitools backup snapshot\n'
+                  u'--|-CHILD\n'
+                  u'----Snapshot Name        : before upgrade\n'
+                  u'----Snapshot Id        : 3\n'
+                  u'----Snapshot Desciption  : \n'), (0, u'')],
+                [(0, u'')]])
+            bp._remove_remote_snapshots(u'1')
+            self.assertListEqual(bp._run_ssh_batch.call_args_list, [
+                call([u'vim-cmd vmsvc/snapshot.get 1',
+                      u'rm -f "/tmp/extentstream.py"'], stop_on_error=False),
+                call([u'vim-cmd vmsvc/snapshot.remove 1 2'],
+                     stop_on_error=False)])
+    
+    def test_native_backup(self):
+        import shutil
+        import tarfile
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        dummy_profile = dict(self.dummy_profile)
+        dummy_profile[u'backups_archive_dir'] = tmp_dir
+        def stream(remote_path, local_path):
+            with open(local_path, 'wb') as local_file:
+                local_file.write(b'disk')
+            return 4, 4
+        try:
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._get_current_time = Mock(return_value=backup.datetime.datetime(
+                    2013,12,4,8,3,34))
+                bp._get_remote_vm = Mock(return_value=(
+                    u'1', u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmx'))
+                bp._prepare_native_backup = Mock(return_value=(
+                    u'vmx', {u'/vmfs/volumes/datastore1/DummyVM-1/DummyVM-1.vmdk':
+                             (u'descriptor', [u'/vmfs/volumes/datastore1/'
+                                              u'DummyVM-1/DummyVM-1-flat.vmdk'])}))
+                bp._stream_remote_extents = Mock(side_effect=stream)
+                bp._remove_remote_snapshots = Mock()
+                run = bp.backup_vm(u'DummyVM-1')
+                self.assertEqual(run[u'outcome'], u'ok')
+                bp._remove_remote_snapshots.assert_called_once_with(u'1')
+                self.assertListEqual(os.listdir(bp._get_staging_dir()), [])
+            archive = tarfile.open(os.path.join(
+                tmp_dir, u'DummyVM-1-2013-12-04_08-03-34.tar.gz'), 'r:gz')
+            self.assertItemsEqual(archive.getnames(), [
+                u'DummyVM-1-2013-12-04_08-03-34',
+                u'DummyVM-1-2013-12-04_08-03-34/DummyVM-1.vmx',
+                u'DummyVM-1-2013-12-04_08-03-34/DummyVM-1.vmdk',
+                u'DummyVM-1-2013-12-04_08-03-34/DummyVM-1-flat.vmdk'])
+            archive.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_download_sparse_backup(self):
+        dummy_profile = dict(self.dummy_profile)
+        dummy_profile[u'remote_backup_dir'] = \
+            u'/vmfs/volumes/Backup-LUN/BackupsDir'
+        with backup.BackupProfile(dummy_profile) as bp:
+            bp._list_remote_backup_files = Mock(return_value=[
+                (u'DummyVM-1.vmx', 3284),
+                (u'DummyVM-1-flat.vmdk', 8589934592)])
+            bp._upload_file = Mock()
+            bp._remove_remote_files = Mock()
+            bp._stream_remote_extents = Mock(side_effect=[
+                (8589934592, 1048576), (3284, 3284)])
+            self.assertTupleEqual(bp._download_sparse_backup(
+                u'DummyVM-1', u'DummyVM-1-2013-12-04_08-03-34',
+                u'/staging', 1), (8589934592 + 3284, 1048576 + 3284))
+            remote_dir = (u'/vmfs/volumes/Backup-LUN/BackupsDir/DummyVM-1/'
+                          u'DummyVM-1-2013-12-04_08-03-34')
+            self.assertListEqual(bp._stream_remote_extents.call_args_list, [
+                call(remote_dir + u'/DummyVM-1-flat.vmdk',
+                     os.path.join(u'/staging', u'DummyVM-1-flat.vmdk')),
+                call(remote_dir + u'/DummyVM-1.vmx',
+                     os.path.join(u'/staging', u'DummyVM-1.vmx'))])
+            bp._upload_file.assert_called_once_with(
+                u'/local/vmware/extentstream.py', u'/tmp/extentstream.py')
+            bp._remove_remote_files.assert_called_once_with(
+                [u'/tmp/extentstream.py'])
+    
+    def test_backup_vm_sparse(self):
+        import shutil
+        import tarfile
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        dummy_profile = {
+            u'backups_archive_dir': tmp_dir,
+            u'backup_vms':  {
+                u'DummyVM-1': {
+                    u'sparse_archive': True,
+                },
+            },
+        }
+        def download(vmname, backup_dir, staging_dir, streams):
+            with open(os.path.join(staging_dir, u'DummyVM-1-flat.vmdk'),
+                      'wb') as disk_file:
+                disk_file.truncate(1024 * 1024)
+            return 1024 * 1024, 0
+        try:
+            with backup.BackupProfile(dummy_profile) as bp:
+                bp._run_remote_backup = Mock(return_value={
+                    u'FINAL_STATUS': True,
+                    u'VM_BACKUP_DIR_NAMING_CONVENTION': u'2013-12-04_08-03-34',
+                })
+                bp._archive_remote_backup = Mock()
+                bp._download_sparse_backup = Mock(side_effect=download)
+                run = bp.backup_vm(u'DummyVM-1')
+                self.assertEqual(run[u'outcome'], u'ok')
+                self.assertFalse(bp._archive_remote_backup.called)
+                self.assertItemsEqual(run[u'timings'].keys(),
+                                      [u'remote_backup', u'archive',
+                                       u'download'])
+                self.assertListEqual(os.listdir(bp._get_staging_dir()), [])
+            archive = tarfile.open(os.path.join(
+                tmp_dir, u'DummyVM-1-2013-12-04_08-03-34.tar.gz'), 'r:gz')
+            self.assertEqual(archive.extractfile(
+                u'DummyVM-1-2013-12-04_08-03-34/DummyVM-1-flat.vmdk').read(),
+                b'\0' * 1024 * 1024)
+            archive.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def _make_sparse_dir(self, tmp_dir):
+        src_dir = os.path.join(tmp_dir, u'DummyVM-1-2013-12-04_08-03-34')
+        os.makedirs(src_dir)
+        with open(os.path.join(src_dir, u'DummyVM-1-flat.vmdk'),
+                  'wb') as disk_file:
+            disk_file.seek(4 * 1024 * 1024)
+            disk_file.write(b'data')
+        return src_dir
+    
+    @unittest.skipUnless(backup.BackupProfile._get_gnu_tar(),
+                         u'GNU tar not installed')
+    def test_archive_local_dir_sparse(self):
+        import shutil
+        import tarfile
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        try:
+            src_dir = self._make_sparse_dir(tmp_dir)
+            dest_path = os.path.join(tmp_dir, u'archive.tar.gz')
+            with backup.BackupProfile({}) as bp:
+                bp._archive_local_dir(src_dir, dest_path)
+            archive = tarfile.open(dest_path, 'r:gz')
+            member = archive.getmember(
+                u'DummyVM-1-2013-12-04_08-03-34/DummyVM-1-flat.vmdk')
+            self.assertTrue(member.issparse())
+            self.assertEqual(archive.extractfile(member).read(),
+                             b'\0' * 4 * 1024 * 1024 + b'data')
+            archive.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_archive_local_dir_without_gnu_tar(self):
+        import shutil
+        import tarfile
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        try:
+            src_dir = self._make_sparse_dir(tmp_dir)
+            dest_path = os.path.join(tmp_dir, u'archive.tar.gz')
+            with backup.BackupProfile({}) as bp:
+                bp._get_gnu_tar = Mock(return_value=None)
+                bp._archive_local_dir(src_dir, dest_path)
+            archive = tarfile.open(dest_path, 'r:gz')
+            self.assertEqual(archive.extractfile(
+                u'DummyVM-1-2013-12-04_08-03-34/DummyVM-1-flat.vmdk').read(),
+                b'\0' * 4 * 1024 * 1024 + b'data')
+            archive.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_archive_local_dir_timeout(self):
+        "Check that local archiving stops at the stage deadline"
+        import shutil
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        try:
+            src_dir = self._make_sparse_dir(tmp_dir)
+            dest_path = os.path.join(tmp_dir, u'archive.tar.gz')
+            for gnu_tar in set([backup.BackupProfile._get_gnu_tar(), None]):
+                with backup.BackupProfile({}) as bp:
+                    bp._get_gnu_tar = Mock(return_value=gnu_tar)
+                    bp._deadline = watchdog.Deadline(u'archive', 0)
+                    with self.assertRaises(watchdog.StageTimeout):
+                        bp._archive_local_dir(src_dir, dest_path)
+                self.assertItemsEqual(os.listdir(tmp_dir),
+                                      [u'DummyVM-1-2013-12-04_08-03-34'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+class NotifyTests(unittest.TestCase):
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.spool_dir = mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.spool_dir)
+    
+    def test_smtp_digests_over_one_connection(self):
+        "Check that spooled messages are sent as digests on one connection"
+        sink = notify.get_sink({
+            u'type': u'smtp', u'host': u'localhost', u'port': 2525,
+            u'starttls': False, u'from': u'esxi@example.com',
+            u'recipients': [u'admin@example.com'],
+        })
+        notifier = notify.Notifier(self.spool_dir, {u'email': sink},
+                                   max_batch=2)
+        for vm in (u'DummyVM-1', u'DummyVM-2', u'DummyVM-3'):
+            notifier.enqueue(u'BACKUP OK %s' % (vm), u'log of %s' % (vm))
+        self.assertEqual(len(notifier.pending(u'email')), 3)
+        with patch('smtplib.SMTP') as smtp:
+            self.assertDictEqual(notifier.flush(), {u'email': None})
+        smtp.assert_called_once_with(u'localhost', 2525, timeout=60)
+        server = smtp.return_value
+        self.assertEqual(server.sendmail.call_count, 2)
+        server.quit.assert_called_once_with()
+        message = server.sendmail.call_args_list[0][0][2]
+        self.assertIn(b'Subject: 2 notifications: BACKUP OK DummyVM-1; '
+                      b'BACKUP OK DummyVM-2', message)
+        self.assertIn(b'log of DummyVM-2', message)
+        self.assertListEqual(notifier.pending(u'email'), [])
+    
+    def test_smtp_delivery_to_local_server(self):
+        "Check delivery to a local SMTP stand-in"
+        import smtpd
+        import asyncore
+        import threading
+        received = list()
+        class StandIn(smtpd.SMTPServer):
+            def process_message(self, peer, mailfrom, rcpttos, data):
+                received.append((mailfrom, rcpttos, data))
+        server = StandIn((u'127.0.0.1', 0), None)
+        thread = threading.Thread(target=asyncore.loop,
+                                  kwargs={'timeout': 0.1})
+        thread.start()
+        try:
+            notifier = notify.Notifier(self.spool_dir, {
+                u'email': notify.get_sink({
+                    u'type': u'smtp', u'host': u'127.0.0.1',
+                    u'port': server.socket.getsockname()[1],
+                    u'starttls': False, u'from': u'esxi@example.com',
+                    u'recipients': u'admin@example.com'})}, max_batch=1)
+            notifier.enqueue(u'BACKUP OK DummyVM-1', u'log 1')
+            notifier.enqueue(u'BACKUP OK DummyVM-2', u'log 2')
+            self.assertDictEqual(notifier.flush(), {u'email': None})
+        finally:
+            server.close()
+            thread.join()
+        self.assertEqual(len(received), 2)
+        self.assertEqual(received[0][:2], (u'esxi@example.com',
+                                           [u'admin@example.com']))
+        self.assertIn(u'Subject: BACKUP OK DummyVM-2', received[1][2])
+    
+    def test_retry_and_spool_on_failure(self):
+        "Check that deliveries are retried, and kept spooled if they fail"
+        sink = Mock()
+        sink.send.side_effect = [IOError(u'Connection refused'), None]
+        notifier = notify.Notifier(self.spool_dir, {u'hook': sink},
+                                   retries=1, retry_delay=5)
+        notifier._sleep = Mock()
+        notifier.enqueue(u'BACKUP OK DummyVM-1', u'log')
+        self.assertDictEqual(notifier.flush(), {u'hook': None})
+        notifier._sleep.assert_called_once_with(5)
+        self.assertEqual(sink.send.call_count, 2)
+        self.assertListEqual(notifier.pending(u'hook'), [])
+        sink.send.side_effect = IOError(u'Connection refused')
+        notifier.enqueue(u'BACKUP FAILED DummyVM-2', u'log')
+        self.assertDictEqual(notifier.flush(),
+                             {u'hook': u'Connection refused'})
+        self.assertEqual(len(notifier.pending(u'hook')), 1)
+    
+    def test_sinks_are_spooled_separately(self):
+        "Check that a failing sink does not hold back (or repeat) others"
+        out_path = os.path.join(self.spool_dir, u'notifications.log')
+        bad_sink = Mock()
+        bad_sink.send.side_effect = IOError(u'Timed out')
+        notifier = notify.Notifier(self.spool_dir, {
+            u'file': notify.get_sink({u'type': u'file', u'path': out_path}),
+            u'hook': bad_sink,
+        }, retries=0)
+        notifier.enqueue(u'BACKUP OK DummyVM-1', u'log')
+        notifier.flush()
+        notifier.flush()
+        with open(out_path, 'rb') as out_file:
+            self.assertEqual(out_file.read(),
+                             b'Subject: BACKUP OK DummyVM-1\n\nlog\n\n')
+        self.assertEqual(len(notifier.pending(u'hook')), 1)
+    
+    def test_notifications_delivered_detached(self):
+        "Check that spooled notifications are left to a detached notify"
+        dummy_profile = {
+            u'backups_archive_dir': self.spool_dir,
+            u'notify_sinks': {
+                u'log': {u'type': u'file', u'path': os.path.join(
+                    self.spool_dir, u'notifications.log')},
+            },
+        }
+        kwargs = {u'profile_name': u'Dummy', u'config': u'/etc/esxi.yaml'}
+        with backup.BackupProfile(dummy_profile) as bp, \
+                patch(__name__ + '.backup.subprocess.Popen') as popen:
+            with backup._notifications(bp, kwargs):
+                pass
+            self.assertFalse(popen.called)
+            with backup._notifications(bp, kwargs) as notifier:
+                notifier.enqueue(u'BACKUP OK DummyVM-1', u'log')
+            self.assertEqual(popen.call_count, 1)
+            self.assertListEqual(popen.call_args[0][0][2:], [
+                u'-c', u'/etc/esxi.yaml', u'notify', u'Dummy'])
+            # The output of the detached command is kept
+            log_path = os.path.join(notifier.spool_dir,
+                                    u'.esxitools-notify.log')
+            self.assertEqual(popen.call_args[1]['stderr'].name, log_path)
+            with open(log_path, 'rb') as log_file:
+                self.assertIn(b' notify Dummy ===', log_file.read())
+            self.assertEqual(len(notifier.pending(u'log')), 1)
+    
+    def test_backup_profile_email_sink(self):
+        "Check that email_report profiles get an email sink by default"
+        dummy_profile = {
+            u'backups_archive_dir': self.spool_dir,
+            u'email_report': True,
+            u'gmail_user': u'example@gmail.com',
+            u'gmail_pwd': u'password',
+            u'from_field': u'You <example@gmail.com>',
+            u'recipients': u'example@gmail.com',
+        }
+        with backup.BackupProfile(dummy_profile) as bp:
+            notifier = bp.get_notifier()
+            self.assertItemsEqual(notifier.sinks.keys(), [u'email'])
+            self.assertEqual(notifier.sinks[u'email'].host, u'smtp.gmail.com')
+            self.assertListEqual(notifier.sinks[u'email'].recipients,
+                                 [u'example@gmail.com'])
+            self.assertEqual(notifier.spool_dir,
+                             os.path.join(self.spool_dir, u'.notify-spool'))
+
+class SimulateTests(unittest.TestCase):
+    def _simulated_profile(self, archives=None):
+        from datetime import datetime, time
+        dummy_profile = {
+            u'backups_archive_dir': u'/mnt/backups/ESXi-archives',
+            u'backup_times': ( (time(23,00,00), time.max),
+                               (time.min, time(04,00,00)) ),
+            u'backup_vms':  {
+                u'DummyVM-1': {
+                    u'period': timedelta(1),
+                    u'rotation_count': 2,
+                },
+                u'DummyVM-2': {
+                    u'period': timedelta(7),
+                    u'rotation_count': 3,
+                },
+            },
+        }
+        return simulate.SimulatedBackupProfile(
+            dummy_profile, archives or {}, datetime(2013,12,1,12,0,0))
+    
+    def test_simulated_listing_and_trim(self):
+        "Check that the real trimming logic runs against the index"
+        bp = self._simulated_profile({
+            u'DummyVM-1-2013-11-28_23-00-00.tar.gz': 10,
+            u'DummyVM-1-2013-11-29_23-00-00.tar.gz': 10,
+            u'DummyVM-1-2013-11-30_23-00-00.tar.gz': 10,
+            u'DummyVM-2-2013-11-20_23-00-00.tar.gz': 20,
+        })
+        self.assertEqual(len(bp._list_backup_archives_for_vm(u'DummyVM-1')),
+                         3)
+        bp.trim_backup_archives()
+        self.assertItemsEqual(bp.archives.keys(), [
+            u'DummyVM-1-2013-11-29_23-00-00.tar.gz',
+            u'DummyVM-1-2013-11-30_23-00-00.tar.gz',
+            u'DummyVM-2-2013-11-20_23-00-00.tar.gz'])
+        self.assertEqual(bp.get_next_vm_to_backup(), u'DummyVM-2')
+    
+    def test_simulate_schedule(self):
+        bp = self._simulated_profile()
+        res = simulate.simulate_schedule(
+            bp, {u'DummyVM-1': 3600, u'DummyVM-2': 2 * 3600},
+            {u'DummyVM-1': 100, u'DummyVM-2': 1000}, 14)
+        runs = [(vmname, ts.strftime(u'%Y-%m-%d %H:%M'))
+                for vmname, ts, _ in res[u'runs']]
+        # Both VMs first thing in the first window, then DummyVM-1 daily
+        # (once a day is overdue) and DummyVM-2 weekly
+        self.assertEqual(runs[:3], [(u'DummyVM-1', u'2013-12-01 23:00'),
+                                    (u'DummyVM-2', u'2013-12-02 00:00'),
+                                    (u'DummyVM-1', u'2013-12-02 23:00')])
+        self.assertEqual(len([r for r in runs if u'DummyVM-1' == r[0]]), 14)
+        self.assertEqual(len([r for r in runs if u'DummyVM-2' == r[0]]), 2)
+        self.assertEqual(len(bp._list_backup_archives_for_vm(u'DummyVM-1')),
+                         2)
+        self.assertEqual(res[u'storage_peak'][0], 3 * 100 + 2 * 1000)
+        self.assertEqual(res[u'overrun_seconds'], 0)
+        self.assertEqual(res[u'window_seconds'], 14 * 5 * 3600)
+        self.assertEqual(res[u'overdue'][u'DummyVM-2'], (0, 0, False))
+        report = simulate.format_simulation(res)
+        self.assertIn(u'Window utilization: 25.7% of 70.0 window hours',
+                      report)
+    
+    def test_simulate_overloaded_window(self):
+        "Check that VMs not fitting in the window show up as overdue"
+        bp = self._simulated_profile()
+        bp.backup_vms[u'DummyVM-2'].period = timedelta(1)
+        res = simulate.simulate_schedule(
+            bp, {u'DummyVM-1': 6 * 3600, u'DummyVM-2': 6 * 3600}, {}, 7)
+        self.assertEqual(len(res[u'runs']), 7)
+        self.assertEqual(res[u'overrun_seconds'], 7 * 3600)
+        total, worst, _ = res[u'overdue'][u'DummyVM-1']
+        self.assertEqual(worst, 24 * 3600)
+        self.assertIn(u'DummyVM-1: overdue',
+                      simulate.format_simulation(res))
+    
+    def test_archive_index_skips_corrupt(self):
+        "Check that the simulation starts from the archives the scheduler sees"
+        import shutil
+        from tempfile import mkdtemp
+        tmp_dir = mkdtemp()
+        try:
+            for archive in (u'DummyVM-1-2013-12-04_08-03-34.tar.gz',
+                            u'DummyVM-1-2013-12-05_08-03-34.tar.gz',
+                            u'DummyVM-2-2013-12-05_08-03-34.part0of2.tar.gz'):
+                with open(os.path.join(tmp_dir, archive), 'wb') as f:
+                    f.write(b'data')
+            integrity.save_manifest(tmp_dir, {
+                u'DummyVM-1-2013-12-05_08-03-34.tar.gz': {u'ok': False},
+            })
+            with backup.BackupProfile({u'backups_archive_dir': tmp_dir}) as bp:
+                self.assertDictEqual(simulate._get_archive_index(bp, {}), {
+                    u'DummyVM-1-2013-12-04_08-03-34.tar.gz': 4,
+                })
+        finally:
+            shutil.rmtree(tmp_dir)
+
+def _has_module(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+class CompressionTests(unittest.TestCase):
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.archive_dir = mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.archive_dir)
+    
+    def _make_archive(self, name):
+        import tarfile
+        src_path = os.path.join(self.archive_dir, u'DummyVM-1-flat.vmdk')
+        with open(src_path, 'wb') as src_file:
+            src_file.write(b'\0' * 1024 * 1024 + os.urandom(1024))
+        archive_path = os.path.join(self.archive_dir, name)
+        tar = tarfile.open(archive_path, 'w:gz')
+        tar.add(src_path, arcname=u'DummyVM-1/DummyVM-1-flat.vmdk')
+        tar.close()
+        os.remove(src_path)
+        return archive_path
+    
+    def _check_recompress(self, fmt):
+        import tarfile
+        archive_path = self._make_archive(
+            u'DummyVM-1-2013-12-04_08-03-34.tar.gz')
+        res = compression.recompress_archive(self.archive_dir, archive_path,
+                                             fmt, 1, 2)
+        new_path = os.path.join(self.archive_dir,
+            u'DummyVM-1-2013-12-04_08-03-34%s' % (compression.EXTENSIONS[fmt]))
+        self.assertEqual(res[0], new_path)
+        self.assertLess(res[2], res[1])
+        self.assertListEqual(sorted(os.listdir(self.archive_dir)), sorted([
+            os.path.split(new_path)[1], u'.tier-catalog.json.lock']))
+        self.assertTrue(integrity.check_archive(new_path)[u'ok'])
+        with open(new_path, 'rb') as raw_file:
+            tar = tarfile.open(
+                fileobj=compression.open_reader(fmt, raw_file), mode='r|')
+            self.assertListEqual([member.name for member in tar],
+                                 [u'DummyVM-1/DummyVM-1-flat.vmdk'])
+            tar.close()
+        # Corruption is detected
+        with open(new_path, 'r+b') as raw_file:
+            raw_file.seek(res[2] // 2)
+            raw_file.write(b'corrupt')
+        self.assertFalse(integrity.check_archive(new_path)[u'ok'])
+    
+    @unittest.skipUnless(_has_module('backports.lzma') or
+                         _has_module('lzma'), 'requires lzma')
+    def test_recompress_xz(self):
+        self._check_recompress(u'xz')
+    
+    @unittest.skipUnless(_has_module('backports.lzma') or
+                         _has_module('lzma'), 'requires lzma')
+    def test_recompress_xz_without_xz_tool(self):
+        with patch(__name__ + '.compression.find_executable',
+                   return_value=None):
+            self._check_recompress(u'xz')
+    
+    @unittest.skipUnless(_has_module('zstandard'), 'requires zstandard')
+    def test_recompress_zst(self):
+        self._check_recompress(u'zst')
+    
+    @unittest.skipUnless(_has_module('zstandard'), 'requires zstandard')
+    def test_recompress_archives_shares_cpus(self):
+        "Check that the CPUs are shared between processes and codec threads"
+        archive_paths = [os.path.join(self.archive_dir, name) for name in (
+            u'DummyVM-1-2013-12-01_01-23-45.tar.gz',
+            u'DummyVM-1-2013-12-02_01-23-45.tar.gz',
+            u'DummyVM-1-2013-12-03_01-23-45.tar.xz')]
+        with nested(patch(__name__ + '.compression.cpu_count',
+                          return_value=8),
+                    patch(__name__ + '.compression.Pool')) as (_, pool):
+            pool.return_value.imap_unordered.side_effect = \
+                lambda job, jobs: list(jobs)
+            jobs = compression.recompress_archives(
+                self.archive_dir, archive_paths, u'zst', 3)
+            pool.assert_called_once_with(2)
+            self.assertListEqual([job[-1] for job in jobs], [4, 4])
+            jobs = compression.recompress_archives(
+                self.archive_dir, archive_paths, u'zst', 3, 16)
+            pool.assert_called_with(2)
+            jobs = compression.recompress_archives(
+                self.archive_dir, archive_paths[:1], u'zst', 3, 4)
+            pool.assert_called_with(1)
+            self.assertListEqual([job[-1] for job in jobs], [8])
+    
+    def test_listing_formats(self):
+        "Check that recompressed archives are listed, and partial ones not"
+        dummy_profile = {
+            u'backups_archive_dir': self.archive_dir,
+            u'backup_vms':  {
+                u'DummyVM-1': {},
+            },
+        }
+        for name in (u'DummyVM-1-2013-12-01_01-23-45.tar.xz',
+                     u'DummyVM-1-2013-12-02_01-23-45.tar.zst',
+                     u'DummyVM-1-2013-12-03_01-23-45.tar.gz',
+                     u'DummyVM-1-2013-12-04_01-23-45.tar.xz.part'):
+            open(os.path.join(self.archive_dir, name), 'wb').close()
+        with backup.BackupProfile(dummy_profile) as bp:
+            self.assertItemsEqual(
+                [os.path.split(path)[1]
+                 for path in bp._list_backup_archives_for_vm(u'DummyVM-1')],
+                [u'DummyVM-1-2013-12-01_01-23-45.tar.xz',
+                 u'DummyVM-1-2013-12-02_01-23-45.tar.zst',
+                 u'DummyVM-1-2013-12-03_01-23-45.tar.gz'])
+            from datetime import datetime
+            self.assertDictEqual(bp.get_latest_archives(), {
+                u'DummyVM-1': datetime(2013,12,3,1,23,45)})
+    
+    def test_recompress_archives_gzip_only(self):
+        dummy_profile = {
+            u'backups_archive_dir': self.archive_dir,
+            u'recompress_format': u'xz',
+            u'recompress_level': 1,
+            u'recompress_processes': 2,
+            u'backup_vms':  {
+                u'DummyVM-1': {},
+            },
+        }
+        with backup.BackupProfile(dummy_profile) as bp:
+            with patch(__name__ + '.compression.recompress_archives',
+                       return_value=[]) as recompress_archives:
+                open(os.path.join(self.archive_dir,
+                     u'DummyVM-1-2013-12-01_01-23-45.tar.xz'), 'wb').close()
+                archive_path = os.path.join(
+                    self.archive_dir, u'DummyVM-1-2013-12-02_01-23-45.tar.gz')
+                open(archive_path, 'wb').close()
+                self.assertListEqual(bp.recompress_archives(), [])
+                recompress_archives.assert_called_once_with(
+                    self.archive_dir, [archive_path], u'xz', 1, 2)
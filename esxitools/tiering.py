@@ -0,0 +1,162 @@
+"""
+Tiered archive storage.
+
+The newest archives of every VM stay in the (hot) archive directory, while
+older ones are offloaded to a secondary (cold) target - another directory
+or mount, or an S3-compatible object store. A catalog in the archive
+directory tracks where every offloaded archive lives.
+"""
+import os
+import json
+from multiprocessing.pool import ThreadPool
+
+import compat
+
+CATALOG_NAME = u'.tier-catalog.json'
+PART_SIZE = 64 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def _copy_range(src_path, dst_path, offset, length):
+    "Copies `length` bytes at `offset` of `src_path` into `dst_path`"
+    with open(src_path, 'rb') as src_file:
+        with open(dst_path, 'r+b') as dst_file:
+            src_file.seek(offset)
+            dst_file.seek(offset)
+            while length > 0:
+                data = src_file.read(min(COPY_BUFFER_SIZE, length))
+                if not data:
+                    raise IOError(u'Unexpected end of "%s"' % (src_path))
+                dst_file.write(data)
+                length -= len(data)
+
+class DirectoryTarget(object):
+    "Cold storage in a local directory or mount"
+    def __init__(self, config, streams):
+        self.path = config[u'path']
+        self.streams = streams
+
+    def location(self, name):
+        return os.path.join(self.path, name)
+
+    def upload(self, local_path, name):
+        """
+        Copies `local_path` to the target as `name` using `streams` parallel
+        range copies, returning the location of the copy.
+        """
+        dest_path = self.location(name)
+        part_path = u'%s.part' % (dest_path)
+        size = os.path.getsize(local_path)
+        with open(part_path, 'wb') as part_file:
+            part_file.truncate(size)
+        pool = ThreadPool(self.streams)
+        try:
+            pool.map(lambda offset: _copy_range(
+                         local_path, part_path, offset,
+                         min(PART_SIZE, size - offset)),
+                     range(0, size, PART_SIZE))
+        finally:
+            pool.close()
+            pool.join()
+        with open(part_path, 'r+b') as part_file:
+            os.fsync(part_file.fileno())
+        os.rename(part_path, dest_path)
+        return dest_path
+
+    def delete(self, name):
+        os.remove(self.location(name))
+
+class S3Target(object):
+    "Cold storage in an S3-compatible object store (e.g. MinIO)"
+    def __init__(self, config, streams):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError(u'S3 cold storage requires boto3')
+        self._client = boto3.client(
+            's3', endpoint_url=config.get(u'endpoint_url'),
+            aws_access_key_id=config.get(u'access_key'),
+            aws_secret_access_key=config.get(u'secret_key'))
+        self.bucket = config[u'bucket']
+        self.prefix = config.get(u'prefix', u'')
+        self._transfer_config = TransferConfig(
+            multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE,
+            max_concurrency=streams, use_threads=True)
+
+    def _key(self, name):
+        return u'%s%s' % (self.prefix, name)
+
+    def location(self, name):
+        return u's3://%s/%s' % (self.bucket, self._key(name))
+
+    def upload(self, local_path, name):
+        "Uploads `local_path` as parallel multipart streams"
+        self._client.upload_file(local_path, self.bucket, self._key(name),
+                                 Config=self._transfer_config)
+        return self.location(name)
+
+    def delete(self, name):
+        self._client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+_targets = {
+    u'directory':   DirectoryTarget,
+    u's3':          S3Target,
+}
+
+def get_target(config, streams):
+    "Returns cold storage target for `config` (see `cold_storage` setting)"
+    return _targets[config[u'type']](config, streams)
+
+def get_catalog_path(archive_dir):
+    return os.path.join(archive_dir, CATALOG_NAME)
+
+def load_catalog(archive_dir):
+    """
+    Returns the catalog of `archive_dir` as a dictionary, with offloaded
+    archive file names as keys and {location, size} entries as values.
+    """
+    catalog_path = get_catalog_path(archive_dir)
+    if not os.path.isfile(catalog_path):
+        return dict()
+    with open(catalog_path, 'r') as catalog_file:
+        return json.load(catalog_file)
+
+def _save_catalog(archive_dir, catalog):
+    catalog_path = get_catalog_path(archive_dir)
+    tmp_path = u'%s.tmp' % (catalog_path)
+    with open(tmp_path, 'w') as catalog_file:
+        json.dump(catalog, catalog_file, indent=1, sort_keys=True)
+    os.rename(tmp_path, catalog_path)
+
+def catalog_lock(archive_dir):
+    "Serializes catalog updates between offload and backup processes"
+    return compat.file_lock(u'%s.lock' % (get_catalog_path(archive_dir)))
+
+def offload_archive(archive_dir, target, archive_path):
+    """
+    Moves `archive_path` from `archive_dir` to cold `target`, returning
+    its new location, or None if the archive was deleted while copying.
+    """
+    _, archive = os.path.split(archive_path)
+    size = os.path.getsize(archive_path)
+    # Copy outside the lock, so backups are not blocked meanwhile
+    location = target.upload(archive_path, archive)
+    with catalog_lock(archive_dir):
+        if not os.path.isfile(archive_path):
+            # Trimmed while it was being copied
+            target.delete(archive)
+            return None
+        catalog = load_catalog(archive_dir)
+        catalog[archive] = {u'location': location, u'size': size}
+        _save_catalog(archive_dir, catalog)
+        os.remove(archive_path)
+    return location
+
+def remove_archive(archive_dir, target, archive):
+    "Deletes offloaded `archive` from cold `target` and the catalog"
+    with catalog_lock(archive_dir):
+        catalog = load_catalog(archive_dir)
+        if archive in catalog:
+            target.delete(archive)
+            del catalog[archive]
+            _save_catalog(archive_dir, catalog)
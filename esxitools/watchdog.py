@@ -0,0 +1,85 @@
+"""
+Deadlines and stall detection for long-running backup stages.
+"""
+import time
+
+class StageTimeout(RuntimeError):
+    pass
+
+def get_timeout(duration, factor, minimum, maximum):
+    """
+    Returns stage timeout (in seconds) allowing `factor` times the
+    historical `duration`, bounded by `minimum` and `maximum`.
+    If there is no history (`duration` is None), returns `maximum`.
+    """
+    if duration is None:
+        return maximum
+    return min(max(duration * factor, minimum), maximum)
+
+class Deadline(object):
+    "Deadline of a named stage, `timeout` seconds from creation"
+    _clock = staticmethod(time.time)
+
+    def __init__(self, stage, timeout):
+        self.stage = stage
+        self.timeout = timeout
+        self._expires = self._clock() + timeout
+
+    def remaining(self):
+        return max(self._expires - self._clock(), 0)
+
+    def expired(self):
+        return self._clock() >= self._expires
+
+    def check(self):
+        "Raises StageTimeout if the deadline has passed"
+        if self.expired():
+            raise StageTimeout(u'Stage "%s" timed out after %d seconds' %
+                               (self.stage, self.timeout))
+
+class TransferMonitor(object):
+    """
+    Tracks byte progress of a transfer against a stage `deadline`,
+    treating `stall_timeout` seconds without progress as a stall.
+    """
+    _clock = staticmethod(time.time)
+
+    def __init__(self, deadline, stall_timeout):
+        self.deadline = deadline
+        self.stall_timeout = stall_timeout
+        self.transferred = 0
+        self._last_progress = self._clock()
+
+    def update(self, nbytes):
+        "Records `nbytes` of progress, raising StageTimeout if overdue"
+        self.transferred += nbytes
+        if nbytes:
+            self._last_progress = self._clock()
+        self.check()
+
+    def check(self):
+        if self.deadline:
+            self.deadline.check()
+        if self._clock() - self._last_progress >= self.stall_timeout:
+            self.stalled()
+
+    def stalled(self):
+        raise StageTimeout(u'Transfer stalled after %d bytes' %
+                           (self.transferred))
+
+class DeadlineWriter(object):
+    """
+    Writes to `out_file`, checking the stage `deadline` (if any) on every
+    write, for writers that cannot poll the deadline themselves
+    """
+    def __init__(self, out_file, deadline):
+        self.out_file = out_file
+        self.deadline = deadline
+
+    def write(self, data):
+        if self.deadline:
+            self.deadline.check()
+        self.out_file.write(data)
+
+    def flush(self):
+        self.out_file.flush()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Streams a (mostly zeroed) disk file to stdout, skipping all-zero blocks.
+#
+# Usage: extentstream.py FILE
+#
+# Stream format (all integers are unsigned 64bit big-endian):
+#   "ESXTENT1" <file size>
+#   Repeated: <offset> <length> <length bytes of data>
+#   Terminated by a record with zero length (and no data).
+#
+# Runs on the ESXi host Python (2.6 and up, including Python 3).
+import os
+import sys
+import struct
+
+MAGIC = b'ESXTENT1'
+BLOCK_SIZE = 64 * 1024
+MAX_EXTENT_SIZE = 16 * BLOCK_SIZE
+ZERO_BLOCK = b'\0' * BLOCK_SIZE
+
+def iter_extents(src_file):
+    "Yields (offset, data) of the non-zero extents of `src_file`"
+    offset = 0
+    extent_offset, extent = 0, []
+    extent_size = 0
+    while True:
+        block = src_file.read(BLOCK_SIZE)
+        if not block:
+            break
+        if block == ZERO_BLOCK[:len(block)]:
+            if extent:
+                yield extent_offset, b''.join(extent)
+                extent, extent_size = [], 0
+        else:
+            if not extent:
+                extent_offset = offset
+            extent.append(block)
+            extent_size += len(block)
+            if extent_size >= MAX_EXTENT_SIZE:
+                yield extent_offset, b''.join(extent)
+                extent, extent_size = [], 0
+        offset += len(block)
+    if extent:
+        yield extent_offset, b''.join(extent)
+
+def write_extents(src_path, out):
+    "Writes the extent stream of `src_path` to binary file object `out`"
+    src_file = open(src_path, 'rb')
+    try:
+        out.write(MAGIC + struct.pack('>Q', os.path.getsize(src_path)))
+        for offset, data in iter_extents(src_file):
+            out.write(struct.pack('>QQ', offset, len(data)))
+            out.write(data)
+        out.write(struct.pack('>QQ', 0, 0))
+        out.flush()
+    finally:
+        src_file.close()
+
+if '__main__' == __name__:
+    if 2 != len(sys.argv):
+        sys.stderr.write('Usage: %s FILE\n' % (sys.argv[0]))
+        sys.exit(2)
+    write_extents(sys.argv[1], getattr(sys.stdout, 'buffer', sys.stdout))